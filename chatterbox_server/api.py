@@ -3,22 +3,42 @@ import os
 import tempfile
 from typing import Optional
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.responses import JSONResponse, StreamingResponse, Response
 import uvicorn
 
+from chatterbox.models.s3gen.flow_matching import CFM_SOLVERS
+from chatterbox.models.s3gen.s3gen import PROMPT_CONTEXT_MODES
+
 try:
     from .tts_service import TTSService, TTSSettings
+    from .prefork import process_memory, serve_prefork
 except Exception:
     # Fallback for direct execution: python chatterbox_server/api.py
     import os as _os, sys as _sys
     _sys.path.append(_os.path.dirname(_os.path.dirname(__file__)))
     from chatterbox_server.tts_service import TTSService, TTSSettings
+    from chatterbox_server.prefork import process_memory, serve_prefork
 
 app = FastAPI(title="Chatterbox TTS API", version="0.1.0")
 svc = TTSService()
 
 
+def check_flow_options(n_cfm_timesteps: Optional[int], cfm_solver: Optional[str], flow_prompt_mode: str):
+    "Reject non-positive step counts and unknown solver / prompt modes with a 422 instead of failing inside the flow"
+    if n_cfm_timesteps is not None and n_cfm_timesteps <= 0:
+        raise HTTPException(status_code=422, detail=f"n_cfm_timesteps must be positive, got {n_cfm_timesteps}")
+    if cfm_solver is not None and cfm_solver not in CFM_SOLVERS:
+        raise HTTPException(
+            status_code=422, detail=f"cfm_solver must be one of {list(CFM_SOLVERS)}, got {cfm_solver!r}",
+        )
+    if flow_prompt_mode not in PROMPT_CONTEXT_MODES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"flow_prompt_mode must be one of {list(PROMPT_CONTEXT_MODES)}, got {flow_prompt_mode!r}",
+        )
+
+
 @app.post("/synthesize")
 async def synthesize(
     text: str,
@@ -32,7 +52,12 @@ async def synthesize(
     return_base64: bool = True,
     pitch_semitones: float = 0.0,
     time_stretch: float = 1.0,
+    n_cfm_timesteps: Optional[int] = None,
+    cfm_solver: Optional[str] = None,
+    flow_prompt_seconds: Optional[float] = None,
+    flow_prompt_mode: str = "tail",
 ):
+    check_flow_options(n_cfm_timesteps, cfm_solver, flow_prompt_mode)
     settings = TTSSettings(
         fast_mode=fast_mode,
         exaggeration=exaggeration,
@@ -41,6 +66,10 @@ async def synthesize(
         streaming=streaming,
         pitch_semitones=pitch_semitones,
         time_stretch=time_stretch,
+        n_cfm_timesteps=n_cfm_timesteps,
+        cfm_solver=cfm_solver,
+        flow_prompt_seconds=flow_prompt_seconds,
+        flow_prompt_mode=flow_prompt_mode,
     )
     prompt_path = audio_prompt_path
     tmp_prompt = None
@@ -80,7 +109,12 @@ async def synthesize_upload(
     return_base64: bool = Form(True),
     pitch_semitones: float = Form(0.0),
     time_stretch: float = Form(1.0),
+    n_cfm_timesteps: Optional[int] = Form(None),
+    cfm_solver: Optional[str] = Form(None),
+    flow_prompt_seconds: Optional[float] = Form(None),
+    flow_prompt_mode: str = Form("tail"),
 ):
+    check_flow_options(n_cfm_timesteps, cfm_solver, flow_prompt_mode)
     tmp = tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.filename)[1] or ".wav", delete=False)
     tmp.write(await file.read())
     tmp.close()
@@ -97,6 +131,10 @@ async def synthesize_upload(
             return_base64=return_base64,
             pitch_semitones=pitch_semitones,
             time_stretch=time_stretch,
+            n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+            flow_prompt_seconds=flow_prompt_seconds,
+            flow_prompt_mode=flow_prompt_mode,
         )
     finally:
         try:
@@ -114,13 +152,24 @@ async def stream_raw(
     exaggeration: float = 0.8,
     cfg_weight: float = 0.15,
     prompt_trim_seconds: float = 2.0,
+    n_cfm_timesteps: Optional[int] = None,
+    cfm_solver: Optional[str] = None,
+    flow_prompt_seconds: Optional[float] = None,
+    flow_prompt_mode: str = "tail",
+    flow_chunk_tokens: Optional[int] = None,
 ):
+    check_flow_options(n_cfm_timesteps, cfm_solver, flow_prompt_mode)
     settings = TTSSettings(
         fast_mode=fast_mode,
         exaggeration=exaggeration,
         cfg_weight=cfg_weight,
         prompt_trim_seconds=prompt_trim_seconds,
         streaming=True,
+        n_cfm_timesteps=n_cfm_timesteps,
+        cfm_solver=cfm_solver,
+        flow_prompt_seconds=flow_prompt_seconds,
+        flow_prompt_mode=flow_prompt_mode,
+        flow_chunk_tokens=flow_chunk_tokens,
     )
     prompt_path = audio_prompt_path
     tmp_prompt = None
@@ -146,9 +195,20 @@ async def stream_raw(
                 pass
 
 
+@app.get("/memory")
+async def memory():
+    # per-worker memory split; with CHATTERBOX_API_WORKERS > 1 most of the RSS should be shared
+    return JSONResponse({"pid": os.getpid(), **process_memory()})
+
+
 def main():
     host = os.environ.get("CHATTERBOX_API_HOST", "127.0.0.1")
     port = int(os.environ.get("CHATTERBOX_API_PORT", "8000"))
+    workers = int(os.environ.get("CHATTERBOX_API_WORKERS", "1"))
+    if workers > 1:
+        threads = os.environ.get("CHATTERBOX_WORKER_THREADS")
+        serve_prefork(app, host, port, workers, threads_per_worker=int(threads) if threads else None)
+        return
     uvicorn.run("chatterbox_server.api:app", host=host, port=port, reload=False)
 
 
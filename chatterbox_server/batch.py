@@ -0,0 +1,209 @@
+"""
+Bulk synthesis of a JSONL job file with the models loaded once.
+
+    chatterbox-batch jobs.jsonl --out-dir out/ [--batch-size 8] [--report report.jsonl]
+    cat jobs.jsonl | chatterbox-batch - --out-dir out/
+
+One job per line: {"id": "...", "text": "...", "voice": "/path/ref.wav", ...} plus optional settings
+(exaggeration, cfg_weight, temperature, prompt_trim_seconds, n_cfm_timesteps, cfm_solver, flow_prompt_seconds,
+flow_prompt_mode). `voice` may be omitted for the built-in voice; `id` defaults to the line number.
+
+Jobs are grouped by voice and settings, sorted by text token count within a group and cut into batches of
+similar length, so each batch runs one lockstep T3 sampling pass and one padded S3Gen pass with little padding.
+Outputs are written to `<out-dir>/<id>.wav`. A batch that fails is retried job by job so one bad line only fails
+itself. Real-time factor and speech tokens/sec are printed per job as batches finish, and for the whole run
+(with the failures) at the end.
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import torch
+import torchaudio as ta
+
+from chatterbox.tts import punc_norm
+
+try:
+    from .processing import load_prompt
+    from .tts_service import TTSService
+except Exception:
+    import os as _os, sys as _sys
+    _sys.path.append(_os.path.dirname(_os.path.dirname(__file__)))
+    from chatterbox_server.processing import load_prompt
+    from chatterbox_server.tts_service import TTSService
+
+# job fields that select the conditionals and generation settings, with their defaults
+GROUP_FIELDS = {
+    "voice": None,
+    "prompt_trim_seconds": 2.0,
+    "exaggeration": 0.5,
+    "cfg_weight": 0.5,
+    "temperature": 0.8,
+    "n_cfm_timesteps": None,
+    "cfm_solver": None,
+    "flow_prompt_seconds": None,
+    "flow_prompt_mode": "tail",
+}
+
+
+@dataclass
+class Job:
+    id: str
+    text: str
+    settings: Dict
+    n_text_tokens: int = 0
+    audio_s: float = 0.0
+    speech_tokens: int = 0
+    wall_s: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def filename(self) -> str:
+        return re.sub(r"[^\w.-]", "_", self.id) + ".wav"
+
+    @property
+    def group(self):
+        return tuple(self.settings[k] for k in GROUP_FIELDS)
+
+
+@dataclass
+class Report:
+    jobs: List[Job] = field(default_factory=list)
+    wall_s: float = 0.0
+
+    def add(self, job: Job):
+        self.jobs.append(job)
+        status = f"FAILED: {job.error}" if job.error else (
+            f"{job.audio_s:6.1f} s audio, RTF {job.wall_s / max(job.audio_s, 1e-6):.3f}, "
+            f"{job.speech_tokens / max(job.wall_s, 1e-6):.0f} tok/s")
+        print(f"[{len(self.jobs)}] {job.id}: {status}", flush=True)
+
+    def summary(self) -> str:
+        ok = [j for j in self.jobs if not j.error]
+        audio = sum(j.audio_s for j in ok)
+        tokens = sum(j.speech_tokens for j in ok)
+        return (f"{len(ok)}/{len(self.jobs)} jobs ok, {len(self.jobs) - len(ok)} failed; "
+                f"{audio:.1f} s audio in {self.wall_s:.1f} s (RTF {self.wall_s / max(audio, 1e-6):.3f}), "
+                f"{tokens / max(self.wall_s, 1e-6):.0f} speech tokens/s")
+
+
+def read_jobs(lines: Iterable[str]) -> List[Job]:
+    jobs = []
+    for i, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        d = json.loads(line)
+        if not d.get("text"):
+            raise ValueError(f"line {i}: missing text")
+        settings = {k: d.get(k, default) for k, default in GROUP_FIELDS.items()}
+        jobs.append(Job(id=str(d.get("id", i)), text=d["text"], settings=settings))
+    return jobs
+
+
+def make_batches(jobs: List[Job], batch_size: int) -> List[List[Job]]:
+    "Group by voice/settings, then cut each group, sorted by text length, into batches of similar length"
+    batches = []
+    jobs = sorted(jobs, key=lambda j: (repr(j.group), j.n_text_tokens))
+    for _, group in groupby(jobs, key=lambda j: repr(j.group)):
+        group = list(group)
+        batches += [group[i:i + batch_size] for i in range(0, len(group), batch_size)]
+    return batches
+
+
+def _set_voice(svc: TTSService, settings: Dict, builtin):
+    if settings["voice"] is None:
+        svc.model.conds = builtin
+        return
+    prompt = load_prompt(settings["voice"], settings["prompt_trim_seconds"], svc.sr)
+    svc.model.prepare_conditionals(prompt, exaggeration=settings["exaggeration"])
+
+
+def _generate_kwargs(settings: Dict) -> Dict:
+    return {k: v for k, v in settings.items() if k not in ("voice", "prompt_trim_seconds")}
+
+
+def run_batch(svc: TTSService, batch: List[Job], out_dir: Path, report: Report):
+    kwargs = _generate_kwargs(batch[0].settings)
+    start = time.perf_counter()
+    try:
+        wavs, token_counts = svc.model.generate_batch([j.text for j in batch], return_token_counts=True, **kwargs)
+    except Exception as e:
+        if len(batch) == 1:
+            batch[0].error = f"{type(e).__name__}: {e}"
+            report.add(batch[0])
+            return
+        for job in batch:  # isolate the failing job(s)
+            run_batch(svc, [job], out_dir, report)
+        return
+    wall = time.perf_counter() - start
+    total_samples = sum(w.size(-1) for w in wavs)
+    for job, wav, n_tokens in zip(batch, wavs, token_counts):
+        try:
+            ta.save(str(out_dir / job.filename), wav, svc.sr)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+        job.audio_s = wav.size(-1) / svc.sr
+        job.speech_tokens = n_tokens
+        # the batch's wall time, split by each job's share of the audio
+        job.wall_s = wall * wav.size(-1) / max(total_samples, 1)
+        report.add(job)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Chatterbox bulk JSONL synthesis")
+    p.add_argument("jobs", help="JSONL job file, or - for stdin")
+    p.add_argument("--out-dir", required=True, help="Directory for <id>.wav outputs")
+    p.add_argument("--batch-size", type=int, default=8, help="Texts per batched T3/S3Gen pass")
+    p.add_argument("--skip-existing", action="store_true", help="Skip jobs whose output file exists")
+    p.add_argument("--report", help="Write per-job results as JSONL")
+    args = p.parse_args()
+
+    with (sys.stdin if args.jobs == "-" else open(args.jobs, encoding="utf-8")) as f:
+        jobs = read_jobs(f)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if args.skip_existing:
+        jobs = [j for j in jobs if not (out_dir / j.filename).exists()]
+
+    svc = TTSService()
+    builtin = svc.model.conds
+    for job in jobs:
+        job.n_text_tokens = len(svc.model.tokenizer.encode(punc_norm(job.text)))
+    batches = make_batches(jobs, args.batch_size)
+    print(f"{len(jobs)} jobs in {len(batches)} batches", flush=True)
+
+    report, start, current = Report(), time.perf_counter(), None
+    with torch.inference_mode():
+        for batch in batches:
+            settings = batch[0].settings
+            if batch[0].group != current:
+                try:
+                    _set_voice(svc, settings, builtin)
+                    current = batch[0].group
+                except Exception as e:
+                    for job in batch:
+                        job.error = f"voice {settings['voice']}: {type(e).__name__}: {e}"
+                        report.add(job)
+                    current = None
+                    continue
+            run_batch(svc, batch, out_dir, report)
+    report.wall_s = time.perf_counter() - start
+
+    print(report.summary())
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            for j in report.jobs:
+                f.write(json.dumps({"id": j.id, "audio_s": j.audio_s, "wall_s": j.wall_s,
+                                    "speech_tokens": j.speech_tokens, "error": j.error}) + "\n")
+    if any(j.error for j in report.jobs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
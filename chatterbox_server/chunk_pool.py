@@ -0,0 +1,82 @@
+"""
+Multi-process fan-out of the sentence chunks of one long text. Each chunk is an independent T3 + S3Gen run that
+uses one or two cores well, so on many-core CPUs a pool of single-threaded worker processes synthesizes several
+chunks at once. Workers are forked from the process that loaded the model, so they share its weights
+copy-on-write; every task carries the request's precomputed conditionals, and results come back in chunk order
+for the crossfade.
+
+Linux (or any OS with `os.fork`) and CPU serving only. Create the pool before the parent runs any inference:
+forking after OpenMP / MKL thread pools have started can deadlock the children.
+"""
+import multiprocessing as mp
+import os
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+import torch
+
+_MODEL = None
+
+
+def _init_worker(num_threads: int):
+    torch.set_num_threads(max(1, num_threads))
+
+
+def _generate(task) -> torch.Tensor:
+    conds, text, kwargs = task
+    _MODEL.conds = conds
+    with torch.inference_mode():
+        return _MODEL.generate(text, **kwargs).cpu()
+
+
+def save_wav_npy(path, wav: torch.Tensor):
+    "Mono float32 samples as .npy, written to a temporary file and renamed, so `path` exists only when complete"
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        np.save(f, wav.reshape(-1).float().numpy())
+    os.replace(tmp, path)
+
+
+def _generate_to_file(task) -> str:
+    conds, text, kwargs, path = task
+    save_wav_npy(path, _generate((conds, text, kwargs)))
+    return path
+
+
+class ChunkPool:
+    """
+    `workers` forked processes, each with `threads_per_worker` torch threads, generating chunks with `model`
+    (a ChatterboxTTS / ChatterboxTurboTTS / ChatterboxMultilingualTTS).
+    """
+
+    def __init__(self, model, workers: int, threads_per_worker: int = 1):
+        if not hasattr(os, "fork"):
+            raise RuntimeError("the chunk pool needs os.fork (Linux/macOS)")
+        if workers < 2:
+            raise ValueError(f"a chunk pool needs at least 2 workers, got {workers}")
+        global _MODEL
+        _MODEL = model
+        self.workers = workers
+        self._pid = os.getpid()
+        self._pool = mp.get_context("fork").Pool(workers, initializer=_init_worker, initargs=(threads_per_worker,))
+
+    def usable(self) -> bool:
+        "False in processes forked after the pool was created (e.g. pre-fork workers), which can't use its pipes"
+        return self._pool is not None and os.getpid() == self._pid
+
+    def imap(self, conds, tasks: Iterable[Tuple[str, dict]]) -> Iterator[torch.Tensor]:
+        "Waveforms for `(text, generate kwargs)` tasks, all with conditionals `conds`, in task order"
+        return self._pool.imap(_generate, [(conds, text, kwargs) for text, kwargs in tasks])
+
+    def imap_to_files(self, conds, tasks: Iterable[Tuple[str, dict, str]]) -> Iterator[str]:
+        """
+        Generate `(text, generate kwargs, path)` tasks and save each waveform to its path (`save_wav_npy`) from
+        the worker. Paths are yielded as they complete, in any order.
+        """
+        return self._pool.imap_unordered(_generate_to_file, [(conds, *task) for task in tasks])
+
+    def close(self):
+        if self._pool is not None and self.usable():
+            self._pool.terminate()
+            self._pool.join()
+        self._pool = None
@@ -2,18 +2,31 @@ import argparse
 import os
 from typing import Optional
 
+from chatterbox.models.s3gen.flow_matching import CFM_SOLVERS
+from chatterbox.models.s3gen.s3gen import PROMPT_CONTEXT_MODES
+
 try:
     from .tts_service import TTSService, TTSSettings
+    from .longform import read_text_file, synthesize_longform
 except Exception:
     # Fallback for direct execution: python chatterbox_server/cli.py
     import os as _os, sys as _sys
     _sys.path.append(_os.path.dirname(_os.path.dirname(__file__)))
     from chatterbox_server.tts_service import TTSService, TTSSettings
+    from chatterbox_server.longform import read_text_file, synthesize_longform
+
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f"must be positive, got {n}")
+    return n
 
 
 def main() -> None:
     p = argparse.ArgumentParser(description="Chatterbox TTS CLI")
-    p.add_argument("text", help="Text to synthesize")
+    p.add_argument("text", nargs="?", help="Text to synthesize")
+    p.add_argument("--file", dest="file", help="Long-form mode: synthesize a .txt/.md file (audiobook), resumable")
     p.add_argument("--prompt", dest="prompt", help="Path to voice prompt (wav/mp3)")
     p.add_argument("--out", dest="out", default=os.path.join(os.getcwd(), "out.wav"), help="Output wav path")
     p.add_argument("--fast", dest="fast", action="store_true", help="Enable fast mode")
@@ -24,9 +37,28 @@ def main() -> None:
     p.add_argument("--fade", dest="fade_ms", type=int, default=30)
     p.add_argument("--pitch", dest="pitch_semitones", type=float, default=0.0)
     p.add_argument("--tempo", dest="time_stretch", type=float, default=1.0)
+    p.add_argument("--cfm-steps", dest="n_cfm_timesteps", type=positive_int, default=None,
+                   help="S3Gen CFM steps (default 10)")
+    p.add_argument("--cfm-solver", dest="cfm_solver", choices=CFM_SOLVERS, default=None, help="S3Gen CFM ODE solver")
+    p.add_argument("--flow-prompt", dest="flow_prompt_seconds", type=float, default=None,
+                   help="Seconds of the reference the S3Gen flow conditions on (default: all)")
+    p.add_argument("--flow-prompt-mode", dest="flow_prompt_mode", choices=PROMPT_CONTEXT_MODES, default="tail")
+    p.add_argument("--vocoder-chunk-frames", type=int, default=None,
+                   help="Vocode in windows of this many mel frames (50/s) to keep vocoder memory flat")
+    p.add_argument("--flow-chunk-tokens", type=int, default=None,
+                   help="Also run the S3Gen flow in windows of this many speech tokens (25/s); streamed audio starts "
+                        "after the first window")
+    lf = p.add_argument_group("long-form (--file)")
+    lf.add_argument("--workers", type=int, default=None,
+                    help="Parallel single-threaded worker processes (default: CHATTERBOX_CHUNK_WORKERS or 1)")
+    lf.add_argument("--max-tokens", type=int, default=120, help="Text-token budget per segment")
+    lf.add_argument("--pause", dest="pause_ms", type=int, default=600, help="Silence between paragraphs (ms)")
+    lf.add_argument("--parts-dir", help="Segment checkpoint directory (default: <out>.parts)")
     args = p.parse_args()
+    if (args.text is None) == (args.file is None):
+        p.error("pass either a text or --file")
 
-    svc = TTSService()
+    svc = TTSService(chunk_workers=args.workers)
     settings = TTSSettings(
         fast_mode=bool(args.fast),
         exaggeration=float(args.exaggeration),
@@ -36,9 +68,23 @@ def main() -> None:
         fade_ms=int(args.fade_ms),
         pitch_semitones=float(args.pitch_semitones),
         time_stretch=float(args.time_stretch),
+        n_cfm_timesteps=args.n_cfm_timesteps,
+        cfm_solver=args.cfm_solver,
+        flow_prompt_seconds=args.flow_prompt_seconds,
+        flow_prompt_mode=args.flow_prompt_mode,
+        vocoder_chunk_frames=args.vocoder_chunk_frames,
+        flow_chunk_tokens=args.flow_chunk_tokens,
     )
 
-    path = svc.synthesize_to_file(args.text, args.prompt, args.out, settings)
+    if args.file:
+        path = synthesize_longform(
+            svc, read_text_file(args.file), args.prompt, args.out, settings,
+            max_tokens=args.max_tokens, pause_ms=args.pause_ms, parts_dir=args.parts_dir,
+            progress=lambda done, total: print(f"\rsegments {done}/{total}", end="", flush=True),
+        )
+        print()
+    else:
+        path = svc.synthesize_to_file(args.text, args.prompt, args.out, settings)
     print(f"Saved: {path}")
 
 
@@ -0,0 +1,247 @@
+"""
+Long-form (audiobook) synthesis of a text or markdown file.
+
+- The text is split into paragraphs, then into segments of whole sentences under a text-token budget, so no segment
+  runs into T3's speech-token limit.
+- Segments are synthesized with the voice conditionals prepared once (and cached next to the segments), in
+  parallel across the service's chunk pool when it has one.
+- Each finished segment is saved to `<out>.parts/` under a name keyed by its text and settings; rerunning the same
+  command after a crash only synthesizes the missing ones.
+- The output WAV is preallocated and memory-mapped, and segments are crossfaded into it one at a time, so the
+  assembly never holds more than one segment in RAM.
+"""
+import hashlib
+import json
+import re
+import struct
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from chatterbox.tts import Conditionals, punc_norm
+
+try:
+    from .chunk_pool import save_wav_npy
+    from .processing import load_prompt
+    from .tts_service import TTSService, TTSSettings
+except Exception:
+    import os as _os, sys as _sys
+    _sys.path.append(_os.path.dirname(_os.path.dirname(__file__)))
+    from chatterbox_server.chunk_pool import save_wav_npy
+    from chatterbox_server.processing import load_prompt
+    from chatterbox_server.tts_service import TTSService, TTSSettings
+
+
+def markdown_to_text(md: str) -> str:
+    "Plain prose from markdown: drops code blocks, images, HTML and markup, keeps link text and headings"
+    md = re.sub(r"```.*?```", "", md, flags=re.S)
+    md = re.sub(r"<[^>]+>", "", md)
+    md = re.sub(r"!\[[^\]]*\]\([^)]*\)", "", md)
+    md = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", md)
+    lines = []
+    for line in md.splitlines():
+        # a heading or list item without final punctuation still ends a sentence; other lines may be hard-wrapped
+        # paragraph text, which must not be split at the line break
+        ends_sentence = re.match(r"\s{0,3}(#{1,6}\s+|[-*+]\s+|\d+[.)]\s+)", line) is not None
+        line = re.sub(r"^\s{0,3}(#{1,6}\s+|>\s?|[-*+]\s+|\d+[.)]\s+)", "", line)
+        if re.fullmatch(r"\s*([-*_]\s*){3,}", line):
+            line = ""
+        line = re.sub(r"(\*{1,3}|_{1,3}|`)(\S.*?\S|\S)\1", r"\2", line)
+        if ends_sentence and line.strip() and not re.search(r"[.!?:;,…\"')]$", line.strip()):
+            line = line.rstrip() + "."
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def read_text_file(path) -> str:
+    path = Path(path)
+    text = path.read_text(encoding="utf-8")
+    return markdown_to_text(text) if path.suffix.lower() in (".md", ".markdown") else text
+
+
+def _split_long(sentence: str, count: Callable[[str], int], max_tokens: int) -> List[str]:
+    "Split a sentence over the budget at clause boundaries, then between words"
+    parts: List[str] = []
+    for piece in re.split(r"(?<=[,;:])\s+", sentence):
+        if count(piece) > max_tokens:
+            parts += piece.split()
+        else:
+            parts.append(piece)
+    out, buf = [], ""
+    for p in parts:
+        cand = f"{buf} {p}".strip()
+        if buf and count(cand) > max_tokens:
+            out.append(buf)
+            buf = p
+        else:
+            buf = cand
+    return out + ([buf] if buf else [])
+
+
+def segment_text(text: str, count: Callable[[str], int], max_tokens: int = 120) -> List[Tuple[str, bool]]:
+    """
+    Segments of `text` as (text, ends_paragraph). Sentences are packed up to `max_tokens` text tokens (as counted
+    by `count`); segments never span a paragraph break.
+    """
+    segments: List[Tuple[str, bool]] = []
+    for para in re.split(r"\n\s*\n", text):
+        para = " ".join(para.split())
+        if not para:
+            continue
+        buf, para_segments = "", []
+        for sentence in re.split(r"(?<=[.!?…])\s+", para):
+            for piece in ([sentence] if count(sentence) <= max_tokens else _split_long(sentence, count, max_tokens)):
+                cand = f"{buf} {piece}".strip()
+                if buf and count(cand) > max_tokens:
+                    para_segments.append(buf)
+                    buf = piece
+                else:
+                    buf = cand
+        if buf:
+            para_segments.append(buf)
+        segments += [(s, i == len(para_segments) - 1) for i, s in enumerate(para_segments)]
+    return segments
+
+
+def _key(*parts) -> str:
+    return hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:12]
+
+
+def _voice_conds(
+    svc: TTSService, prompt_path: Optional[str], voice_key: str, settings: TTSSettings, parts_dir: Path,
+) -> Conditionals:
+    "Conditionals for the voice, prepared once and cached in `parts_dir` so a resumed run skips the embedding"
+    if prompt_path is None:
+        return svc.model.conds
+    path = parts_dir / f"conds-{_key(voice_key, settings.prompt_trim_seconds, settings.exaggeration)}.pt"
+    if path.exists():
+        return Conditionals.load(path, map_location=svc.map_location).to(svc.device)
+    prompt = load_prompt(prompt_path, settings.prompt_trim_seconds, svc.sr)
+    svc.model.prepare_conditionals(prompt, exaggeration=settings.exaggeration)
+    svc.model.conds.save(path)
+    return svc.model.conds
+
+
+def _wav_header(num_samples: int, sr: int) -> bytes:
+    data = num_samples * 2
+    return (b"RIFF" + struct.pack("<I", 36 + data) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sr, sr * 2, 2, 16)
+            + b"data" + struct.pack("<I", data))
+
+
+def assemble_wav(
+    parts: Sequence[Path],
+    ends_paragraph: Sequence[bool],
+    out_path,
+    sr: int,
+    fade_samples: int,
+    pause_samples: int,
+) -> int:
+    """
+    Write the segment `.npy` files into a 16-bit mono WAV at `out_path`: consecutive segments of a paragraph are
+    crossfaded over `fade_samples`, paragraphs are separated by `pause_samples` of silence. The WAV is
+    preallocated and filled through a memory map one segment at a time. Returns the number of samples.
+    """
+    lengths = [np.load(p, mmap_mode="r").shape[0] for p in parts]
+    starts, crossfaded, pos = [], [], 0
+    for i, n in enumerate(lengths):
+        cross = i > 0 and not ends_paragraph[i - 1] and 0 < fade_samples < min(n, lengths[i - 1])
+        pos -= fade_samples if cross else 0
+        starts.append(pos)
+        crossfaded.append(cross)
+        pos += n + (pause_samples if ends_paragraph[i] and i < len(lengths) - 1 else 0)
+    total = pos
+    if total * 2 + 36 > 0xFFFFFFFF:
+        raise ValueError(f"{total / sr / 3600:.1f} h of audio does not fit in a WAV file, split the input")
+
+    header = _wav_header(total, sr)
+    with open(out_path, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + total * 2)
+    out = np.memmap(out_path, dtype="<i2", mode="r+", offset=len(header), shape=(total,))
+    fade = np.linspace(0, 1, fade_samples, dtype=np.float32) if fade_samples > 0 else None
+    prev_tail = None
+    for path, start, cross in zip(parts, starts, crossfaded):
+        wav = np.load(path).astype(np.float32)
+        if cross:
+            wav[:fade_samples] = prev_tail * (1 - fade) + wav[:fade_samples] * fade
+        out[start:start + len(wav)] = (np.clip(wav, -1, 1) * 32767.0).astype(np.int16)
+        prev_tail = wav[-fade_samples:].copy() if fade_samples > 0 else None
+    out.flush()
+    del out
+    return total
+
+
+def synthesize_longform(
+    svc: TTSService,
+    text: str,
+    audio_prompt_path: Optional[str],
+    output_path: str,
+    settings: Optional[TTSSettings] = None,
+    max_tokens: int = 120,
+    pause_ms: int = 600,
+    parts_dir: Optional[str] = None,
+    progress: Callable[[int, int], None] = None,
+) -> str:
+    """
+    Synthesize a long `text` into `output_path`, checkpointing each segment under `parts_dir` (default
+    `<output_path>.parts`). Reruns reuse the segments already there. `progress(done, total)` is called as unique
+    segments finish.
+    """
+    if settings is None:
+        settings = TTSSettings()
+    parts_dir = Path(parts_dir or f"{output_path}.parts")
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    tokenizer = svc.model.tokenizer
+    segments = segment_text(text, lambda s: len(tokenizer.encode(punc_norm(s))), max_tokens)
+    if not segments:
+        raise ValueError("no text to synthesize")
+
+    voice_key = hashlib.sha1(Path(audio_prompt_path).read_bytes()).hexdigest() if audio_prompt_path else "builtin"
+    conds = _voice_conds(svc, audio_prompt_path, voice_key, settings, parts_dir)
+    if conds is None:
+        raise ValueError("the model has no built-in voice, pass a voice prompt")
+    kwargs = dict(
+        exaggeration=settings.exaggeration,
+        cfg_weight=settings.cfg_weight,
+        n_cfm_timesteps=settings.n_cfm_timesteps,
+        cfm_solver=settings.cfm_solver,
+        flow_prompt_seconds=settings.flow_prompt_seconds,
+        flow_prompt_mode=settings.flow_prompt_mode,
+        vocoder_chunk_frames=settings.vocoder_chunk_frames,
+        flow_chunk_tokens=settings.flow_chunk_tokens,
+    )
+    settings_key = json.dumps({k: v for k, v in asdict(settings).items() if k in kwargs}, sort_keys=True)
+    # keyed by content, not position: edits to the text only invalidate the segments they touch
+    # the voice key is the prompt file; the trimmed prompt (and so the conditionals) also depend on the trim length
+    conds_key = _key(voice_key, settings.prompt_trim_seconds)
+    paths = [parts_dir / f"{_key(seg, settings_key, conds_key)}.npy" for seg, _ in segments]
+    pending = list({str(path): (seg, kwargs, str(path)) for (seg, _), path in zip(segments, paths)
+                    if not path.exists()}.values())
+
+    done, total = len({str(p) for p in paths}) - len(pending), len({str(p) for p in paths})
+    if progress:
+        progress(done, total)
+    if svc.chunk_pool is not None and svc.chunk_pool.usable() and len(pending) > 1:
+        for _ in svc.chunk_pool.imap_to_files(conds, pending):
+            done += 1
+            if progress:
+                progress(done, total)
+    else:
+        svc.model.conds = conds
+        for seg, kw, path in pending:
+            with torch.inference_mode():
+                save_wav_npy(path, svc.model.generate(seg, **kw).cpu())
+            done += 1
+            if progress:
+                progress(done, total)
+
+    assemble_wav(
+        paths, [end for _, end in segments], output_path, svc.sr,
+        fade_samples=max(0, int(svc.sr * settings.fade_ms / 1000)),
+        pause_samples=max(0, int(svc.sr * pause_ms / 1000)),
+    )
+    return output_path
@@ -0,0 +1,129 @@
+"""
+Pre-fork serving: the parent process loads the models once, then forks N uvicorn workers on a shared listening
+socket. The weights are never written after loading, so the workers share their pages copy-on-write and each
+additional worker costs its activations and Python heap, not another copy of T3 / S3Gen / VE.
+
+Linux (or any OS with `os.fork`) and CPU serving only; forking after CUDA/MPS initialization is not supported.
+"""
+import gc
+import os
+import signal
+import socket
+import time
+from typing import Dict, List, Optional
+
+import torch
+import uvicorn
+
+
+def process_memory(pid="self") -> Dict[str, float]:
+    """
+    Memory of a process in MiB from /proc/<pid>/smaps_rollup: RSS, PSS (shared pages split between the processes
+    mapping them), and the shared / private parts of the RSS. Empty dict where /proc is not available.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    fields[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    return {
+        "rss_mib": fields.get("Rss", 0.0),
+        "pss_mib": fields.get("Pss", 0.0),
+        "shared_mib": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+        "private_mib": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    }
+
+
+def format_memory(pid, mem: Dict[str, float]) -> str:
+    if not mem:
+        return f"pid {pid}: memory stats unavailable"
+    return (f"pid {pid}: rss {mem['rss_mib']:.0f} MiB (shared {mem['shared_mib']:.0f}, "
+            f"private {mem['private_mib']:.0f}), pss {mem['pss_mib']:.0f} MiB")
+
+
+def configure_worker_threads(num_threads: int):
+    "Per-worker torch thread settings, replacing the single-thread `low_compute_defaults()` of the parent"
+    torch.set_num_threads(max(1, num_threads))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set in the parent before fork
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock: socket.socket, num_threads: int):
+    configure_worker_threads(num_threads)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+
+def serve_prefork(
+    app,
+    host: str,
+    port: int,
+    workers: int,
+    threads_per_worker: Optional[int] = None,
+    report_after: float = 10.0,
+):
+    """
+    Serve the already-imported `app` (whose module-level service has loaded the models) from `workers` forked
+    processes. `threads_per_worker` defaults to the CPU count split evenly between the workers. The parent
+    prints the per-process memory split `report_after` seconds after start, then supervises the workers and
+    forwards SIGINT/SIGTERM to them.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("pre-fork serving needs os.fork (Linux/macOS)")
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    sock = _bind(host, port)
+
+    # keep the collector from touching (and so un-sharing) the pages of every object loaded so far
+    gc.collect()
+    gc.freeze()
+
+    children: List[int] = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _run_worker(app, sock, threads_per_worker)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    print(f"pre-fork: {workers} workers x {threads_per_worker} threads on {host}:{port} (parent pid {os.getpid()})")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    start, reported = time.monotonic(), False
+    alive = set(children)
+    while alive:
+        for pid in list(alive):
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if done:
+                alive.discard(pid)
+        if not reported and time.monotonic() - start >= report_after:
+            reported = True
+            print(format_memory(f"{os.getpid()} (parent)", process_memory()))
+            for pid in sorted(alive):
+                print(format_memory(pid, process_memory(pid)))
+        time.sleep(0.5)
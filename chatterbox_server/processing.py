@@ -3,11 +3,14 @@ import re
 import wave
 import tempfile
 import hashlib
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Optional, Union
 
 import torch
 import torchaudio as ta
 
+from chatterbox.audio_frontend import PromptAudio, decode_audio, get_resampler
+
 # Prefer safe MPS CPU fallback
 os.environ.setdefault("PYTORCH_ENABLE_MPS_FALLBACK", "1")
 
@@ -81,6 +84,56 @@ def tensor_to_pcm16_bytes(x: torch.Tensor) -> bytes:
     return (x * 32767.0).to(torch.int16).cpu().numpy().tobytes()
 
 
+def _crossfade(prev_tail: torch.Tensor, head: torch.Tensor, fade_samples: int) -> Iterator[torch.Tensor]:
+    if prev_tail.size(1) > fade_samples:
+        # short chunks accumulated into a tail longer than the fade
+        yield prev_tail[:, :-fade_samples]
+        prev_tail = prev_tail[:, -fade_samples:]
+    n = prev_tail.size(1)  # shorter than the fade after a very short chunk
+    fade = torch.linspace(0, 1, n, device=head.device).view(1, -1)
+    yield prev_tail * (1 - fade) + head[:, :n] * fade
+    if head.size(1) > n:
+        yield head[:, n:]
+
+
+def crossfade_chunks(
+    chunks: Iterable[Union[torch.Tensor, Iterable[torch.Tensor]]], fade_samples: int,
+) -> Iterator[torch.Tensor]:
+    """
+    Join consecutive (1, T) chunk waveforms with a linear crossfade of `fade_samples`, yielding audio as soon as
+    it is final; the last `fade_samples` of each chunk are held back until the next one arrives. A chunk may also
+    be an iterator of contiguous pieces (e.g. `generate_stream`), which are passed through as they arrive.
+    """
+    prev_tail = None
+    for chunk in chunks:
+        pending = None  # audio of this chunk not yielded yet
+        for wav in ([chunk] if torch.is_tensor(chunk) else chunk):
+            wav = ensure_mono_1xT(wav)
+            if fade_samples <= 0:
+                yield wav
+                continue
+            pending = wav if pending is None else torch.cat([pending, wav], dim=1)
+            # the head is crossfaded into the previous tail, the tail is held for the next chunk
+            if pending.size(1) <= fade_samples * (1 if prev_tail is None else 2):
+                continue
+            if prev_tail is not None:
+                yield from _crossfade(prev_tail, pending[:, :fade_samples], fade_samples)
+                pending, prev_tail = pending[:, fade_samples:], None
+            yield pending[:, :-fade_samples]
+            pending = pending[:, -fade_samples:]
+        if pending is None:
+            continue
+        if prev_tail is None:
+            prev_tail = pending
+        elif pending.size(1) <= fade_samples:
+            prev_tail = torch.cat([prev_tail, pending], dim=1)
+        else:
+            yield from _crossfade(prev_tail, pending[:, :fade_samples], fade_samples)
+            prev_tail = pending[:, fade_samples:]
+    if prev_tail is not None and prev_tail.numel() > 0:
+        yield prev_tail
+
+
 def write_streaming_wav(output_path: str, sr: int):
     wf = wave.open(output_path, "wb")
     wf.setnchannels(1)
@@ -131,17 +184,11 @@ def _prompt_cache_path(source_path: str, seconds: float, target_sr: Optional[int
         return None
 
 
-def trim_prompt(path: str, seconds: Optional[float], target_sr: Optional[int]) -> str:
-    if not path or not os.path.exists(path) or not seconds or seconds <= 0:
-        return path
-    cache_path = _prompt_cache_path(path, seconds, target_sr)
-    if cache_path and os.path.exists(cache_path):
-        return cache_path
-    wav, sr = ta.load(path)
-    if wav.dim() == 2 and wav.size(0) > 1:
-        wav = wav.mean(dim=0, keepdim=True)
+def _clean_prompt(path: str, seconds: float, target_sr: Optional[int]):
+    "Decode, EQ, pick the loudest `seconds` window, trim silence and peak-normalize a prompt; returns (wav, sr)"
+    wav, sr = decode_audio(path)
     if target_sr and target_sr > 0 and target_sr != sr:
-        wav = ta.functional.resample(wav, sr, target_sr)
+        wav = get_resampler(sr, target_sr, "cpu")(wav)
         sr = target_sr
     max_frames = int(sr * seconds)
     try:
@@ -190,6 +237,16 @@ def trim_prompt(path: str, seconds: Optional[float], target_sr: Optional[int]) -
     peak = float(wav.abs().max()) if wav.numel() > 0 else 0.0
     if peak > 0:
         wav = wav / peak * 10 ** (-1 / 20)
+    return wav, sr
+
+
+def trim_prompt(path: str, seconds: Optional[float], target_sr: Optional[int]) -> str:
+    if not path or not os.path.exists(path) or not seconds or seconds <= 0:
+        return path
+    cache_path = _prompt_cache_path(path, seconds, target_sr)
+    if cache_path and os.path.exists(cache_path):
+        return cache_path
+    wav, sr = _clean_prompt(path, seconds, target_sr)
     if cache_path:
         ta.save(cache_path, wav, sr)
         return cache_path
@@ -197,3 +254,29 @@ def trim_prompt(path: str, seconds: Optional[float], target_sr: Optional[int]) -
     tmp.close()
     ta.save(tmp.name, wav, sr)
     return tmp.name
+
+
+_PROMPTS: "OrderedDict[str, PromptAudio]" = OrderedDict()
+_MAX_PROMPTS = 32
+
+
+def load_prompt(path: Optional[str], seconds: Optional[float], target_sr: Optional[int]) -> Optional[PromptAudio]:
+    """
+    In-memory `trim_prompt`: the cleaned prompt as a `PromptAudio`, without writing and re-reading a wav. Results
+    are kept in a small LRU keyed like the on-disk prompt cache (path, mtime, seconds, rate), so repeated requests
+    with the same prompt reuse the decoded and resampled audio.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    key = _prompt_cache_path(path, seconds or 0, target_sr) or path
+    if key in _PROMPTS:
+        _PROMPTS.move_to_end(key)
+        return _PROMPTS[key]
+    if not seconds or seconds <= 0:
+        prompt = PromptAudio.load(path)
+    else:
+        prompt = PromptAudio(*_clean_prompt(path, seconds, target_sr))
+    _PROMPTS[key] = prompt
+    while len(_PROMPTS) > _MAX_PROMPTS:
+        _PROMPTS.popitem(last=False)
+    return prompt
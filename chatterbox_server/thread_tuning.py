@@ -0,0 +1,225 @@
+"""
+Per-stage torch thread budgets. The three inference stages scale differently with intra-op threads: T3 decode runs
+small latency-bound matmuls per token, the S3Gen flow runs the CFM estimator over the whole utterance, and HiFT
+runs convolutions over long sequences. The best count for each also depends on how many requests share the CPU.
+
+A profile maps a concurrency level to a thread count per stage. `tune` measures it on this host by timing each
+stage of real `generate` calls, and `ThreadBudget.install` applies it by wrapping the stage entry points of a
+model so each stage runs with its count for the current number of in-flight requests.
+
+    budget = ThreadBudget(load_profile(path) or tune(model, levels=(1, 2, 4)))
+    budget.install(model)
+    with budget.request():
+        model.generate(...)
+
+Notes:
+- `torch.set_num_threads` is process-wide. Concurrent requests in different stages each set their own count; the
+  per-concurrency profile keeps those counts within the core budget.
+- Inter-op threads can only be set once per process, before any parallel work, so they are not tuned: the
+  stages don't use inter-op parallelism and stay at `low_compute_defaults()`'s single inter-op thread.
+- Stages running on onnxruntime (`S3Gen.use_onnx_backend`) use the ORT thread count they were created with.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("t3", "flow", "hift")
+
+# (stage, attribute path of the object, method names) wrapped by `ThreadBudget.install`
+_ENTRY_POINTS = (
+    ("t3", ("t3",), ("inference", "inference_turbo")),
+    ("flow", ("s3gen",), ("flow_inference",)),
+    ("hift", ("s3gen", "mel2wav"), ("inference",)),
+)
+
+TUNE_TEXT = (
+    "The quick brown fox jumps over the lazy dog, then runs back across the field "
+    "before the farmer notices that the gate was left open."
+)
+
+
+def host_key() -> str:
+    "Profiles are only valid for the host and torch build they were measured on"
+    return f"{os.cpu_count()}cpu-torch{torch.__version__}"
+
+
+def default_profile_path() -> Path:
+    return Path.home() / ".cache" / "chatterbox" / f"threads-{host_key()}.json"
+
+
+def load_profile(path) -> Optional[Dict[int, Dict[str, int]]]:
+    "Profile saved by `save_profile`, or None if the file is missing or was measured on another host"
+    path = Path(path)
+    if not path.exists():
+        return None
+    data = json.loads(path.read_text())
+    if data.get("host") != host_key():
+        logger.warning(f"ignoring thread profile {path}: measured on {data.get('host')}, this host is {host_key()}")
+        return None
+    return {int(level): counts for level, counts in data["levels"].items()}
+
+
+def save_profile(path, profile: Dict[int, Dict[str, int]]):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"host": host_key(), "levels": profile}, indent=2))
+
+
+def _units(out) -> int:
+    "Output size of a stage: speech tokens (T3), mel frames (flow) or samples (HiFT)"
+    if isinstance(out, tuple):
+        out = out[0]
+    return max(1, out.size(-1))
+
+
+class ThreadBudget:
+    """
+    Applies a profile ({concurrency level: {stage: threads}}) around the stages of installed models. The level
+    used is the number of in-flight `request()`s times `processes` (e.g. pre-fork workers), rounded down to the
+    nearest profiled level.
+    """
+
+    def __init__(self, profile: Dict[int, Dict[str, int]], processes: int = 1):
+        if not profile:
+            raise ValueError("empty thread profile")
+        self.profile = {int(k): v for k, v in profile.items()}
+        self.processes = max(1, processes)
+        self.recorder = None
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def threads(self, stage: str, concurrency: Optional[int] = None) -> int:
+        if concurrency is None:
+            concurrency = max(1, self._active) * self.processes
+        levels = sorted(self.profile)
+        level = max([l for l in levels if l <= concurrency], default=levels[0])
+        return int(self.profile[level].get(stage, torch.get_num_threads()))
+
+    @contextlib.contextmanager
+    def request(self):
+        with self._lock:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    @contextlib.contextmanager
+    def stage(self, stage: str):
+        prev = torch.get_num_threads()
+        torch.set_num_threads(self.threads(stage))
+        try:
+            yield
+        finally:
+            torch.set_num_threads(prev)
+
+    def _wrap(self, stage: str, fn):
+        # not `__wrapped__`: bound methods forward it to their function's decorator chain
+        fn = getattr(fn, "_stage_fn", fn)
+
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with self.stage(stage):
+                start = time.perf_counter()
+                out = fn(*args, **kwargs)
+                if self.recorder is not None:
+                    self.recorder(stage, time.perf_counter() - start, out)
+            return out
+
+        run._stage_fn = fn
+        return run
+
+    def install(self, model):
+        """
+        Wrap the stage entry points of a ChatterboxTTS / ChatterboxTurboTTS / ChatterboxMultilingualTTS. Components
+        shared through `models.registry` are wrapped for every model holding them; installing again replaces the
+        previous budget.
+        """
+        for stage, path, methods in _ENTRY_POINTS:
+            obj = model
+            for attr in path:
+                obj = getattr(obj, attr, None)
+            if obj is None:
+                continue
+            for name in methods:
+                if (fn := getattr(obj, name, None)) is not None:
+                    object.__setattr__(obj, name, self._wrap(stage, fn))
+        return model
+
+    @staticmethod
+    def uninstall(model):
+        "Restore the unwrapped stage entry points"
+        for _, path, methods in _ENTRY_POINTS:
+            obj = model
+            for attr in path:
+                obj = getattr(obj, attr, None)
+            for name in methods:
+                if obj is not None and hasattr(obj.__dict__.get(name), "_stage_fn"):
+                    del obj.__dict__[name]
+        return model
+
+
+def _candidates(level: int, max_threads: int) -> Sequence[int]:
+    budget = max(1, max_threads // level)
+    counts, n = {budget}, 1
+    while n < budget:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def tune(
+    model,
+    levels: Iterable[int] = (1,),
+    max_threads: Optional[int] = None,
+    repeats: int = 2,
+    text: str = TUNE_TEXT,
+    **generate_kwargs,
+) -> Dict[int, Dict[str, int]]:
+    """
+    Measure the best thread count per stage at each concurrency level: for each candidate count (powers of two
+    up to the per-request share of `max_threads` cores), `level` threads each run `repeats` `generate` calls at
+    once with every stage at that count. Stages are compared by time per output unit (token, mel frame, sample),
+    so runs that sample different lengths stay comparable. The model must have conditionals prepared.
+    """
+    max_threads = max_threads or os.cpu_count() or 1
+    budget = ThreadBudget({1: {}})
+    budget.install(model)
+    prev = torch.get_num_threads()
+    profile = {}
+    try:
+        for level in levels:
+            best: Dict[str, tuple] = {}
+            for n in _candidates(level, max_threads):
+                times = defaultdict(list)
+                budget.profile = {1: {stage: n for stage in STAGES}}
+                budget.recorder = lambda stage, seconds, out: times[stage].append(seconds / _units(out))
+                with ThreadPoolExecutor(max_workers=level) as pool:
+                    runs = [pool.submit(model.generate, text, **generate_kwargs) for _ in range(level * repeats)]
+                    for r in runs:
+                        r.result()
+                for stage, ts in times.items():
+                    per_unit = statistics.median(ts)
+                    logger.info(f"concurrency {level}, {n} threads: {stage} {per_unit * 1e6:.1f} us/unit")
+                    if stage not in best or per_unit < best[stage][1]:
+                        best[stage] = (n, per_unit)
+            profile[level] = {stage: n for stage, (n, _) in best.items()}
+            logger.info(f"concurrency {level}: {profile[level]}")
+    finally:
+        ThreadBudget.uninstall(model)
+        torch.set_num_threads(prev)
+    return profile
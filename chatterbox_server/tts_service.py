@@ -1,23 +1,28 @@
+import contextlib
+import logging
 import os
 import tempfile
 from dataclasses import dataclass
-from typing import Generator, Optional
+from typing import Generator, Iterable, Iterator, Optional, Union
 
 import torch
 import torchaudio as ta
 
 from chatterbox.tts import ChatterboxTTS
+from chatterbox.models.residency import lazy_conditioning
 try:
     from .processing import (
         device_and_map,
         low_compute_defaults,
         split_text_chunks,
-        ensure_mono_1xT,
         tensor_to_pcm16_bytes,
         write_streaming_wav,
         postprocess_output,
-        trim_prompt,
+        load_prompt,
+        crossfade_chunks,
     )
+    from .chunk_pool import ChunkPool
+    from .thread_tuning import ThreadBudget, default_profile_path, load_profile, save_profile, tune
 except Exception:
     # Fallback for direct execution: python chatterbox_server/tts_service.py
     import os as _os, sys as _sys
@@ -26,12 +31,18 @@ except Exception:
         device_and_map,
         low_compute_defaults,
         split_text_chunks,
-        ensure_mono_1xT,
         tensor_to_pcm16_bytes,
         write_streaming_wav,
         postprocess_output,
-        trim_prompt,
+        load_prompt,
+        crossfade_chunks,
     )
+    from chatterbox_server.chunk_pool import ChunkPool
+    from chatterbox_server.thread_tuning import (
+        ThreadBudget, default_profile_path, load_profile, save_profile, tune,
+    )
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -44,36 +55,146 @@ class TTSSettings:
     fade_ms: int = 30
     pitch_semitones: float = 0.0
     time_stretch: float = 1.0
+    # S3Gen flow: number of CFM steps (None = model default) and ODE solver ("euler", "midpoint", "heun", "adaptive")
+    n_cfm_timesteps: Optional[int] = None
+    cfm_solver: Optional[str] = None
+    # seconds of the reference the S3Gen flow conditions on (None = all of it, up to 10 s) and which part:
+    # "tail" (last N seconds) or "informative" (loudest N-second window); shorter = faster flow
+    flow_prompt_seconds: Optional[float] = None
+    flow_prompt_mode: str = "tail"
+    # vocode in windows of this many mel frames (flat vocoder memory); flow_chunk_tokens also runs the flow in
+    # windows of that many speech tokens, so streamed audio starts after the first window (`generate_stream`)
+    vocoder_chunk_frames: Optional[int] = None
+    flow_chunk_tokens: Optional[int] = None
 
 
 class TTSService:
-    def __init__(self):
+    def __init__(self, quantize: Optional[str] = None, dtype: Optional[str] = None, chunk_workers: Optional[int] = None):
         low_compute_defaults()
         self.device, self.map_location = device_and_map()
-        self.model = ChatterboxTTS.from_pretrained(device=self.device)
+        # int8 T3 and bf16 only apply to CPU; ignore the env defaults on other devices
+        if self.device == "cpu":
+            if quantize is None:
+                quantize = os.environ.get("CHATTERBOX_T3_QUANT") or None
+            if dtype is None:
+                dtype = os.environ.get("CHATTERBOX_DTYPE") or None
+        self.model = ChatterboxTTS.from_pretrained(device=self.device, quantize=quantize, dtype=dtype)
+        if os.environ.get("CHATTERBOX_T3_COMPILE", "0") == "1":
+            self.model.t3.enable_compiled_decode()
+        if onnx_dir := os.environ.get("CHATTERBOX_S3GEN_ONNX"):
+            self.model.s3gen.use_onnx_backend(onnx_dir, num_threads=torch.get_num_threads())
         if self.device == "mps":
             try:
                 self.model = self.model.to(dtype=torch.float16)
             except Exception:
                 pass
+        # long texts fan their chunks out to this many forked single-threaded workers (CPU only); forked before
+        # any inference runs in this process
+        if chunk_workers is None:
+            chunk_workers = int(os.environ.get("CHATTERBOX_CHUNK_WORKERS", "1"))
+        self.chunk_pool = None
+        if self.device == "cpu" and chunk_workers > 1:
+            self.chunk_pool = ChunkPool(self.model, chunk_workers)
+        # conditioning-only submodules (S3 tokenizer, CAMPPlus, VE, T3 text head) load on demand and are
+        # evicted after this many idle seconds, or when MemAvailable drops below CHATTERBOX_MIN_AVAILABLE_MIB
+        self.residency = None
+        if idle := os.environ.get("CHATTERBOX_CONDITIONING_IDLE_S"):
+            min_available = os.environ.get("CHATTERBOX_MIN_AVAILABLE_MIB")
+            self.residency = lazy_conditioning(
+                self.model, idle_timeout=float(idle), min_available_mib=float(min_available) if min_available else None,
+            ).start()
+        self.thread_budget = self._thread_budget() if self.device == "cpu" else None
+
+    def _thread_budget(self) -> Optional[ThreadBudget]:
+        """
+        Per-stage thread counts from the profile at CHATTERBOX_THREAD_PROFILE (`auto` = the per-host default path).
+        With CHATTERBOX_THREAD_TUNE=1 a missing profile is measured now (CHATTERBOX_THREAD_TUNE_LEVELS concurrency
+        levels, default 1) with the built-in voice and saved, except with CHATTERBOX_API_WORKERS > 1: tuning runs
+        multithreaded inference in this process, which the pre-fork server then forks, and forking after OpenMP
+        threads have started can deadlock the workers.
+        """
+        path = os.environ.get("CHATTERBOX_THREAD_PROFILE")
+        if not path:
+            return None
+        path = default_profile_path() if path == "auto" else path
+        profile = load_profile(path)
+        processes = int(os.environ.get("CHATTERBOX_API_WORKERS", "1"))
+        if profile is None and os.environ.get("CHATTERBOX_THREAD_TUNE", "0") == "1":
+            if processes > 1:
+                logger.warning(
+                    f"CHATTERBOX_THREAD_TUNE is not supported with CHATTERBOX_API_WORKERS > 1; measure {path} "
+                    "beforehand with `python -m scripts.tune_threads --out <path>`, using the defaults"
+                )
+                return None
+            if self.model.conds is None:
+                logger.warning("no built-in voice to tune thread counts with, using the defaults")
+                return None
+            levels = [int(l) for l in os.environ.get("CHATTERBOX_THREAD_TUNE_LEVELS", "1").split(",")]
+            profile = tune(self.model, levels=levels)
+            save_profile(path, profile)
+        if profile is None:
+            return None
+        budget = ThreadBudget(profile, processes=processes)
+        return budget.install(self.model)
+
+    def _request(self):
+        return self.thread_budget.request() if self.thread_budget is not None else contextlib.nullcontext()
 
     @property
     def sr(self) -> int:
         return self.model.sr
 
     def warmup(self, settings: TTSSettings, audio_prompt_path: Optional[str]):
-        trimmed_prompt = trim_prompt(audio_prompt_path, settings.prompt_trim_seconds, self.sr) if audio_prompt_path else None
+        # the prompt is decoded, cleaned and resampled in memory (and cached), and the model conditionals are
+        # prepared from it once per request; the per-chunk generate calls below reuse them
+        prompt = load_prompt(audio_prompt_path, settings.prompt_trim_seconds, self.sr) if audio_prompt_path else None
+        if prompt is not None:
+            self.model.prepare_conditionals(prompt, exaggeration=settings.exaggeration)
         try:
             with torch.inference_mode():
                 _ = self.model.generate(
                     ".",
-                    audio_prompt_path=trimmed_prompt,
                     exaggeration=settings.exaggeration,
                     cfg_weight=min(0.1, settings.cfg_weight),
                 )
         except Exception:
             pass
-        return trimmed_prompt
+        return prompt
+
+    def _chunk_wavs(self, text: str, settings: TTSSettings) -> Iterator[Union[torch.Tensor, Iterable[torch.Tensor]]]:
+        """
+        Waveforms of the sentence chunks of `text` in order, with the cfg weight ramped over the chunks. With a
+        chunk pool (CHATTERBOX_CHUNK_WORKERS) the chunks are synthesized in parallel worker processes; otherwise,
+        with `flow_chunk_tokens`, each chunk is an iterator of its audio pieces (`generate_stream`).
+        """
+        chunks = split_text_chunks(text)
+        n = max(1, len(chunks))
+        w0 = settings.cfg_weight
+        w1 = min(settings.cfg_weight * 1.2, settings.cfg_weight + 0.2)
+        step = (w1 - w0) / max(1, n - 1)
+        tasks = [
+            (chunk, dict(
+                exaggeration=settings.exaggeration,
+                cfg_weight=w0 + step * i,
+                n_cfm_timesteps=settings.n_cfm_timesteps,
+                cfm_solver=settings.cfm_solver,
+                flow_prompt_seconds=settings.flow_prompt_seconds,
+                flow_prompt_mode=settings.flow_prompt_mode,
+                vocoder_chunk_frames=settings.vocoder_chunk_frames,
+                flow_chunk_tokens=settings.flow_chunk_tokens,
+            ))
+            for i, chunk in enumerate(chunks)
+        ]
+        if self.chunk_pool is not None and len(tasks) > 1 and self.chunk_pool.usable():
+            yield from self.chunk_pool.imap(self.model.conds, tasks)
+            return
+        for chunk, kwargs in tasks:
+            if settings.flow_chunk_tokens:
+                # the flow windows already bound what reaches the vocoder
+                kwargs.pop("vocoder_chunk_frames")
+                yield self.model.generate_stream(chunk, **kwargs)
+            else:
+                yield self.model.generate(chunk, **kwargs)
 
     def synthesize_to_file(
         self,
@@ -84,51 +205,14 @@ class TTSService:
     ) -> str:
         if settings is None:
             settings = TTSSettings()
-        trimmed_prompt = self.warmup(settings, audio_prompt_path)
-        with torch.inference_mode():
+        self.warmup(settings, audio_prompt_path)
+        with self._request(), torch.inference_mode():
             if settings.streaming:
-                chunks = split_text_chunks(text)
                 wf = write_streaming_wav(output_path, self.sr)
                 fade_samples = max(0, int(self.sr * settings.fade_ms / 1000))
-                prev_tail = None
                 try:
-                    n = max(1, len(chunks))
-                    w0 = settings.cfg_weight
-                    w1 = min(settings.cfg_weight * 1.2, settings.cfg_weight + 0.2)
-                    step = (w1 - w0) / max(1, n - 1)
-                    for i, chunk in enumerate(chunks):
-                        curr_cfg = w0 + step * i
-                        wav = self.model.generate(
-                            chunk,
-                            audio_prompt_path=trimmed_prompt,
-                            exaggeration=settings.exaggeration,
-                            cfg_weight=curr_cfg,
-                        )
-                        wav = ensure_mono_1xT(wav)
-                        if fade_samples <= 0:
-                            wf.writeframes(tensor_to_pcm16_bytes(wav))
-                            continue
-                        if wav.size(1) <= fade_samples:
-                            prev_tail = wav if prev_tail is None else torch.cat([prev_tail, wav], dim=1)
-                            continue
-                        if prev_tail is None:
-                            head = wav[:, :-fade_samples]
-                            prev_tail = wav[:, -fade_samples:]
-                            wf.writeframes(tensor_to_pcm16_bytes(head))
-                        else:
-                            head = wav[:, :fade_samples]
-                            rest = wav[:, fade_samples:]
-                            fade = torch.linspace(0, 1, fade_samples, device=wav.device).view(1, -1)
-                            overlap = prev_tail * (1 - fade) + head * fade
-                            wf.writeframes(tensor_to_pcm16_bytes(overlap))
-                            if rest.size(1) > fade_samples:
-                                mid = rest[:, :-fade_samples]
-                                prev_tail = rest[:, -fade_samples:]
-                                wf.writeframes(tensor_to_pcm16_bytes(mid))
-                            else:
-                                prev_tail = rest
-                    if prev_tail is not None and prev_tail.numel() > 0:
-                        wf.writeframes(tensor_to_pcm16_bytes(prev_tail))
+                    for wav in crossfade_chunks(self._chunk_wavs(text, settings), fade_samples):
+                        wf.writeframes(tensor_to_pcm16_bytes(wav))
                 finally:
                     wf.close()
                 postprocess_output(
@@ -140,9 +224,14 @@ class TTSService:
             else:
                 wav = self.model.generate(
                     text,
-                    audio_prompt_path=trimmed_prompt,
                     exaggeration=settings.exaggeration,
                     cfg_weight=settings.cfg_weight,
+                    n_cfm_timesteps=settings.n_cfm_timesteps,
+                    cfm_solver=settings.cfm_solver,
+                    flow_prompt_seconds=settings.flow_prompt_seconds,
+                    flow_prompt_mode=settings.flow_prompt_mode,
+                    vocoder_chunk_frames=settings.vocoder_chunk_frames,
+                    flow_chunk_tokens=settings.flow_chunk_tokens,
                 )
                 ta.save(output_path, wav, self.sr)
                 postprocess_output(
@@ -179,45 +268,8 @@ class TTSService:
     ) -> Generator[bytes, None, None]:
         if settings is None:
             settings = TTSSettings()
-        trimmed_prompt = self.warmup(settings, audio_prompt_path)
-        with torch.inference_mode():
-            chunks = split_text_chunks(text)
+        self.warmup(settings, audio_prompt_path)
+        with self._request(), torch.inference_mode():
             fade_samples = max(0, int(self.sr * settings.fade_ms / 1000))
-            prev_tail = None
-            n = max(1, len(chunks))
-            w0 = settings.cfg_weight
-            w1 = min(settings.cfg_weight * 1.2, settings.cfg_weight + 0.2)
-            step = (w1 - w0) / max(1, n - 1)
-            for i, chunk in enumerate(chunks):
-                curr_cfg = w0 + step * i
-                wav = self.model.generate(
-                    chunk,
-                    audio_prompt_path=trimmed_prompt,
-                    exaggeration=settings.exaggeration,
-                    cfg_weight=curr_cfg,
-                )
-                wav = ensure_mono_1xT(wav)
-                if fade_samples <= 0:
-                    yield tensor_to_pcm16_bytes(wav)
-                    continue
-                if wav.size(1) <= fade_samples:
-                    prev_tail = wav if prev_tail is None else torch.cat([prev_tail, wav], dim=1)
-                    continue
-                if prev_tail is None:
-                    head = wav[:, :-fade_samples]
-                    prev_tail = wav[:, -fade_samples:]
-                    yield tensor_to_pcm16_bytes(head)
-                else:
-                    head = wav[:, :fade_samples]
-                    rest = wav[:, fade_samples:]
-                    fade = torch.linspace(0, 1, fade_samples, device=wav.device).view(1, -1)
-                    overlap = prev_tail * (1 - fade) + head * fade
-                    yield tensor_to_pcm16_bytes(overlap)
-                    if rest.size(1) > fade_samples:
-                        mid = rest[:, :-fade_samples]
-                        prev_tail = rest[:, -fade_samples:]
-                        yield tensor_to_pcm16_bytes(mid)
-                    else:
-                        prev_tail = rest
-            if prev_tail is not None and prev_tail.numel() > 0:
-                yield tensor_to_pcm16_bytes(prev_tail)
+            for wav in crossfade_chunks(self._chunk_wavs(text, settings), fade_samples):
+                yield tensor_to_pcm16_bytes(wav)
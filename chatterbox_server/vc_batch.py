@@ -0,0 +1,93 @@
+"""
+Batched voice conversion of many clips to one target voice.
+
+    chatterbox-vc-batch clips/ more.wav --target voice.wav --out-dir out/ [--batch-size 8] [--io-workers 4]
+
+Directories are expanded to the audio files in them. The target is embedded once; clips are decoded on a thread
+pool, converted `--batch-size` at a time with one batched tokenizer call and one padded flow + HiFT pass
+(`ChatterboxVC.generate_batch`), and written on the same pool while the next batch runs. Outputs are named after
+the input's path below the directory it was found in (`clips/a/x.flac` -> `<out-dir>/a/x.wav`) or after the file
+name for files given directly; inputs that would map to the same output are rejected up front. Prints clips/sec
+and the real-time factor.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from collections import Counter
+from typing import List, Tuple
+
+import torchaudio as ta
+
+from chatterbox.audio_frontend import PromptAudio
+from chatterbox.vc import ChatterboxVC
+
+try:
+    from .processing import device_and_map, low_compute_defaults
+except Exception:
+    import os as _os, sys as _sys
+    _sys.path.append(_os.path.dirname(_os.path.dirname(__file__)))
+    from chatterbox_server.processing import device_and_map, low_compute_defaults
+
+AUDIO_SUFFIXES = {".wav", ".flac", ".mp3", ".ogg", ".m4a", ".aiff", ".aif"}
+
+
+def collect_inputs(paths: List[str]) -> List[Tuple[Path, Path]]:
+    "(input file, output path relative to the output directory) pairs"
+    items = []
+    for p in map(Path, paths):
+        if p.is_dir():
+            files = sorted(f for f in p.rglob("*") if f.suffix.lower() in AUDIO_SUFFIXES)
+            items += [(f, f.relative_to(p).with_suffix(".wav")) for f in files]
+        else:
+            items.append((p, Path(p.name).with_suffix(".wav")))
+    return items
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Chatterbox batched voice conversion")
+    p.add_argument("inputs", nargs="+", help="Source clips or directories of clips")
+    p.add_argument("--target", required=True, help="Target voice wav")
+    p.add_argument("--out-dir", required=True, help="Directory for the converted .wav files")
+    p.add_argument("--batch-size", type=int, default=8, help="Clips per batched tokenizer/flow/HiFT pass")
+    p.add_argument("--io-workers", type=int, default=4, help="Threads decoding inputs and writing outputs")
+    p.add_argument("--group", type=int, default=64, help="Clips decoded and held in memory at a time")
+    args = p.parse_args()
+
+    items = collect_inputs(args.inputs)
+    if not items:
+        p.error("no input clips")
+    clashes = sorted(str(out) for out, n in Counter(out for _, out in items).items() if n > 1)
+    if clashes:
+        p.error(f"several inputs would be written to the same output: {', '.join(clashes[:5])}"
+                f"{' ...' if len(clashes) > 5 else ''}")
+    out_dir = Path(args.out_dir)
+    for _, out in items:
+        (out_dir / out).parent.mkdir(parents=True, exist_ok=True)
+
+    low_compute_defaults()
+    device, _ = device_and_map()
+    vc = ChatterboxVC.from_pretrained(device)
+    vc.set_target_voice(args.target)
+
+    start, audio_s, writes = time.perf_counter(), 0.0, []
+    with ThreadPoolExecutor(max_workers=args.io_workers) as io:
+        for g in range(0, len(items), args.group):
+            group = items[g:g + args.group]
+            clips = list(io.map(PromptAudio.load, [str(f) for f, _ in group]))
+            audio_s += sum(c.duration() for c in clips)
+            wavs = vc.generate_batch(clips, batch_size=args.batch_size)
+            writes += [io.submit(ta.save, str(out_dir / out), wav, vc.sr) for (_, out), wav in zip(group, wavs)]
+            done = g + len(group)
+            elapsed = time.perf_counter() - start
+            print(f"{done}/{len(items)} clips, {done / elapsed:.2f} clips/s", flush=True)
+        for w in writes:
+            w.result()
+    elapsed = time.perf_counter() - start
+
+    print(f"Converted {len(items)} clips ({audio_s:.1f} s of audio) in {elapsed:.1f} s: "
+          f"{len(items) / elapsed:.2f} clips/s, RTF {elapsed / max(audio_s, 1e-6):.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+S3Gen benchmarks and quality checks.
+
+    python -m scripts.bench_s3gen estimator --voice ref.wav [--speech speech.wav] [--modes fused bf16 int8]
+
+    python -m scripts.bench_s3gen steps --voice ref.wav [--solvers euler heun adaptive] [--steps 2 4 6 10] [--csv out.csv]
+    python -m scripts.bench_s3gen guidance --voice ref.wav [--cfg-steps 10 6 4 2 0]
+    python -m scripts.bench_s3gen prompt --voice ref.wav --speech other.wav [--seconds 6 4 2 1]
+    python -m scripts.bench_s3gen encoder --voice ref.wav
+    python -m scripts.bench_s3gen vocoder --voice ref.wav
+    python -m scripts.bench_s3gen tokenizer --voice ref.wav [--clips 16]
+    python -m scripts.bench_s3gen batch --voice ref.wav [--clips 4]
+
+`estimator` runs the token -> mel flow with the fp32 estimator and each optimized estimator mode on the same
+tokens, conditioning and noise, and reports the mel MSE against fp32 and the flow speedup.
+
+`steps` sweeps CFM solver x number of steps and reports, for each point of the quality-vs-steps curve, the
+estimator calls, flow time and mel MSE against a many-step reference solve (same noise).
+
+`guidance` sweeps the CFG guidance interval (CFG on the first k of n steps) and reports the flow speedup and mel
+MSE against guidance on every step.
+
+`prompt` sweeps the flow prompt context (`S3Gen.crop_ref_dict`, last N seconds or the most informative window) and
+reports flow latency, mel MSE against the full 10 s context and the speaker similarity of the vocoded output to
+the reference. The noise covers prompt + generated frames, so the MSE includes a sampling floor, printed first
+(full context, another seed). Use `--speech` with a different utterance than the reference.
+
+`encoder` times the flow's conformer encoder over prompt + speech tokens with the SDPA attention path and the
+explicit masked_fill/softmax path, and reports the max abs difference of the encoder outputs.
+
+`vocoder` times HiFT on the reference mels as loaded (weight norm, unfused Snake) and after
+`HiFTGenerator.prepare_for_inference`, and reports the real-time factor and max abs waveform difference. It
+then runs chunked vocoding (`S3Gen.hift_inference_chunked`) and compares length and audio with the one-shot output.
+
+`tokenizer` cuts the reference into clips of different lengths and times the S3 tokenizer on one clip per call vs
+all clips in one batched call, and checks that both give the same tokens.
+
+`batch` resynthesizes token prefixes of different lengths with one padded `S3Gen.inference_batch` call and with
+one `inference` call each, and compares every row: sample count, log-mel MSE of the two waveforms (flow and HiFT
+noise differ between the runs, so not the raw samples) and the RMS of the last 100 ms, which shows padding
+leaking into the end of short rows.
+"""
+import argparse
+import copy
+import csv
+import time
+
+import librosa
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+from chatterbox.tts import REPO_ID
+from chatterbox.models.s3gen import S3GEN_SR, S3Gen
+from chatterbox.models.s3gen.s3gen import PROMPT_CONTEXT_MODES, get_resampler
+from chatterbox.models.s3gen.decoder import ESTIMATOR_MODES
+from chatterbox.models.s3gen.flow_matching import CFM_SOLVERS
+from chatterbox.models.s3tokenizer import S3_SR, S3_TOKEN_RATE
+
+
+def load_s3gen(device="cpu", **kwargs):
+    s3gen = S3Gen(**kwargs)
+    s3gen.load_state_dict(load_file(hf_hub_download(repo_id=REPO_ID, filename="s3gen.safetensors")), strict=False)
+    return s3gen.to(device).eval()
+
+
+def prepare_inputs(s3gen, args):
+    "Reference conditioning and speech tokens to resynthesize (the reference itself unless `--speech` is given)"
+    ref_wav, _ = librosa.load(args.voice, sr=S3GEN_SR)
+    ref_dict = s3gen.embed_ref(ref_wav[:10 * S3GEN_SR], S3GEN_SR)
+    speech_wav, _ = librosa.load(args.speech or args.voice, sr=S3_SR)
+    speech_tokens, _ = s3gen.tokenizer.forward([speech_wav[:args.max_seconds * S3_SR]])
+    return ref_dict, speech_tokens.to(s3gen.device)
+
+
+def timed_flow(s3gen, speech_tokens, ref_dict, args, **kwargs):
+    "Returns (mels of the first run, mean seconds per run); every run uses the same noise"
+    mels, secs = None, []
+    for _ in range(args.repeats):
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        out = s3gen.flow_inference(speech_tokens, ref_dict=dict(ref_dict), **kwargs)
+        secs.append(time.perf_counter() - start)
+        mels = out.float() if mels is None else mels
+    return mels, sum(secs[1:] or secs) / len(secs[1:] or secs)
+
+
+def mel_mse(a, b):
+    T = min(a.size(-1), b.size(-1))
+    return torch.mean((a[..., :T] - b[..., :T]) ** 2).item()
+
+
+def bench_estimator(args):
+    base = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(base, args)
+    ref_mels, ref_secs = timed_flow(base, speech_tokens, ref_dict, args)
+    print(f"fp32: {ref_secs * 1000:.0f} ms/utt ({speech_tokens.size(1)} tokens)")
+
+    ok = True
+    for mode in args.modes:
+        s3gen = load_s3gen(args.device, estimator_mode=mode)
+        mels, secs = timed_flow(s3gen, speech_tokens, ref_dict, args)
+        mse = mel_mse(mels, ref_mels)
+        ok &= mse <= args.max_mse
+        print(f"{mode}: {secs * 1000:.0f} ms/utt, speedup x{ref_secs / secs:.2f}, mel MSE vs fp32 {mse:.5f}")
+        del s3gen
+
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+def bench_steps(args):
+    s3gen = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(s3gen, args)
+    nfe = [0]
+    s3gen.flow.decoder.estimator.register_forward_pre_hook(lambda *_: nfe.__setitem__(0, nfe[0] + 1))
+
+    ref_mels, _ = timed_flow(s3gen, speech_tokens, ref_dict, args, n_cfm_timesteps=args.ref_steps, cfm_solver=args.ref_solver)
+    print(f"reference: {args.ref_solver} x {args.ref_steps} steps ({speech_tokens.size(1)} tokens)")
+
+    # estimator calls per step of the fixed-step solvers; adaptive counts every stage, accepted or rejected
+    calls_per_step = {"euler": 1, "midpoint": 2, "heun": 2}
+    rows, ok = [], True
+    for solver in args.solvers:
+        for steps in args.steps:
+            nfe[0] = 0
+            mels, secs = timed_flow(s3gen, speech_tokens, ref_dict, args, n_cfm_timesteps=steps, cfm_solver=solver)
+            rows.append(dict(solver=solver, steps=steps, nfe=nfe[0] // args.repeats, ms=round(secs * 1000, 1),
+                             mse=round(mel_mse(mels, ref_mels), 6)))
+            print("{solver:>9} steps={steps:<3} nfe={nfe:<3} {ms:8.1f} ms/utt  mel MSE {mse:.6f}".format(**rows[-1]))
+            if solver in calls_per_step and rows[-1]["nfe"] != calls_per_step[solver] * steps:
+                print(f"  unexpected nfe, {solver} should call the estimator {calls_per_step[solver]}x per step")
+                ok = False
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"wrote {args.csv}")
+    return 0 if ok else 1
+
+
+def bench_guidance(args):
+    s3gen = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(s3gen, args)
+    kwargs = dict(n_cfm_timesteps=args.n_steps, cfm_solver=args.solver)
+    ref_mels, ref_secs = timed_flow(s3gen, speech_tokens, ref_dict, args, **kwargs)
+    print(f"CFG on all {args.n_steps} {args.solver} steps: {ref_secs * 1000:.0f} ms/utt ({speech_tokens.size(1)} tokens)")
+
+    for k in args.cfg_steps:
+        mels, secs = timed_flow(s3gen, speech_tokens, ref_dict, args, cfm_cfg_steps=k, **kwargs)
+        print(f"CFG on first {k:>2}/{args.n_steps}: {secs * 1000:.0f} ms/utt, speedup x{ref_secs / secs:.2f}, "
+              f"mel MSE {mel_mse(mels, ref_mels):.5f}")
+    return 0
+
+
+def speaker_similarity(s3gen, mels, ref_dict):
+    "Cosine similarity between the CAMPPlus x-vector of the vocoded mels and the reference one"
+    wav, _ = s3gen.hift_inference(mels.to(next(s3gen.mel2wav.parameters()).dtype))
+    wav_16 = get_resampler(S3GEN_SR, S3_SR, s3gen.device)(wav.float())
+    emb = s3gen.speaker_encoder.inference(wav_16)
+    return torch.nn.functional.cosine_similarity(emb, ref_dict["embedding"].to(emb), dim=-1).mean().item()
+
+
+def bench_prompt(args):
+    s3gen = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(s3gen, args)
+    full_mels, full_secs = timed_flow(s3gen, speech_tokens, ref_dict, args)
+    prompt_secs = ref_dict["prompt_token"].size(1) / S3_TOKEN_RATE
+    print(f"full context ({prompt_secs:.1f} s): {full_secs * 1000:.0f} ms/utt, "
+          f"spk cos {speaker_similarity(s3gen, full_mels, ref_dict):.3f}")
+    args.seed += 1
+    floor_mels, _ = timed_flow(s3gen, speech_tokens, ref_dict, args)
+    args.seed -= 1
+    print(f"sampling floor (full context, other seed): mel MSE {mel_mse(floor_mels, full_mels):.5f}")
+
+    for mode in args.modes:
+        for seconds in args.seconds:
+            cropped = s3gen.crop_ref_dict(ref_dict, seconds, mode)
+            mels, secs = timed_flow(s3gen, speech_tokens, cropped, args)
+            print(f"{mode:>11} {seconds:4.1f} s: {secs * 1000:.0f} ms/utt, speedup x{full_secs / secs:.2f}, "
+                  f"mel MSE {mel_mse(mels, full_mels):.5f}, spk cos {speaker_similarity(s3gen, mels, ref_dict):.3f}")
+    return 0
+
+
+def bench_encoder(args):
+    from chatterbox.models.s3gen.transformer.attention import MultiHeadedAttention
+
+    s3gen = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(s3gen, args)
+    flow = s3gen.flow
+    tokens = torch.cat([ref_dict["prompt_token"].to(speech_tokens), speech_tokens], dim=1)
+    token_len = torch.tensor([tokens.size(1)], device=tokens.device)
+    xs = flow.input_embedding(tokens.long())
+
+    outs = {}
+    for use_sdpa in (False, True):
+        MultiHeadedAttention.use_sdpa = use_sdpa
+        secs = []
+        with torch.inference_mode():
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                h, _ = flow.encoder(xs, token_len)
+                secs.append(time.perf_counter() - start)
+        outs[use_sdpa] = h.float()
+        name = "sdpa" if use_sdpa else "explicit"
+        print(f"{name:>8}: {sum(secs[1:] or secs) / len(secs[1:] or secs) * 1000:.1f} ms ({tokens.size(1)} tokens)")
+    MultiHeadedAttention.use_sdpa = True
+    err = (outs[True] - outs[False]).abs().max().item()
+    print(f"max |sdpa - explicit| {err:.2e}")
+    return 0 if err < args.tol else 1
+
+
+def bench_vocoder(args):
+    s3gen = load_s3gen(args.device)
+    ref_wav, _ = librosa.load(args.voice, sr=S3GEN_SR)
+    ref_wav = ref_wav[:args.max_seconds * S3GEN_SR]
+    mels = s3gen.embed_ref(ref_wav, S3GEN_SR)["prompt_feat"].transpose(1, 2).contiguous()
+    audio_secs = len(ref_wav) / S3GEN_SR
+
+    hifts = {"as loaded": s3gen.mel2wav, "prepared": copy.deepcopy(s3gen.mel2wav).prepare_for_inference()}
+    wavs, base = {}, None
+    for name, hift in hifts.items():
+        secs = []
+        for _ in range(args.repeats):
+            torch.manual_seed(args.seed)
+            start = time.perf_counter()
+            wav, _ = hift.inference(speech_feat=mels)
+            secs.append(time.perf_counter() - start)
+        wavs[name] = wav.float()
+        secs = sum(secs[1:] or secs) / len(secs[1:] or secs)
+        base = base or secs
+        print(f"{name:>9}: {secs * 1000:.0f} ms for {audio_secs:.1f} s of audio, RTF {secs / audio_secs:.3f}, "
+              f"speedup x{base / secs:.2f}")
+    err = (wavs["as loaded"] - wavs["prepared"]).abs().max().item()
+    print(f"max |prepared - as loaded| {err:.2e}")
+
+    # chunked vocoding with the prepared HiFT: same audio length, bounded peak memory
+    s3gen.mel2wav = hifts["prepared"]
+    for chunk_frames in args.chunk_frames:
+        if s3gen.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        wav = torch.cat(list(s3gen.hift_inference_chunked(mels, chunk_frames, args.overlap_frames)), dim=1).float()
+        secs = time.perf_counter() - start
+        n = min(wav.size(1), wavs["prepared"].size(1))
+        diff = (wav[:, :n] - wavs["prepared"][:, :n]).abs().mean().item()
+        mem = f", peak {torch.cuda.max_memory_allocated() / 2**20:.0f} MiB" if s3gen.device.type == "cuda" else ""
+        print(f"chunked {chunk_frames} frames: {secs * 1000:.0f} ms, {wav.size(1)} vs {wavs['prepared'].size(1)} "
+              f"samples, mean |chunked - one shot| {diff:.2e}{mem}")
+    return 0
+
+
+def bench_tokenizer(args):
+    s3gen = load_s3gen(args.device)
+    wav, _ = librosa.load(args.voice, sr=S3_SR)
+    wav = torch.from_numpy(wav[:args.max_seconds * S3_SR])
+    # clip lengths spread between 1 s and the full reference so the batch is actually ragged
+    lens = torch.linspace(S3_SR, wav.numel(), args.clips).long().tolist()
+    clips = [wav[:n] for n in lens]
+
+    def timed(fn):
+        secs = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            out = fn()
+            secs.append(time.perf_counter() - start)
+        return out, sum(secs[1:] or secs) / len(secs[1:] or secs)
+
+    singles, loop_secs = timed(lambda: [s3gen.tokenizer.forward([c]) for c in clips])
+    (tokens, token_lens), batch_secs = timed(lambda: s3gen.tokenizer.forward(clips))
+    same = True
+    for i, (tok, tok_len) in enumerate(singles):
+        n = int(tok_len[0])
+        same &= n == int(token_lens[i]) and torch.equal(tok[0, :n], tokens[i, :n])
+    print(f"{args.clips} clips ({sum(lens) / S3_SR:.1f} s): per clip {loop_secs * 1000:.0f} ms, "
+          f"batched {batch_secs * 1000:.0f} ms, speedup x{loop_secs / batch_secs:.2f}, same tokens: {same}")
+    return 0 if same else 1
+
+
+def bench_batch(args):
+    s3gen = load_s3gen(args.device)
+    ref_dict, speech_tokens = prepare_inputs(s3gen, args)
+    T = speech_tokens.size(1)
+    lens = torch.linspace(min(T, S3_TOKEN_RATE), T, args.clips).long().tolist()
+    clips = [speech_tokens[0, :n] for n in lens]
+
+    torch.manual_seed(args.seed)
+    start = time.perf_counter()
+    batched = s3gen.inference_batch(clips, ref_dict)
+    batch_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    singles = [s3gen.inference(c, ref_dict=ref_dict)[0] for c in clips]
+    loop_secs = time.perf_counter() - start
+    print(f"{args.clips} rows: per row {loop_secs * 1000:.0f} ms, batched {batch_secs * 1000:.0f} ms, "
+          f"speedup x{loop_secs / batch_secs:.2f}")
+
+    tail = S3GEN_SR // 10
+    ok = True
+    for n, b, s in zip(lens, batched, singles):
+        b, s = b.float(), s.float()
+        mse = mel_mse(s3gen.mel_extractor(b), s3gen.mel_extractor(s))
+        tail_b, tail_s = (w[:, -tail:].square().mean().sqrt().item() for w in (b, s))
+        ok &= b.size(1) == s.size(1) and mse <= args.max_mse
+        print(f"{n:>5} tokens: {b.size(1)} vs {s.size(1)} samples, log-mel MSE {mse:.4f}, "
+              f"tail RMS batched {tail_b:.4f} / single {tail_s:.4f}")
+    return 0 if ok else 1
+
+
+def main():
+    p = argparse.ArgumentParser(description="S3Gen benchmarks")
+    p.add_argument("--voice", required=True, help="Reference voice wav")
+    p.add_argument("--speech", help="Wav whose speech tokens are resynthesized (default: the reference)")
+    p.add_argument("--max-seconds", type=int, default=10)
+    p.add_argument("--device", default="cpu")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    e = sub.add_parser("estimator", help="Compare optimized CFM estimator modes against fp32")
+    e.add_argument("--modes", nargs="+", choices=ESTIMATOR_MODES[1:], default=list(ESTIMATOR_MODES[1:]))
+    e.add_argument("--max-mse", type=float, default=0.05)
+    e.set_defaults(func=bench_estimator)
+
+    st = sub.add_parser("steps", help="Quality-vs-steps curves for the CFM ODE solvers")
+    st.add_argument("--solvers", nargs="+", choices=CFM_SOLVERS, default=list(CFM_SOLVERS))
+    st.add_argument("--steps", nargs="+", type=int, default=[2, 3, 4, 6, 8, 10])
+    st.add_argument("--ref-solver", choices=CFM_SOLVERS, default="heun")
+    st.add_argument("--ref-steps", type=int, default=32)
+    st.add_argument("--csv", help="Write the curve points to this CSV file")
+    st.set_defaults(func=bench_steps)
+
+    g = sub.add_parser("guidance", help="Speedup vs mel divergence of the CFG guidance interval")
+    g.add_argument("--cfg-steps", nargs="+", type=int, default=[8, 6, 4, 3, 2, 1, 0])
+    g.add_argument("--n-steps", type=int, default=10)
+    g.add_argument("--solver", choices=CFM_SOLVERS, default="euler")
+    g.set_defaults(func=bench_guidance)
+
+    pc = sub.add_parser("prompt", help="Latency vs quality of a bounded flow prompt context")
+    pc.add_argument("--seconds", nargs="+", type=float, default=[6.0, 4.0, 3.0, 2.0, 1.0])
+    pc.add_argument("--modes", nargs="+", choices=PROMPT_CONTEXT_MODES, default=list(PROMPT_CONTEXT_MODES))
+    pc.set_defaults(func=bench_prompt)
+
+    en = sub.add_parser("encoder", help="SDPA vs explicit attention in the flow encoder")
+    en.add_argument("--tol", type=float, default=1e-3)
+    en.set_defaults(func=bench_encoder)
+
+    v = sub.add_parser("vocoder", help="HiFT micro-benchmark before/after prepare_for_inference")
+    v.add_argument("--chunk-frames", nargs="*", type=int, default=[100, 200], help="Also time chunked vocoding")
+    v.add_argument("--overlap-frames", type=int, default=20)
+    v.set_defaults(func=bench_vocoder)
+
+    tk = sub.add_parser("tokenizer", help="Batched vs per-clip S3 tokenizer")
+    tk.add_argument("--clips", type=int, default=16)
+    tk.set_defaults(func=bench_tokenizer)
+
+    b = sub.add_parser("batch", help="Batched vs per-row S3Gen inference")
+    b.add_argument("--clips", type=int, default=4)
+    b.add_argument("--max-mse", type=float, default=0.5, help="Largest per-row log-mel MSE that passes")
+    b.set_defaults(func=bench_batch)
+
+    args = p.parse_args()
+    raise SystemExit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
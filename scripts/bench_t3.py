@@ -0,0 +1,199 @@
+"""
+T3 benchmarks and validation.
+
+    python -m scripts.bench_t3 quant --voice ref.wav [--mode int8]
+    python -m scripts.bench_t3 compile --voice ref.wav
+
+`quant` compares a quantized T3 against the fp32 model on the same conditionals:
+    - teacher-forced argmax agreement of the speech head on fp32-generated tokens
+    - decode speed (speech tokens / sec)
+    - voice similarity (VoiceEncoder cosine) of the synthesized audio to the reference and to the fp32 output
+
+`compile` measures per-token decode latency of the eager and the compiled decode step, and the cold start
+(decoder setup + first generation, which includes compilation or loading cached artifacts). Run it twice to see
+the warm-cache cold start.
+"""
+import argparse
+import copy
+import time
+
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from chatterbox.tts import ChatterboxTTS, punc_norm
+from chatterbox.models.s3tokenizer import S3_SR
+from chatterbox.models.quantization import QUANT_MODES, weight_bytes
+
+
+DEFAULT_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Quantization should not change who is speaking, only how fast the model runs.",
+    "On a quiet evening, the old lighthouse keeper counted the ships returning to harbor.",
+]
+
+
+def _text_tokens(model, text, cfg_weight):
+    text_tokens = model.tokenizer.text_to_tokens(punc_norm(text)).to(model.device)
+    if cfg_weight > 0.0:
+        text_tokens = torch.cat([text_tokens, text_tokens], dim=0)
+    text_tokens = F.pad(text_tokens, (1, 0), value=model.t3.hp.start_text_token)
+    text_tokens = F.pad(text_tokens, (0, 1), value=model.t3.hp.stop_text_token)
+    return text_tokens
+
+
+@torch.inference_mode()
+def _speech_argmax(t3, t3_cond, text_tokens, speech_tokens):
+    "Teacher-forced speech-head argmax for the conditional row"
+    embeds, len_cond = t3.prepare_input_embeds(
+        t3_cond=t3_cond, text_tokens=text_tokens[:1], speech_tokens=speech_tokens[None],
+    )
+    hidden = t3.tfmr(inputs_embeds=embeds, use_cache=False, return_dict=True).last_hidden_state
+    speech_start = len_cond + text_tokens.size(1)
+    logits = t3.speech_head(hidden[:, speech_start:])
+    return logits.argmax(dim=-1)[0]
+
+
+def _decode(model, text, args):
+    text_tokens = _text_tokens(model, text, args.cfg_weight)
+    start = time.perf_counter()
+    with torch.inference_mode():
+        speech_tokens = model.t3.inference(
+            t3_cond=model.conds.t3,
+            text_tokens=text_tokens,
+            max_new_tokens=1000,
+            temperature=args.temperature,
+            cfg_weight=args.cfg_weight,
+        )[0]
+    return speech_tokens, time.perf_counter() - start
+
+
+def _voice_embed(model, wav):
+    wav = wav.squeeze(0).cpu().numpy()
+    wav_16k = librosa.resample(wav, orig_sr=model.sr, target_sr=S3_SR)
+    return model.ve.embeds_from_wavs([wav_16k], sample_rate=S3_SR, as_spk=True)
+
+
+def _cosine(a, b):
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-8))
+
+
+def bench_quant(args):
+    torch.manual_seed(args.seed)
+    model = ChatterboxTTS.from_pretrained(device="cpu")
+    model.prepare_conditionals(args.voice, exaggeration=args.exaggeration)
+    ref_wav, _ = librosa.load(args.voice, sr=S3_SR)
+    ref_embed = model.ve.embeds_from_wavs([ref_wav], sample_rate=S3_SR, as_spk=True)
+
+    t3_fp32 = model.t3
+    t3_q = copy.deepcopy(t3_fp32).quantize(args.mode)
+    print(f"T3 weights: fp32 {weight_bytes(t3_fp32) / 2**20:.1f} MiB, {args.mode} {weight_bytes(t3_q) / 2**20:.1f} MiB")
+
+    texts = args.text or DEFAULT_TEXTS
+    rows = []
+    for text in texts:
+        row = {}
+        for name, t3 in (("fp32", t3_fp32), (args.mode, t3_q)):
+            model.t3 = t3
+            torch.manual_seed(args.seed)
+            tokens, secs = _decode(model, text, args)
+            row[name] = dict(tokens=tokens, tps=len(tokens) / secs)
+            torch.manual_seed(args.seed)
+            wav = model.generate(
+                text, exaggeration=args.exaggeration, cfg_weight=args.cfg_weight, temperature=args.temperature,
+            )
+            row[name]["embed"] = _voice_embed(model, wav)
+
+        ref_tokens = row["fp32"]["tokens"]
+        text_tokens = _text_tokens(model, text, args.cfg_weight)
+        pred_fp32 = _speech_argmax(t3_fp32, model.conds.t3, text_tokens, ref_tokens)
+        pred_q = _speech_argmax(t3_q, model.conds.t3, text_tokens, ref_tokens)
+        row["agreement"] = (pred_fp32 == pred_q).float().mean().item()
+        row["sim_ref_fp32"] = _cosine(row["fp32"]["embed"], ref_embed)
+        row["sim_ref_q"] = _cosine(row[args.mode]["embed"], ref_embed)
+        row["sim_fp32_q"] = _cosine(row["fp32"]["embed"], row[args.mode]["embed"])
+        rows.append(row)
+        print(
+            f"[{len(rows)}/{len(texts)}] agree={row['agreement']:.3f} "
+            f"tok/s fp32={row['fp32']['tps']:.1f} {args.mode}={row[args.mode]['tps']:.1f} "
+            f"sim(ref) fp32={row['sim_ref_fp32']:.3f} {args.mode}={row['sim_ref_q']:.3f} "
+            f"sim(fp32,{args.mode})={row['sim_fp32_q']:.3f}"
+        )
+    model.t3 = t3_fp32
+
+    mean = lambda k: float(np.mean([r[k] for r in rows]))
+    speedup = np.mean([r[args.mode]["tps"] / r["fp32"]["tps"] for r in rows])
+    print(
+        f"\nmean token agreement {mean('agreement'):.3f}, decode speedup x{speedup:.2f}, "
+        f"voice similarity to ref fp32={mean('sim_ref_fp32'):.3f} {args.mode}={mean('sim_ref_q'):.3f}, "
+        f"fp32 vs {args.mode}={mean('sim_fp32_q'):.3f}"
+    )
+    ok = mean("agreement") >= args.min_agreement and mean("sim_ref_fp32") - mean("sim_ref_q") <= args.max_sim_drop
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+def bench_compile(args):
+    torch.manual_seed(args.seed)
+    model = ChatterboxTTS.from_pretrained(device=args.device, dtype=args.dtype)
+    model.prepare_conditionals(args.voice, exaggeration=args.exaggeration)
+    texts = args.text or DEFAULT_TEXTS
+
+    def per_token_ms():
+        total_tokens, total_secs = 0, 0.0
+        for text in texts:
+            torch.manual_seed(args.seed)
+            tokens, secs = _decode(model, text, args)
+            total_tokens += tokens.numel()
+            total_secs += secs
+        return 1000 * total_secs / max(1, total_tokens)
+
+    eager_ms = per_token_ms()
+    print(f"eager: {eager_ms:.1f} ms/token")
+
+    start = time.perf_counter()
+    model.t3.enable_compiled_decode(cache_dir=args.cache_dir)
+    _decode(model, texts[0], args)
+    cold_secs = time.perf_counter() - start
+    print(f"compiled cold start: {cold_secs:.1f} s (artifacts in {model.t3.decoder.artifact_dir})")
+
+    compiled_ms = per_token_ms()
+    print(f"compiled: {compiled_ms:.1f} ms/token, speedup x{eager_ms / compiled_ms:.2f}")
+    return 0
+
+
+def main():
+    p = argparse.ArgumentParser(description="T3 benchmarks")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    q = sub.add_parser("quant", help="Validate a quantized T3 against fp32")
+    q.add_argument("--voice", required=True, help="Reference voice wav")
+    q.add_argument("--mode", choices=QUANT_MODES, default="int8")
+    q.add_argument("--text", action="append", help="Text to synthesize (repeatable)")
+    q.add_argument("--exaggeration", type=float, default=0.5)
+    q.add_argument("--cfg", dest="cfg_weight", type=float, default=0.5)
+    q.add_argument("--temperature", type=float, default=0.8)
+    q.add_argument("--seed", type=int, default=0)
+    q.add_argument("--min-agreement", type=float, default=0.9)
+    q.add_argument("--max-sim-drop", type=float, default=0.02)
+    q.set_defaults(func=bench_quant)
+
+    c = sub.add_parser("compile", help="Per-token latency and cold start of the compiled decode step")
+    c.add_argument("--voice", required=True, help="Reference voice wav")
+    c.add_argument("--text", action="append", help="Text to synthesize (repeatable)")
+    c.add_argument("--device", default="cpu")
+    c.add_argument("--dtype", choices=["fp32", "bf16"], default="fp32")
+    c.add_argument("--cache-dir", help="Compile artifact cache (default: CHATTERBOX_COMPILE_CACHE or ~/.cache)")
+    c.add_argument("--exaggeration", type=float, default=0.5)
+    c.add_argument("--cfg", dest="cfg_weight", type=float, default=0.5)
+    c.add_argument("--temperature", type=float, default=0.8)
+    c.add_argument("--seed", type=int, default=0)
+    c.set_defaults(func=bench_compile)
+
+    args = p.parse_args()
+    raise SystemExit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Export the S3Gen encoder, CFM estimator and HiFT decoder to ONNX and check them against torch.
+
+    python -m scripts.export_onnx --out onnx/s3gen [--turbo]
+
+Then serve with `CHATTERBOX_S3GEN_ONNX=onnx/s3gen chatterbox-api`, or call `s3gen.use_onnx_backend("onnx/s3gen")`.
+"""
+import argparse
+import copy
+
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.models.s3gen.onnx_backend import export_onnx
+
+
+def main():
+    p = argparse.ArgumentParser(description="Export S3Gen to ONNX")
+    p.add_argument("--out", required=True, help="Output directory")
+    p.add_argument("--turbo", action="store_true", help="Export the meanflow (turbo) S3Gen")
+    p.add_argument("--opset", type=int, default=17)
+    p.add_argument("--threads", type=int, default=None, help="onnxruntime intra-op threads for the check")
+    args = p.parse_args()
+
+    if args.turbo:
+        repo, fname = "ResembleAI/chatterbox-turbo", "s3gen_meanflow.safetensors"
+    else:
+        repo, fname = "ResembleAI/chatterbox", "s3gen.safetensors"
+    s3gen = S3Gen(meanflow=args.turbo)
+    s3gen.load_state_dict(load_file(hf_hub_download(repo_id=repo, filename=fname)), strict=False)
+    s3gen.eval()
+
+    for path in export_onnx(s3gen, args.out, opset=args.opset):
+        print(f"wrote {path}")
+
+    # same tokens, conditioning and noise through torch and onnxruntime
+    ort_s3gen = copy.deepcopy(s3gen).use_onnx_backend(args.out, num_threads=args.threads)
+    tokens = torch.randint(0, 6561, (1, 80))
+    ref_dict = dict(
+        prompt_token=torch.randint(0, 6561, (1, 50)),
+        prompt_token_len=torch.tensor([50]),
+        prompt_feat=torch.randn(1, 100, 80),
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192),
+    )
+    outs = []
+    for model in (s3gen, ort_s3gen):
+        torch.manual_seed(0)
+        wav, _ = model.inference(tokens, ref_dict=dict(ref_dict))
+        outs.append(wav)
+    n = min(o.size(-1) for o in outs)
+    err = (outs[0][..., :n] - outs[1][..., :n]).abs().max().item()
+    print(f"max |torch - onnxruntime| on the waveform: {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
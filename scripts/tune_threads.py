@@ -0,0 +1,49 @@
+"""
+Measure per-stage thread counts (T3, S3Gen flow, HiFT) on this host and save them as a thread profile.
+
+    python -m scripts.tune_threads --voice ref.wav [--levels 1 2 4] [--out profile.json]
+
+For each concurrency level, runs that many `generate` calls at once with every candidate thread count and picks,
+per stage, the count with the lowest time per output unit. The server applies the profile with
+`CHATTERBOX_THREAD_PROFILE=<out>` (default path: `auto`).
+"""
+import argparse
+import logging
+
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+from chatterbox_server.processing import low_compute_defaults
+from chatterbox_server.thread_tuning import STAGES, default_profile_path, save_profile, tune
+
+
+def main():
+    p = argparse.ArgumentParser(description="Per-stage thread tuner")
+    p.add_argument("--voice", help="Reference voice wav (default: the built-in voice)")
+    p.add_argument("--levels", type=int, nargs="+", default=[1], help="Concurrent requests to tune for")
+    p.add_argument("--max-threads", type=int, help="Cores to budget (default: all)")
+    p.add_argument("--repeats", type=int, default=2)
+    p.add_argument("--quant", help="T3 quantization mode, as served (CHATTERBOX_T3_QUANT)")
+    p.add_argument("--dtype", choices=["fp32", "bf16"], help="As served (CHATTERBOX_DTYPE)")
+    p.add_argument("--out", help="Profile path (default: the per-host path used by CHATTERBOX_THREAD_PROFILE=auto)")
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    low_compute_defaults()
+    torch.manual_seed(args.seed)
+    model = ChatterboxTTS.from_pretrained(device="cpu", quantize=args.quant, dtype=args.dtype)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    profile = tune(model, levels=args.levels, max_threads=args.max_threads, repeats=args.repeats)
+
+    print(f"{'concurrency':>11} " + " ".join(f"{s:>6}" for s in STAGES))
+    for level, counts in profile.items():
+        print(f"{level:>11} " + " ".join(f"{counts.get(s, '-'):>6}" for s in STAGES))
+    out = args.out or default_profile_path()
+    save_profile(out, profile)
+    print(f"saved {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,8 @@ setup(
     entry_points={
         "console_scripts": [
             "chatterbox-api=chatterbox_server.api:main",
+            "chatterbox-batch=chatterbox_server.batch:main",
+            "chatterbox-vc-batch=chatterbox_server.vc_batch:main",
             "chatterbox-gui=chatterbox_gui.gui:main",
         ]
     },
@@ -0,0 +1,122 @@
+"""
+Audio ingest shared by the TTS / VC front-ends: decode a prompt once, resample once per rate.
+
+`PromptAudio` holds the decoded mono waveform and lazily caches it at every rate a consumer asks for
+(24 kHz for the S3Gen mel prompt, 16 kHz for the S3 tokenizer, CAMPPlus and the voice encoder), so a
+prompt is decoded and resampled once no matter how many models read it.
+"""
+import io
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Union
+
+import numpy as np
+import torch
+import torchaudio as ta
+
+
+@lru_cache(100)
+def get_resampler(src_sr, dst_sr, device):
+    "Cached torchaudio resampler; building the sinc kernel is most of the cost of a one-off resample"
+    return ta.transforms.Resample(src_sr, dst_sr).to(device)
+
+
+def decode_audio(src) -> Tuple[torch.Tensor, int]:
+    """
+    Decode a path, raw bytes or a binary file object into a (1, T) float32 mono tensor and its sample rate.
+
+    libsndfile (soundfile) is tried first; formats it can't read go through torchaudio's codec backends. There is
+    no audioread fallback, which is what makes `librosa.load` slow on anything but wav/flac.
+    """
+    if isinstance(src, (bytes, bytearray)):
+        src = io.BytesIO(src)
+    try:
+        import soundfile as sf
+        data, sr = sf.read(src, dtype="float32", always_2d=True)  # (T, C)
+        wav = torch.from_numpy(np.ascontiguousarray(data.T))
+    except Exception:
+        if hasattr(src, "seek"):
+            src.seek(0)
+        wav, sr = ta.load(src)
+    if wav.size(0) > 1:
+        wav = wav.mean(dim=0, keepdim=True)
+    return wav.float(), int(sr)
+
+
+class PromptAudio:
+    """
+    A decoded mono prompt with cached resampled versions.
+
+    Build it with `PromptAudio.load(path_or_bytes)` (decodes once) or directly from a waveform. `at(sr)` returns a
+    (1, T) float32 CPU tensor at that rate, resampling on first use only; `numpy(sr)` is the same as a 1-D array.
+    """
+
+    def __init__(self, wav: Union[torch.Tensor, np.ndarray], sr: int):
+        if isinstance(wav, np.ndarray):
+            wav = torch.from_numpy(wav)
+        wav = torch.atleast_2d(wav.detach().float().cpu())
+        if wav.size(0) > 1:
+            wav = wav.mean(dim=0, keepdim=True)
+        self.sr = int(sr)
+        self._by_sr: Dict[int, torch.Tensor] = {self.sr: wav}
+
+    @classmethod
+    def load(cls, src) -> "PromptAudio":
+        "`src` is a path, bytes, a binary file object, or already a `PromptAudio` (returned as is)"
+        if isinstance(src, PromptAudio):
+            return src
+        if isinstance(src, Path):
+            src = str(src)
+        return cls(*decode_audio(src))
+
+    def at(self, sr: int) -> torch.Tensor:
+        if sr not in self._by_sr:
+            self._by_sr[sr] = get_resampler(self.sr, sr, "cpu")(self._by_sr[self.sr])
+        return self._by_sr[sr]
+
+    def numpy(self, sr: int) -> np.ndarray:
+        return self.at(sr)[0].numpy()
+
+    def duration(self) -> float:
+        return self._by_sr[self.sr].size(1) / self.sr
+
+
+def iter_audio_windows(
+    src, sr: int, block_seconds: float, context_seconds: float,
+) -> Iterator[Tuple[torch.Tensor, int, int]]:
+    """
+    Read a long recording in consecutive blocks of `block_seconds`, each with up to `context_seconds` of the
+    neighbouring audio on both sides, resampled to `sr`. Yields `(window, left, right)`: a (1, T) float32 mono
+    tensor and the number of context samples at its start and end, which belong to the neighbouring blocks.
+
+    Seekable files libsndfile can read are read window by window, so memory does not grow with the recording.
+    Other sources (compressed formats, bytes, a `PromptAudio`) are decoded in full first.
+    """
+    try:
+        import soundfile as sf
+        f = sf.SoundFile(str(src)) if isinstance(src, (str, Path)) else None
+    except Exception:
+        f = None
+    if f is None:
+        wav = PromptAudio.load(src).at(sr)
+        total, src_sr = wav.size(1), sr
+    else:
+        total, src_sr = f.frames, f.samplerate
+    block = max(1, round(block_seconds * src_sr))
+    context = round(context_seconds * src_sr)
+    try:
+        for start in range(0, total, block):
+            lo, hi = max(0, start - context), min(total, start + block + context)
+            if f is None:
+                window = wav[:, lo:hi]
+            else:
+                f.seek(lo)
+                data = f.read(hi - lo, dtype="float32", always_2d=True)
+                window = torch.from_numpy(np.ascontiguousarray(data.T)).mean(dim=0, keepdim=True)
+                if src_sr != sr:
+                    window = get_resampler(src_sr, sr, "cpu")(window)
+            scale = sr / src_sr
+            yield window, round((start - lo) * scale), round((hi - min(total, start + block)) * scale)
+    finally:
+        if f is not None:
+            f.close()
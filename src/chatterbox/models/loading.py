@@ -0,0 +1,174 @@
+"""
+Fast model construction: parameters are created on the meta device (no allocation, no random init) and then
+materialized straight from memory-mapped safetensors with `load_state_dict(assign=True)`.
+
+Pickled `.pt` checkpoints are converted to safetensors once and cached, so later starts mmap them as well.
+"""
+import contextlib
+import fnmatch
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+WEIGHTS_CACHE = Path(os.environ.get("CHATTERBOX_WEIGHTS_CACHE", Path.home() / ".cache" / "chatterbox" / "weights"))
+
+_register_parameter = nn.Module.register_parameter
+_meta_lock = threading.Lock()
+_meta_depth = 0
+# per-thread nesting depth of `init_empty_weights`: only the threads building modules inside it register on meta
+_meta_local = threading.local()
+
+
+def _register_on_meta(module, name, param):
+    _register_parameter(module, name, param)
+    if param is not None and getattr(_meta_local, "depth", 0) > 0:
+        param_cls = type(module._parameters[name])
+        module._parameters[name] = param_cls(module._parameters[name].to("meta"), requires_grad=param.requires_grad)
+
+
+@contextlib.contextmanager
+def init_empty_weights():
+    """
+    Modules built inside this context get their parameters on the meta device, so initializers are no-ops.
+    Buffers (STFT windows, mel filters, rotary tables, fades) are still computed for real, since checkpoints
+    don't carry the non-persistent ones.
+
+    The `register_parameter` patch is process-wide and reference counted, so components can be built from several
+    loader threads, but it only applies on threads inside this context: parameters registered elsewhere at the
+    same time (`load_state_dict(assign=True)`, weight-norm folding, quantization rebuilds) stay real.
+    """
+    global _meta_depth
+    with _meta_lock:
+        if _meta_depth == 0:
+            nn.Module.register_parameter = _register_on_meta
+        _meta_depth += 1
+    _meta_local.depth = getattr(_meta_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _meta_local.depth -= 1
+        with _meta_lock:
+            _meta_depth -= 1
+            if _meta_depth == 0:
+                nn.Module.register_parameter = _register_parameter
+
+
+def materialize_missing(module: nn.Module, allow_missing: Iterable[str] = ()):
+    """
+    Parameters the checkpoint didn't cover are still on the meta device. Those matching an `allow_missing` pattern
+    (fnmatch, on the full parameter name) get real storage and their module's `reset_parameters` init; any other
+    missing parameter, or an allowed one whose module has no `reset_parameters`, raises. Buffers are never touched:
+    they were built for real.
+    """
+    missing, allowed = [], []
+    for name, sub in module.named_modules():
+        own = [n for n, p in sub.named_parameters(recurse=False) if p.is_meta]
+        if not own:
+            continue
+        full = [f"{name}.{n}" if name else n for n in own]
+        if not all(any(fnmatch.fnmatchcase(f, pat) for pat in allow_missing) for f in full):
+            missing += full
+            continue
+        if not hasattr(sub, "reset_parameters"):
+            raise RuntimeError(f"{type(module).__name__}: cannot initialize {full}, {type(sub).__name__} has no "
+                               f"reset_parameters")
+        for n in own:
+            p = sub._parameters[n]
+            real = torch.empty(p.shape, dtype=p.dtype, device="cpu")
+            sub._parameters[n] = type(p)(real, requires_grad=p.requires_grad)
+        sub.reset_parameters()
+        allowed += full
+    if missing:
+        raise RuntimeError(f"{type(module).__name__}: {len(missing)} parameters are missing from the checkpoint: "
+                           f"{missing[:5]}{'...' if len(missing) > 5 else ''}")
+    if allowed:
+        logger.warning(f"{type(module).__name__}: {len(allowed)} parameters not in the checkpoint got their module's "
+                       f"default init: {allowed[:5]}{'...' if len(allowed) > 5 else ''}")
+    return module
+
+
+def cached_safetensors(path) -> Path:
+    """
+    Safetensors copy of a pickled `.pt` state dict, written once under `CHATTERBOX_WEIGHTS_CACHE` and keyed by the
+    source path, size and mtime. `.safetensors` paths are returned as is.
+    """
+    path = Path(path)
+    if path.suffix == ".safetensors":
+        return path
+    st = path.stat()
+    key = hashlib.sha1(f"{path.resolve()}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()[:16]
+    out = WEIGHTS_CACHE / f"{path.stem}-{key}.safetensors"
+    if not out.exists():
+        state = torch.load(path, map_location="cpu", weights_only=True)
+        # safetensors refuses tensors that share storage, give each its own contiguous copy
+        state = {k: v.detach().clone().contiguous() for k, v in state.items()}
+        out.parent.mkdir(parents=True, exist_ok=True)
+        tmp = out.with_suffix(f".tmp{os.getpid()}")
+        save_file(state, str(tmp))
+        os.replace(tmp, out)
+        logger.info(f"converted {path} to {out}")
+    return out
+
+
+def load_weights(path, prefix: Optional[str] = None) -> dict:
+    """
+    State dict from a safetensors file (memory-mapped) or a `.pt` file (via its cached safetensors copy). With
+    `prefix`, only the tensors under it are read, with the prefix stripped (e.g. "tokenizer." of an S3Gen file).
+    """
+    path = Path(path)
+    if path.suffix != ".safetensors":
+        try:
+            path = cached_safetensors(path)
+        except OSError as e:
+            logger.warning(f"could not cache {path} as safetensors ({e}), loading the pickle")
+            state = torch.load(path, map_location="cpu", weights_only=True)
+            return state if prefix is None else {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+    if prefix is None:
+        return load_file(str(path))
+    with safe_open(str(path), framework="pt") as f:
+        return {k[len(prefix):]: f.get_tensor(k) for k in f.keys() if k.startswith(prefix)}
+
+
+def load_module(
+    factory: Callable[[], nn.Module],
+    path,
+    strict: bool = True,
+    transform: Optional[Callable[[dict], dict]] = None,
+    prefix: Optional[str] = None,
+    allow_missing: Iterable[str] = (),
+) -> nn.Module:
+    """
+    `factory()` built on the meta device and filled from the checkpoint at `path` without copying into freshly
+    initialized tensors. `transform` can unwrap or rename the state dict first, `prefix` loads a submodule from
+    its parent's checkpoint. `strict=False` tolerates unexpected keys and missing buffers; parameters missing from
+    the checkpoint still raise unless listed in `allow_missing` (see `materialize_missing`). Returns the module on
+    CPU, with `weights_file` / `weights_prefix` set to the checkpoint tensors it was read from (see `residency`,
+    which reloads evicted submodules from them, and `registry.dedupe`).
+    """
+    with init_empty_weights():
+        module = factory()
+    state = load_weights(path, prefix)
+    if transform is not None:
+        state = transform(state)
+    module.load_state_dict(state, strict=strict, assign=True)
+    module.weights_file = Path(path)
+    module.weights_prefix = prefix or ""
+    return materialize_missing(module, allow_missing)
+
+
+def load_parallel(*loaders: Callable[[], object]) -> list:
+    "Run component loaders on a thread pool (file reads and tensor copies release the GIL); results in order"
+    with ThreadPoolExecutor(max_workers=len(loaders)) as pool:
+        futures = [pool.submit(fn) for fn in loaders]
+        return [f.result() for f in futures]
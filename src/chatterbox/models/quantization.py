@@ -0,0 +1,196 @@
+"""
+Post-training quantization helpers for CPU inference.
+
+Two modes are supported:
+    - "int8": dynamic int8 linears (`torch.ao` dynamic quantization). Activations are quantized on the fly,
+      weights are stored as int8. Fastest on x86 CPUs with VNNI/AMX.
+    - "int8_weight_only": int8 weights with a per-output-channel scale, matmuls run in the activation dtype.
+      Works with fp32 and bf16 activations.
+
+Embeddings are always stored as int8 rows with a per-row scale (a lookup only dequantizes the gathered rows).
+"""
+import logging
+from typing import Iterable
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+QUANT_MODES = ("int8", "int8_weight_only")
+
+
+def _quantize_rows(w: torch.Tensor):
+    "Symmetric per-row int8 quantization, returns (int8 weights, fp32 scales of shape (rows, 1))"
+    w = w.detach().float()
+    scale = w.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127.0
+    w_int8 = torch.round(w / scale).clamp(-127, 127).to(torch.int8)
+    return w_int8, scale
+
+
+class Int8Embedding(nn.Module):
+    """
+    Drop-in replacement for `nn.Embedding` with int8 rows and a per-row scale.
+    """
+
+    def __init__(self, num_embeddings: int, embedding_dim: int, dtype=torch.float32):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer("weight_int8", torch.zeros(num_embeddings, embedding_dim, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(num_embeddings, 1, dtype=dtype))
+
+    @classmethod
+    def from_float(cls, emb: nn.Embedding) -> 'Int8Embedding':
+        qemb = cls(emb.num_embeddings, emb.embedding_dim, dtype=emb.weight.dtype).to(emb.weight.device)
+        w_int8, scale = _quantize_rows(emb.weight)
+        qemb.weight_int8.copy_(w_int8)
+        qemb.scale.copy_(scale)
+        return qemb
+
+    @property
+    def weight(self):
+        "Dequantized weight, for code that only inspects `.weight.device` / `.weight.dtype`"
+        return self.weight_int8.to(self.scale.dtype) * self.scale
+
+    def forward(self, ids: torch.Tensor) -> torch.Tensor:
+        return self.weight_int8[ids].to(self.scale.dtype) * self.scale[ids]
+
+    def extra_repr(self):
+        return f"{self.num_embeddings}, {self.embedding_dim}, int8"
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    `nn.Linear` with int8 weights and a per-output-channel scale. Uses the fused `_weight_int8pack_mm` kernel
+    when the installed torch provides it, otherwise dequantizes on the fly.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, dtype=torch.float32):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight_int8", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(out_features, dtype=dtype))
+        self.register_buffer("bias", torch.zeros(out_features, dtype=dtype) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear) -> 'Int8WeightOnlyLinear':
+        qlin = cls(
+            linear.in_features, linear.out_features, bias=linear.bias is not None, dtype=linear.weight.dtype,
+        ).to(linear.weight.device)
+        w_int8, scale = _quantize_rows(linear.weight)
+        qlin.weight_int8.copy_(w_int8)
+        qlin.scale.copy_(scale.squeeze(1))
+        if linear.bias is not None:
+            qlin.bias.copy_(linear.bias.detach())
+        return qlin
+
+    @property
+    def weight(self):
+        "Dequantized weight, for code that only inspects `.weight.device` / `.weight.dtype`"
+        return self.weight_int8.to(self.scale.dtype) * self.scale[:, None]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x2d = x.reshape(-1, self.in_features)
+        if hasattr(torch.ops.aten, "_weight_int8pack_mm") and x.device.type == "cpu":
+            out = torch.ops.aten._weight_int8pack_mm(x2d, self.weight_int8, self.scale.to(x.dtype))
+        else:
+            out = F.linear(x2d, self.weight_int8.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out.reshape(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, int8"
+
+
+def _gpt2_conv1d_to_linear(module: nn.Module) -> nn.Linear:
+    "HF GPT2 uses a transposed `Conv1D` instead of `nn.Linear`; convert it so the quantizers can see it"
+    in_features, out_features = module.weight.shape
+    linear = nn.Linear(in_features, out_features, device=module.weight.device, dtype=module.weight.dtype)
+    linear.weight.data.copy_(module.weight.data.t())
+    linear.bias.data.copy_(module.bias.data)
+    return linear
+
+
+def _plain_linear(module: nn.Linear) -> nn.Linear:
+    "Copy an `nn.Linear` subclass (e.g. diffusers' `LoRACompatibleLinear`) into a plain `nn.Linear`"
+    assert getattr(module, "lora_layer", None) is None, "cannot quantize a linear with an active LoRA layer"
+    linear = nn.Linear(
+        module.in_features, module.out_features, bias=module.bias is not None,
+        device=module.weight.device, dtype=module.weight.dtype,
+    )
+    linear.weight.data.copy_(module.weight.data)
+    if module.bias is not None:
+        linear.bias.data.copy_(module.bias.data)
+    return linear
+
+
+def _replace_modules(root: nn.Module, fn):
+    "Recursively replace children of `root` with `fn(child)` when it returns a module"
+    for name, child in root.named_children():
+        new = fn(child)
+        if new is not None:
+            setattr(root, name, new)
+        else:
+            _replace_modules(child, fn)
+
+
+def quantize_linears(root: nn.Module, names: Iterable[str], mode: str):
+    """
+    Quantize all linear layers inside the named submodules of `root` (a name may also point at a single
+    `nn.Linear`). Modifies `root` in place.
+    """
+    assert mode in QUANT_MODES, f"unknown quantization mode {mode!r}, expected one of {QUANT_MODES}"
+
+    # GPT2 Conv1D / Linear subclasses -> Linear, `quantize_dynamic` only matches exact types
+    def to_linear(m):
+        if type(m).__name__ == "Conv1D" and hasattr(m, "nf"):
+            return _gpt2_conv1d_to_linear(m)
+        if isinstance(m, nn.Linear) and type(m) is not nn.Linear:
+            return _plain_linear(m)
+    for name in names:
+        _replace_modules(root.get_submodule(name), to_linear)
+
+    if mode == "int8":
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        torch.ao.quantization.quantize_dynamic(
+            root, {name: qconfig for name in names}, dtype=torch.qint8, inplace=True,
+        )
+    else:
+        def to_int8(m):
+            if isinstance(m, nn.Linear):
+                return Int8WeightOnlyLinear.from_float(m)
+        for name in names:
+            module = root.get_submodule(name)
+            if isinstance(module, nn.Linear):
+                setattr(root, name, Int8WeightOnlyLinear.from_float(module))
+            else:
+                _replace_modules(module, to_int8)
+    return root
+
+
+def quantize_embeddings(root: nn.Module, names: Iterable[str]):
+    "Replace the named `nn.Embedding` submodules of `root` with `Int8Embedding`. Modifies `root` in place."
+    for name in names:
+        module = root.get_submodule(name)
+        assert isinstance(module, nn.Embedding), f"{name} is not an nn.Embedding"
+        parent_name, _, attr = name.rpartition(".")
+        parent = root.get_submodule(parent_name) if parent_name else root
+        setattr(parent, attr, Int8Embedding.from_float(module))
+    return root
+
+
+def weight_bytes(module: nn.Module) -> int:
+    "Bytes held by parameters, buffers and packed dynamic-quant weights of `module`"
+    total = sum(t.numel() * t.element_size() for t in module.parameters())
+    total += sum(t.numel() * t.element_size() for t in module.buffers() if t is not None)
+    for m in module.modules():
+        packed = getattr(m, "_packed_params", None)
+        if packed is not None and hasattr(m, "weight") and callable(m.weight):
+            w = m.weight()
+            total += w.numel() * w.element_size()
+    return total
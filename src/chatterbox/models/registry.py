@@ -0,0 +1,171 @@
+"""
+Process-wide registry of loaded components, so English / multilingual / turbo TTS and VC served from one process
+hold each unique set of weights once.
+
+- `get_or_load` caches whole components by checkpoint (resolved path and size; Hugging Face cache blobs are
+  content-addressed, so two snapshots of the same file resolve to the same blob) plus the load options.
+- `dedupe` caches modules by the checkpoint tensors they were loaded from (file and key prefix) and their layout
+  (parameter names, shapes, dtypes, devices). Identical submodules from different checkpoint files (e.g. the S3
+  tokenizer, CAMPPlus and HiFT inside the regular and meanflow S3Gen checkpoints, or the voice encoder in `ve.pt`
+  vs `ve.safetensors`) are matched by a digest of their tensor bytes, read from the files only when two files
+  offer a module of the same layout; loaded tensors are never copied to the host for hashing.
+
+Components handed out by the registry are shared: treat them as read-only. Anything that mutates a module in
+place (`S3Gen.use_onnx_backend`, quantization) affects every wrapper holding it.
+"""
+import hashlib
+import json
+import logging
+import struct
+import threading
+import weakref
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from .loading import cached_safetensors
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_key(path) -> Tuple[str, int]:
+    path = Path(path).resolve()
+    return str(path), path.stat().st_size
+
+
+def module_layout(module: nn.Module) -> str:
+    "Type and parameter/buffer names, dtypes, shapes and devices of a module, without touching tensor data"
+    entries = [type(module).__name__] + [
+        f"{name}|{t.dtype}|{tuple(t.shape)}|{t.device}"
+        for name, t in list(module.named_parameters()) + list(module.named_buffers())
+    ]
+    return hashlib.sha1("\n".join(entries).encode()).hexdigest()
+
+
+def tensors_digest(path, prefix: str = "") -> str:
+    """
+    Hash of the names, dtypes, shapes and bytes of the tensors under `prefix` in a checkpoint, streamed from its
+    safetensors file (`.pt` files via their cached safetensors copy) without building tensors.
+    """
+    path = cached_safetensors(path)
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        data_start = 8 + header_len
+        for name in sorted(k for k in header if k != "__metadata__" and k.startswith(prefix)):
+            info = header[name]
+            h.update(f"{name[len(prefix):]}|{info['dtype']}|{info['shape']}".encode())
+            start, end = info["data_offsets"]
+            f.seek(data_start + start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 24))
+                h.update(chunk)
+                remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def weights_hash(module: nn.Module) -> str:
+    "Hash of a module's parameters and buffers (names, dtypes, shapes, bytes) and device"
+    h = hashlib.sha1(type(module).__name__.encode())
+    for name, t in list(module.named_parameters()) + list(module.named_buffers()):
+        h.update(f"{name}|{t.dtype}|{tuple(t.shape)}|{t.device}".encode())
+        h.update(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+class ModelRegistry:
+    def __init__(self):
+        # both weak, so a component or submodule dropped or evicted by every holder (see `residency`) is actually freed
+        self._by_checkpoint: "weakref.WeakValueDictionary[tuple, nn.Module]" = weakref.WeakValueDictionary()
+        self._by_source: "weakref.WeakValueDictionary[tuple, nn.Module]" = weakref.WeakValueDictionary()
+        self._by_weights: "weakref.WeakValueDictionary[str, nn.Module]" = weakref.WeakValueDictionary()
+        self._digests: Dict[tuple, str] = {}
+        self._lock = threading.Lock()
+        self._key_locks: Dict[tuple, threading.Lock] = {}
+
+    def get_or_load(self, kind: str, path, loader: Callable[[], nn.Module], *options) -> nn.Module:
+        """
+        The component loaded from `path` with `options` (e.g. device, estimator mode), calling `loader()` only on
+        the first request. Concurrent requests for the same key wait for the first load instead of repeating it.
+        """
+        key = (kind, checkpoint_key(path), *map(str, options))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            module = self._by_checkpoint.get(key)
+            if module is None:
+                module = self._by_checkpoint[key] = loader()
+            else:
+                logger.info(f"reusing loaded {kind} from {Path(path).name}")
+            return module
+
+    def _digest(self, ckpt: Tuple[str, int], prefix: str) -> str:
+        key = (ckpt, prefix)
+        if key not in self._digests:
+            self._digests[key] = tensors_digest(ckpt[0], prefix)
+        return self._digests[key]
+
+    def dedupe(self, module: nn.Module, path=None, prefix: Optional[str] = None) -> nn.Module:
+        """
+        `module`, or an already registered module with identical weights. `path` and `prefix` name the checkpoint
+        tensors it was loaded from (default: the `weights_file` / `weights_prefix` set by `loading.load_module`).
+        Modules without a checkpoint fall back to hashing their tensors.
+        """
+        path = path if path is not None else getattr(module, "weights_file", None)
+        prefix = prefix if prefix is not None else getattr(module, "weights_prefix", "")
+        if path is None:
+            key = weights_hash(module)
+            with self._lock:
+                return self._by_weights.setdefault(key, module)
+
+        layout, ckpt = module_layout(module), checkpoint_key(path)
+        with self._lock:
+            found = self._by_source.get((layout, ckpt, prefix))
+            if found is not None:
+                return found
+            candidates = [(k, m) for k, m in self._by_source.items() if k[0] == layout]
+        # same layout from another checkpoint: compare the tensor bytes in the files (read once per file and prefix)
+        for (_, other_ckpt, other_prefix), other in candidates:
+            if self._digest(other_ckpt, other_prefix) == self._digest(ckpt, prefix):
+                module = other
+                break
+        with self._lock:
+            return self._by_source.setdefault((layout, ckpt, prefix), module)
+
+    def share_s3gen_parts(self, s3gen: nn.Module) -> nn.Module:
+        "Swap the S3 tokenizer, CAMPPlus speaker encoder and HiFT of `s3gen` for registered identical copies"
+        path = getattr(s3gen, "weights_file", None)
+        for name in ("tokenizer", "speaker_encoder", "mel2wav"):
+            if isinstance(getattr(s3gen, name, None), nn.Module):
+                prefix = f"{getattr(s3gen, 'weights_prefix', '')}{name}." if path is not None else None
+                setattr(s3gen, name, self.dedupe(getattr(s3gen, name), path, prefix))
+        return s3gen
+
+    def unique_bytes(self) -> int:
+        "Bytes of distinct tensor storage held by registered components"
+        seen, total = set(), 0
+        with self._lock:
+            modules = (list(self._by_checkpoint.values()) + list(self._by_source.values())
+                       + list(self._by_weights.values()))
+        for m in modules:
+            for t in list(m.parameters()) + list(m.buffers()):
+                ptr = t.untyped_storage().data_ptr()
+                if ptr not in seen:
+                    seen.add(ptr)
+                    total += t.untyped_storage().nbytes()
+        return total
+
+    def clear(self):
+        with self._lock:
+            self._by_checkpoint.clear()
+            self._by_source.clear()
+            self._by_weights.clear()
+            self._digests.clear()
+            self._key_locks.clear()
+
+
+REGISTRY = ModelRegistry()
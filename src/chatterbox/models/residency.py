@@ -0,0 +1,227 @@
+"""
+Tiered residency for submodules that are only needed to build conditionals: the S3 tokenizer and CAMPPlus speaker
+encoder inside S3Gen, the voice encoder, and T3's `text_head` (unused by inference). With a warm voice cache they
+sit idle, so they are replaced by `LazyModule` placeholders that load on first use from the memory-mapped
+checkpoint and can be evicted after an idle timeout or when the host runs low on memory.
+
+    mgr = lazy_conditioning(model, idle_timeout=300)   # ChatterboxTTS / Turbo / Multilingual / VC
+    mgr.start()                                        # background eviction
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from .loading import load_module
+from .registry import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule(nn.Module):
+    """
+    Stand-in for a submodule that is loaded on first use and can be evicted. Calls and attribute lookups are
+    forwarded to the loaded module. The loaded module is not registered as a child, so `.to()`/`state_dict()` of
+    the parent skip it; the loader decides device and dtype.
+    """
+
+    def __init__(self, name: str, loader: Callable[[], nn.Module], module: Optional[nn.Module] = None):
+        super().__init__()
+        object.__setattr__(self, "_lazy_name", name)
+        object.__setattr__(self, "_lazy_loader", loader)
+        object.__setattr__(self, "_lazy_module", module)
+        object.__setattr__(self, "_lazy_lock", threading.Lock())
+        object.__setattr__(self, "last_used", time.monotonic())
+
+    @property
+    def loaded(self) -> bool:
+        return self._lazy_module is not None
+
+    def get(self) -> nn.Module:
+        object.__setattr__(self, "last_used", time.monotonic())
+        module = self._lazy_module
+        if module is None:
+            with self._lazy_lock:
+                module = self._lazy_module
+                if module is None:
+                    start = time.perf_counter()
+                    module = self._lazy_loader()
+                    object.__setattr__(self, "_lazy_module", module)
+                    logger.info(f"loaded {self._lazy_name} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return module
+
+    def evict(self) -> bool:
+        "Drop the loaded module; callers still holding it keep it alive until they finish"
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                return False
+            object.__setattr__(self, "_lazy_module", None)
+        logger.info(f"evicted {self._lazy_name}")
+        return True
+
+    def nbytes(self) -> int:
+        module = self._lazy_module
+        if module is None:
+            return 0
+        return sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+
+    def forward(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.get(), name)
+
+
+def available_memory_mib() -> Optional[float]:
+    "MemAvailable from /proc/meminfo in MiB, None where it is not available"
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class ResidencyManager:
+    """
+    Tracks `LazyModule`s and evicts the ones idle for more than `idle_timeout` seconds, or all loaded ones when
+    available memory drops below `min_available_mib`. `start()` runs `evict_idle` on a daemon thread.
+    """
+
+    def __init__(self, idle_timeout: Optional[float] = 300.0, min_available_mib: Optional[float] = None):
+        self.idle_timeout = idle_timeout
+        self.min_available_mib = min_available_mib
+        self.modules: Dict[str, LazyModule] = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._fork_hook = False
+
+    def lazy(self, name: str, loader: Callable[[], nn.Module], module: Optional[nn.Module] = None) -> LazyModule:
+        "A `LazyModule` for `loader`; pass the currently loaded `module` to start resident"
+        self.modules[name] = LazyModule(name, loader, module)
+        return self.modules[name]
+
+    def evict_idle(self, now: Optional[float] = None) -> List[str]:
+        now = time.monotonic() if now is None else now
+        available = available_memory_mib() if self.min_available_mib else None
+        pressure = available is not None and available < self.min_available_mib
+        evicted = [
+            name for name, m in self.modules.items()
+            if m.loaded and (pressure or (self.idle_timeout is not None and now - m.last_used > self.idle_timeout))
+            and m.evict()
+        ]
+        if evicted:
+            gc.collect()
+        return evicted
+
+    def evict_all(self) -> List[str]:
+        evicted = [name for name, m in self.modules.items() if m.evict()]
+        gc.collect()
+        return evicted
+
+    def resident_bytes(self) -> int:
+        return sum(m.nbytes() for m in self.modules.values())
+
+    def start(self, interval: float = 30.0):
+        "Evict on a daemon thread every `interval` seconds; restarted in forked children (pre-fork serving)"
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                self.evict_idle()
+
+        self._thread = threading.Thread(target=loop, name="chatterbox-residency", daemon=True)
+        self._thread.start()
+        if hasattr(os, "register_at_fork") and not self._fork_hook:
+            self._fork_hook = True
+            os.register_at_fork(after_in_child=lambda: self._thread is not None and self._restart(interval))
+        return self
+
+    def _restart(self, interval):
+        # threads don't survive fork(); the child gets its own eviction thread
+        self._thread = None
+        self._stop = threading.Event()
+        self.start(interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+
+def _placement(module: nn.Module):
+    t = next(iter(list(module.parameters()) + list(module.buffers())))
+    return t.device, t.dtype
+
+
+def _reloader(factory, module: nn.Module, parent: nn.Module, prefix: str, strict=True):
+    """
+    Loader that rebuilds `module` from its parent's checkpoint, on the device/dtype it has now. The result goes
+    through `REGISTRY.dedupe`, so while another wrapper still holds the shared module it is reused, not copied.
+    """
+    path = getattr(parent, "weights_file", None)
+    if path is None:
+        raise ValueError(f"{type(parent).__name__} was not loaded with `loading.load_module`, cannot reload {prefix}")
+    device, dtype = _placement(module)
+
+    def load():
+        with torch.inference_mode(False):
+            loaded = load_module(factory, path, strict=strict, prefix=prefix).to(device=device, dtype=dtype).eval()
+        return REGISTRY.dedupe(loaded)
+
+    return load
+
+
+def lazy_conditioning(
+    model,
+    idle_timeout: Optional[float] = 300.0,
+    min_available_mib: Optional[float] = None,
+    evict_now: bool = False,
+) -> ResidencyManager:
+    """
+    Put the conditioning-only submodules of a ChatterboxTTS / ChatterboxTurboTTS / ChatterboxMultilingualTTS /
+    ChatterboxVC under a `ResidencyManager`. They stay resident until evicted (`evict_now=True` evicts at once,
+    e.g. once the voice cache is warm) and reload from the model's checkpoints on demand.
+    """
+    from .s3tokenizer import S3Tokenizer
+    from .s3gen.xvector import CAMPPlus
+    from .voice_encoder import VoiceEncoder
+
+    mgr = ResidencyManager(idle_timeout, min_available_mib)
+    s3gen = model.s3gen
+    s3gen.tokenizer = mgr.lazy(
+        "s3_tokenizer",
+        _reloader(lambda: S3Tokenizer("speech_tokenizer_v2_25hz"), s3gen.tokenizer, s3gen, "tokenizer.", strict=False),
+        s3gen.tokenizer,
+    )
+    s3gen.speaker_encoder = mgr.lazy(
+        "campplus",
+        _reloader(lambda: CAMPPlus(memory_efficient=False), s3gen.speaker_encoder, s3gen, "speaker_encoder."),
+        s3gen.speaker_encoder,
+    )
+    if getattr(model, "ve", None) is not None:
+        model.ve = mgr.lazy("voice_encoder", _reloader(VoiceEncoder, model.ve, model.ve, ""), model.ve)
+    t3 = getattr(model, "t3", None)
+    if t3 is not None and isinstance(getattr(t3, "text_head", None), nn.Linear):
+        head = t3.text_head
+        shape = head.in_features, head.out_features, head.bias is not None  # the factory must not keep `head` alive
+        t3.text_head = mgr.lazy(
+            "t3_text_head",
+            _reloader(lambda: nn.Linear(shape[0], shape[1], bias=shape[2]), head, t3, "text_head."),
+            head,
+        )
+        del head
+    if evict_now:
+        mgr.evict_all()
+    return mgr
@@ -21,6 +21,11 @@ from .matcha.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample
     TimestepEmbedding, Upsample1D
 from .matcha.transformer import BasicTransformerBlock
 from .utils.intmeanflow import get_intmeanflow_time_mixer
+from ..quantization import quantize_linears
+
+
+# "fp32": training layout, unchanged. The others are inference-only (see `ConditionalDecoder.prepare_for_inference`)
+ESTIMATOR_MODES = ("fp32", "fused", "bf16", "int8")
 
 
 def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
@@ -34,6 +39,37 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+class EstimatorContext:
+    """
+    The inputs of `ConditionalDecoder.forward` that are the same at every step of one CFM solve: the padding mask
+    and attention bias of each UNet resolution, the packed static inputs (mu, speaker embedding broadcast over time,
+    cond) and a table of time embeddings keyed by the time values. Build it with `ConditionalDecoder.make_context`.
+    """
+
+    def __init__(self, estimator, masks, attn_biases, static_in, time_table):
+        self.estimator = estimator
+        self.masks = masks
+        self.attn_biases = attn_biases
+        self.static_in = static_in
+        self.time_table = time_table
+
+    def time_embedding(self, t, r=None):
+        "(1, D) embedding of the (first) time value of `t` (and `r`), computed on a table miss"
+        t = t.reshape(-1)[:1]
+        r = r.reshape(-1)[:1] if self.estimator.meanflow else None
+        key = (t.item(), r.item() if r is not None else None)
+        emb = self.time_table.get(key)
+        if emb is None:
+            emb = self.time_table[key] = self.estimator.embed_time(t, r)
+        return emb
+
+    def narrow(self, n):
+        "Context of the first `n` batch rows (the conditional half of a CFG batch); shares the time table"
+        return EstimatorContext(
+            self.estimator, [m[:n] for m in self.masks], [b[:n] for b in self.attn_biases], self.static_in[:n],
+            self.time_table,
+        )
+
 
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
@@ -226,6 +262,74 @@ class ConditionalDecoder(nn.Module):
     def dtype(self):
         return self.final_proj.weight.dtype
 
+    def prepare_for_inference(self, mode: str = "fused"):
+        """
+        Irreversibly convert the estimator for inference:
+            - "fused": fused QKV projections and SDPA attention in every transformer block
+            - "bf16": "fused" with all weights in bfloat16
+            - "int8": "fused" with dynamic int8 linears in the transformer/resnet blocks (CPU only)
+        """
+        if mode not in ESTIMATOR_MODES:
+            raise ValueError(f"unknown estimator mode {mode!r}, expected one of {ESTIMATOR_MODES}")
+        if mode == "fp32":
+            return self
+        for m in self.modules():
+            if isinstance(m, BasicTransformerBlock):
+                m.fuse_for_inference()
+        if mode == "bf16":
+            self.to(torch.bfloat16)
+        elif mode == "int8":
+            quantize_linears(self, ["down_blocks", "mid_blocks", "up_blocks"], "int8")
+        return self
+
+    def embed_time(self, t, r=None):
+        "(N,) time steps (and meanflow end times) -> (N, time_embed_dim)"
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+
+        if self.meanflow:
+            r = self.time_embeddings(r).to(t.dtype)
+            r = self.time_mlp(r)
+            concat_embed = torch.cat([t, r], dim=1)
+            t = self.time_embed_mixer(concat_embed)
+        return t
+
+    def attn_bias(self, x, mask):
+        # attn_mask = torch.matmul(mask.transpose(1, 2).contiguous(), mask)
+        attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1)
+        return mask_to_bias(attn_mask == 1, x.dtype)
+
+    @torch.inference_mode()
+    def make_context(self, mask, mu, spks=None, cond=None, t_span=None):
+        """
+        Precompute the step-invariant inputs of one CFM solve (see `EstimatorContext`). The time embeddings of
+        `t_span` (in the estimator dtype, consecutive (t, r) pairs for meanflow) are computed in one batch; other
+        time values are embedded on first use.
+        """
+        static_in = mu
+        if spks is not None:
+            static_in = pack([static_in, repeat(spks, "b c -> b c t", t=mu.shape[-1])], "b * t")[0]
+        if cond is not None:
+            static_in = pack([static_in, cond], "b * t")[0]
+
+        masks = [mask]
+        for _ in self.down_blocks:
+            masks.append(masks[-1][:, :, ::2])
+        masks = masks[:-1]
+        attn_biases = [self.attn_bias(m.transpose(1, 2).to(self.dtype), m) for m in masks]
+
+        time_table = {}
+        if t_span is not None:
+            ts = t_span.to(device=mask.device, dtype=self.dtype)
+            if self.meanflow:
+                t, r = ts[:-1], ts[1:]
+                keys = zip(t.tolist(), r.tolist())
+            else:
+                t, r = ts, None
+                keys = ((v, None) for v in t.tolist())
+            time_table = {k: emb[None] for k, emb in zip(keys, self.embed_time(t, r))}
+        return EstimatorContext(self, masks, attn_biases, static_in, time_table)
+
     def initialize_weights(self):
         for m in self.modules():
             if isinstance(m, nn.Conv1d):
@@ -240,7 +344,7 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None):
+    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None, ctx=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -250,6 +354,8 @@ class ConditionalDecoder(nn.Module):
             spks (_type_, optional) Defaults to None.
             cond (_type_, optional)
             r: end time for meanflow mode (shape (1,) tensor)
+            ctx: optional `EstimatorContext` of the current solve; replaces `mu`, `spks`, `cond`, the per-resolution
+                masks and attention biases, and looks up the time embedding
 
         Raises:
             ValueError: _description_
@@ -258,32 +364,28 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
-
-        if self.meanflow:
-            r = self.time_embeddings(r).to(t.dtype)
-            r = self.time_mlp(r)
-            concat_embed = torch.cat([t, r], dim=1)
-            t = self.time_embed_mixer(concat_embed)
-
-        x = pack([x, mu], "b * t")[0]
-
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        if ctx is None:
+            t = self.embed_time(t, r)
+            x = pack([x, mu], "b * t")[0]
+            if spks is not None:
+                spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+                x = pack([x, spks], "b * t")[0]
+            if cond is not None:
+                x = pack([x, cond], "b * t")[0]
+        else:
+            t = ctx.time_embedding(t, r).expand(x.size(0), -1)
+            x = pack([x, ctx.static_in], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        masks = [mask] if ctx is None else list(ctx.masks)
+        biases = [] if ctx is None else list(ctx.attn_biases)
+        for i, (resnet, transformer_blocks, downsample) in enumerate(self.down_blocks):
+            mask_down = masks[i]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            if ctx is None:
+                biases.append(self.attn_bias(x, mask_down))
+            attn_mask = biases[i]
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -293,16 +395,15 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+            if ctx is None:
+                masks.append(mask_down[:, :, ::2])
+        masks = masks[:len(self.down_blocks)]
+        mask_mid, bias_mid = masks[-1], biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = bias_mid
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -312,14 +413,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
 
         for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+            mask_up, attn_mask = masks.pop(), biases.pop()
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -140,7 +140,9 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   finalize,
                   n_timesteps=10,
                   noised_mels=None,
-                  meanflow=False):
+                  meanflow=False,
+                  solver=None,
+                  cfg_steps=None):
         # token: (B, n_toks)
         # token_len: (B,)
         B = token.size(0)
@@ -157,8 +159,29 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         prompt_feat_len = _repeat_batch_dim(prompt_feat_len, B, ndim=1)  # (B,) or None
         embedding = _repeat_batch_dim(embedding, B, ndim=2)  # (B, emb_dim)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        # prompt mel frames per row that line up with the prompt tokens: `embed_ref` only guarantees
+        # tokens == mels // 2, so an odd trailing frame is dropped the same way whether or not the batch is ragged
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full((B,), prompt_feat.shape[1], device=prompt_token_len.device)
+        prompt_mel_len = torch.minimum(
+            prompt_feat_len.long().to(prompt_token_len.device), prompt_token_len.long() * self.token_mel_ratio,
+        )
+
+        # concat text and prompt_text. With per-row prompts of different lengths every row is packed on its own
+        # as [prompt, tokens, padding], so the padding stays at the end where the masks expect it.
+        ragged = B > 1 and bool(
+            (prompt_token_len != prompt_token_len[0]).any() or (prompt_mel_len != prompt_mel_len[0]).any()
+        )
+        if ragged:
+            assert finalize, "per-row prompts of different lengths are only supported with finalize=True"
+            P, L = prompt_token_len.long().tolist(), token_len.long().tolist()
+            packed = token.new_zeros(B, max(p + l for p, l in zip(P, L)))
+            for i, (p, l) in enumerate(zip(P, L)):
+                packed[i, :p] = prompt_token[i, :p]
+                packed[i, p:p + l] = token[i, :l]
+            token, token_len = packed, prompt_token_len + token_len
+        else:
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
 
         if (token >= self.vocab_size).any():
@@ -171,12 +194,18 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
 
         h_lengths = h_masks.sum(dim=-1).squeeze(dim=-1)
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+        mel_len1 = int(prompt_mel_len[0])
+        mel_len2 = h.shape[1] - mel_len1
         h = self.encoder_proj(h)
 
         # # get conditions
-        conds = torch.zeros([B, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([B, h.shape[1], self.output_size], device=token.device).to(h.dtype)
+        if ragged:
+            prompt_mel_lens = prompt_mel_len.tolist()
+            for i, n in enumerate(prompt_mel_lens):
+                conds[i, :n] = prompt_feat[i, :n]
+        else:
+            conds[:, :mel_len1] = prompt_feat[:, :mel_len1]
         conds = conds.transpose(1, 2)
 
         mask = (~make_pad_mask(h_lengths)).unsqueeze(1).to(h)
@@ -192,7 +221,16 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             n_timesteps=n_timesteps,
             noised_mels=noised_mels,
             meanflow=meanflow,
+            solver=solver,
+            cfg_steps=cfg_steps,
         )
+        if ragged:
+            # per-row [prompt_mel_len, prompt_mel_len + generated) slices, re-padded to the longest row
+            gen_lens = [l * self.token_mel_ratio for l in L]
+            out = feat.new_zeros(B, feat.size(1), max(gen_lens))
+            for i, (n, m) in enumerate(zip(prompt_mel_lens, gen_lens)):
+                out[i, :, :m] = feat[i, :, n:n + m]
+            return out, None
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, None  # NOTE jrm: why are they returning None here?
@@ -19,8 +19,89 @@ from .configs import CFM_PARAMS
 from tqdm import tqdm
 
 
+CFM_SOLVERS = ("euler", "midpoint", "heun", "adaptive")
+
+
 def cast_all(*args, dtype):
-    return [a if (not a.dtype.is_floating_point) or a.dtype == dtype else a.to(dtype) for a in args]
+    "Cast floating point tensors to `dtype`; `None` and integer tensors are passed through"
+    return [a if a is None or (not a.dtype.is_floating_point) or a.dtype == dtype else a.to(dtype) for a in args]
+
+
+class GuidedVelocity:
+    """
+    CFG-guided dx/dt of the estimator for one solve.
+
+    The conditional and unconditional halves go through the estimator as one doubled batch. The inputs are
+    preallocated once, the conditioning (mask, mu, spks, cond) is written once, and only x/t/r are refreshed per
+    call. The ODE state, time steps and CFG combination stay in the input dtype (fp32); only the estimator inputs
+    are cast, so a bf16 estimator does not accumulate rounding error over the steps.
+
+    Estimators with `make_context` (`ConditionalDecoder`) also get their step-invariant work (masks, attention
+    biases, speaker broadcast, time embeddings of `t_span`) done once here instead of on every call.
+    """
+
+    def __init__(self, cfm, x, mu, mask, spks, cond, meanflow=False, t_span=None):
+        self.estimator = cfm.estimator
+        self.cfg_rate = cfm.inference_cfg_rate
+        self.meanflow = meanflow
+        self.in_dtype = x.dtype
+        est_dtype = self.estimator.dtype
+        mu, mask, spks, cond = cast_all(mu, mask, spks, cond, dtype=est_dtype)
+
+        # Duplicated batch dims are for CFG
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        # Shapes:
+        #      x_in  ( 2B, 80, T )
+        #   mask_in  ( 2B,  1, T )
+        #     mu_in  ( 2B, 80, T )
+        #      t_in  ( 2B,       )
+        #   spks_in  ( 2B, 80,   )
+        #   cond_in  ( 2B, 80, T )
+        #      r_in  ( 2B,       )
+        B, T = mu.size(0), x.size(2)
+        self.B = B
+        self.x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=est_dtype)
+        self.mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=est_dtype)
+        self.mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=est_dtype)
+        self.t_in    = torch.zeros([2 * B       ], device=x.device, dtype=est_dtype)
+        self.spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=est_dtype)
+        self.cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=est_dtype)
+        self.r_in    = torch.zeros([2 * B       ], device=x.device, dtype=est_dtype) # (only used for meanflow)
+
+        self.mask_in[:B] = self.mask_in[B:] = mask
+        self.mu_in[:B] = mu
+        self.spks_in[:B] = spks
+        self.cond_in[:B] = cond
+
+        self.ctx = self.ctx_cond = None
+        if hasattr(self.estimator, "make_context"):
+            self.ctx = self.estimator.make_context(self.mask_in, self.mu_in, self.spks_in, self.cond_in, t_span=t_span)
+            self.ctx_cond = self.ctx.narrow(B)
+
+    def __call__(self, x, t, r=None, guided=True):
+        """
+        With `guided=False` (or a zero CFG rate) only the conditional half runs: the first B rows of the
+        preallocated inputs are used as-is, at half the estimator cost.
+        """
+        B = self.B
+        n = 2 * B if guided and self.cfg_rate > 0 else B
+        self.x_in[:B] = x
+        if n > B:
+            self.x_in[B:] = x
+        self.t_in[:n] = t
+        if self.meanflow:
+            self.r_in[:n] = r
+        kwargs = {}
+        if self.ctx is not None:
+            kwargs["ctx"] = self.ctx if n > B else self.ctx_cond
+        dxdt = self.estimator(
+            x=self.x_in[:n], mask=self.mask_in[:n], mu=self.mu_in[:n], t=self.t_in[:n], spks=self.spks_in[:n],
+            cond=self.cond_in[:n], r=self.r_in[:n] if self.meanflow else None, **kwargs,
+        ).to(self.in_dtype)
+        if n == B:
+            return dxdt
+        dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
+        return (1.0 + self.cfg_rate) * dxdt - self.cfg_rate * cfg_dxdt
 
 
 class ConditionalCFM(BASECFM):
@@ -34,6 +115,10 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # step size control of the "adaptive" solver
+        self.adaptive_rtol = cfm_params.get("adaptive_rtol", 0.05)
+        self.adaptive_atol = cfm_params.get("adaptive_atol", 0.05)
+        self.adaptive_max_nfe_ratio = cfm_params.get("adaptive_max_nfe_ratio", 4)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
@@ -75,7 +160,19 @@ class ConditionalCFM(BASECFM):
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
         return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False):
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None, cfg_steps=None):
+        """
+        Integrate the CFG-guided flow from noise `x` over `t_span` with one of `CFM_SOLVERS`.
+        `cfg_steps` limits guidance to the first k steps (None = all); later steps run the conditional branch only.
+        """
+        solver = solver or self.solver
+        if solver not in CFM_SOLVERS:
+            raise ValueError(f"unknown CFM solver {solver!r}, expected one of {CFM_SOLVERS}")
+        if cfg_steps is not None and cfg_steps < 0:
+            raise ValueError(f"cfg_steps must be >= 0, got {cfg_steps}")
+        return getattr(self, f"solve_{solver}")(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, cfg_steps=cfg_steps)
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, meanflow=False, cfg_steps=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -90,59 +187,79 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             meanflow: meanflow mode
+            cfg_steps: apply CFG on the first `cfg_steps` steps only (None = every step)
         """
-        in_dtype = x.dtype
-        x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
-
-        # Duplicated batch dims are for CFG
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        B, T = mu.size(0), x.size(2)
-        x_in    = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2 * B,  1, T], device=x.device, dtype=x.dtype)
-        mu_in   = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        t_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2 * B, 80   ], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2 * B, 80, T], device=x.device, dtype=x.dtype)
-        r_in    = torch.zeros([2 * B       ], device=x.device, dtype=x.dtype) # (only used for meanflow)
-
-        for t, r in zip(t_span[:-1], t_span[1:]):
+        velocity = GuidedVelocity(self, x, mu, mask, spks, cond, meanflow=meanflow, t_span=t_span)
+        for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+            t = t.unsqueeze(dim=0)
+            r = r.unsqueeze(dim=0)
+            guided = cfg_steps is None or i < cfg_steps
+            x = x + (r - t) * velocity(x, t, r, guided=guided)
+        return x
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, cfg_steps=None):
+        "Explicit midpoint (2nd order), two estimator calls per step"
+        velocity = GuidedVelocity(self, x, mu, mask, spks, cond, t_span=t_span)
+        for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
+            t = t.unsqueeze(dim=0)
+            dt = r.unsqueeze(dim=0) - t
+            guided = cfg_steps is None or i < cfg_steps
+            k1 = velocity(x, t, guided=guided)
+            x = x + dt * velocity(x + 0.5 * dt * k1, t + 0.5 * dt, guided=guided)
+        return x
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, cfg_steps=None):
+        "Heun / explicit trapezoid (2nd order), two estimator calls per step"
+        velocity = GuidedVelocity(self, x, mu, mask, spks, cond, t_span=t_span)
+        for i, (t, r) in enumerate(zip(t_span[:-1], t_span[1:])):
             t = t.unsqueeze(dim=0)
             r = r.unsqueeze(dim=0)
-            # Shapes:
-            #      x_in  ( 2B, 80, T )
-            #   mask_in  ( 2B,  1, T )
-            #     mu_in  ( 2B, 80, T )
-            #      t_in  ( 2B,       )
-            #   spks_in  ( 2B, 80,   )
-            #   cond_in  ( 2B, 80, T )
-            #      r_in  ( 2B,       )
-            #         x  (  B, 80, T )
-            #      mask  (  B,  1, T )
-            #        mu  (  B, 80, T )
-            #         t  (  B,       )
-            #      spks  (  B, 80,   )
-            #      cond  (  B, 80, T )
-            #         r  (  B,       )
-
-            x_in[:B] = x_in[B:] = x
-            mask_in[:B] = mask_in[B:] = mask
-            mu_in[:B] = mu
-            t_in[:B] = t_in[B:] = t
-            spks_in[:B] = spks
-            cond_in[:B] = cond
-            r_in[:B] = r_in[B:] = r # (only used for meanflow)
-            dxdt = self.estimator.forward(
-                x=x_in, mask=mask_in, mu=mu_in, t=t_in, spks=spks_in, cond=cond_in,
-                r=r_in if meanflow else None,
-            )
-            dxdt, cfg_dxdt = torch.split(dxdt, [B, B], dim=0)
-            dxdt = ((1.0 + self.inference_cfg_rate) * dxdt - self.inference_cfg_rate * cfg_dxdt)
             dt = r - t
-            x = x + dt * dxdt
-
+            guided = cfg_steps is None or i < cfg_steps
+            k1 = velocity(x, t, guided=guided)
+            k2 = velocity(x + dt * k1, r, guided=guided)
+            x = x + 0.5 * dt * (k1 + k2)
+        return x
 
-
-        return x.to(in_dtype)
+    def solve_adaptive(self, x, t_span, mu, mask, spks, cond, cfg_steps=None):
+        """
+        Adaptive Bogacki-Shampine 3(2) with first-same-as-last, three estimator calls per accepted step.
+        The first step size is the first interval of `t_span`; the solve stops adapting after
+        `adaptive_max_nfe_ratio * (len(t_span) - 1)` estimator calls and finishes with one euler step.
+        With `cfg_steps`, guidance is on while the step starts before `t_span[cfg_steps]`.
+        """
+        velocity = GuidedVelocity(self, x, mu, mask, spks, cond, t_span=t_span)
+        t, t_end = t_span[0].item(), t_span[-1].item()
+        dt = (t_span[1] - t_span[0]).item()
+        cfg_until = t_span[min(cfg_steps, len(t_span) - 1)].item() if cfg_steps is not None else float("inf")
+        max_nfe = self.adaptive_max_nfe_ratio * (len(t_span) - 1)
+        t_in = lambda v: torch.full((1,), v, device=x.device, dtype=x.dtype)
+
+        guided = t < cfg_until
+        k1 = velocity(x, t_in(t), guided=guided)
+        nfe = 1
+        while t_end - t > 1e-6:
+            dt = min(dt, t_end - t)
+            if guided and t >= cfg_until:
+                # guidance switched off: the FSAL derivative was guided, re-evaluate it unguided
+                guided = False
+                k1 = velocity(x, t_in(t), guided=False)
+                nfe += 1
+            if nfe + 3 > max_nfe:
+                return x + (t_end - t) * k1
+            k2 = velocity(x + 0.5 * dt * k1, t_in(t + 0.5 * dt), guided=guided)
+            k3 = velocity(x + 0.75 * dt * k2, t_in(t + 0.75 * dt), guided=guided)
+            x_new = x + dt * (2 / 9 * k1 + 1 / 3 * k2 + 4 / 9 * k3)
+            k4 = velocity(x_new, t_in(t + dt), guided=guided)
+            nfe += 3
+
+            err = dt * (-5 / 72 * k1 + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * k4)
+            scale = self.adaptive_atol + self.adaptive_rtol * torch.maximum(x.abs(), x_new.abs())
+            err_norm = (err / scale).pow(2).mean().sqrt().item()
+            if err_norm <= 1.0:
+                t, x, k1 = t + dt, x_new, k4
+            dt *= min(5.0, max(0.2, 0.9 * max(err_norm, 1e-10) ** (-1 / 3)))
+        return x
 
     def compute_loss(self, x1, mask, mu, spks=None, cond=None):
         """Computes diffusion loss
@@ -193,7 +310,8 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = None
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, noised_mels=None, meanflow=False,
+                solver=None, cfg_steps=None):
         """Forward diffusion
 
         Args:
@@ -207,6 +325,8 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
             noised_mels: gt mels noised a time t
+            solver: one of `CFM_SOLVERS`, defaults to `cfm_params.solver`. Ignored by meanflow models.
+            cfg_steps: guidance interval, CFG on the first `cfg_steps` steps only (None = all steps)
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
@@ -230,17 +350,23 @@ class CausalConditionalCFM(ConditionalCFM):
         if meanflow:
             return self.basic_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
 
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, meanflow=meanflow), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_steps=cfg_steps), None
 
     def basic_euler(self, x, t_span, mu, mask, spks, cond):
+        # as in `solve_euler`, integrate in the input dtype and only cast the estimator inputs
         in_dtype = x.dtype
-        x, t_span, mu, mask, spks, cond = cast_all(x, t_span, mu, mask, spks, cond, dtype=self.estimator.dtype)
+        est_dtype = self.estimator.dtype
+        mu, mask, spks, cond = cast_all(mu, mask, spks, cond, dtype=est_dtype)
+        kwargs = {}
+        if hasattr(self.estimator, "make_context"):
+            kwargs["ctx"] = self.estimator.make_context(mask, mu, spks, cond, t_span=t_span)
 
         print("S3 Token -> Mel Inference...")
         for t, r in tqdm(zip(t_span[..., :-1], t_span[..., 1:]), total=t_span.shape[-1] - 1):
             t, r = t[None], r[None]
-            dxdt = self.estimator.forward(x, mask=mask, mu=mu, t=t, spks=spks, cond=cond, r=r)
+            x_est, t_est, r_est = cast_all(x, t, r, dtype=est_dtype)
+            dxdt = self.estimator(x_est, mask=mask, mu=mu, t=t_est, spks=spks, cond=cond, r=r_est, **kwargs)
             dt = r - t
-            x = x + dt * dxdt
+            x = x + dt * dxdt.to(in_dtype)
 
-        return x.to(in_dtype)
+        return x
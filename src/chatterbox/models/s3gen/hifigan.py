@@ -24,13 +24,24 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize, remove_weight_norm
 from torch.nn.utils.parametrizations import weight_norm
 from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
 from torch.nn import Parameter
 
 
+def fold_weight_norm(module: nn.Module):
+    "Bake weight norm (parametrization or legacy hook) into a plain `weight`; no-op for other modules"
+    if parametrize.is_parametrized(module, "weight"):
+        parametrize.remove_parametrizations(module, "weight", leave_parametrized=True)
+        return
+    try:
+        remove_weight_norm(module)
+    except ValueError:
+        pass
+
+
 class Snake(nn.Module):
     '''
     Implementation of a sine-based periodic activation function
@@ -69,6 +80,16 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        self.fused = False
+
+    def fuse_for_inference(self):
+        "Precompute alpha and 1 / alpha in the (1, C, 1) layout; forward becomes a single addcmul over sin^2"
+        alpha = self.alpha.detach()
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.register_buffer("alpha_bc", alpha.view(1, -1, 1).clone(), persistent=False)
+        self.register_buffer("inv_alpha_bc", (1.0 / (alpha + self.no_div_by_zero)).view(1, -1, 1), persistent=False)
+        self.fused = True
 
     def forward(self, x):
         '''
@@ -76,6 +97,8 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.fused:
+            return torch.addcmul(x, self.inv_alpha_bc, sin(x * self.alpha_bc).square())
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -162,8 +185,8 @@ class ResBlock(torch.nn.Module):
 
     def remove_weight_norm(self):
         for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+            fold_weight_norm(self.convs1[idx])
+            fold_weight_norm(self.convs2[idx])
 
 
 class SineGen(torch.nn.Module):
@@ -204,6 +227,9 @@ class SineGen(torch.nn.Module):
         :return: [B, 1, sample_len]
         """
 
+        # the phase is a long cumulative sum, always accumulate it in fp32
+        in_dtype = f0.dtype
+        f0 = f0.float()
         F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
         for i in range(self.harmonic_num + 1):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
@@ -228,7 +254,7 @@ class SineGen(torch.nn.Module):
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
         sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        return sine_waves.to(in_dtype), uv.to(in_dtype), noise.to(in_dtype)
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -376,43 +402,71 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # a buffer, so it follows the module's device instead of being copied over on every STFT
+        stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.register_buffer("stft_window", stft_window, persistent=False)
         self.f0_predictor = f0_predictor
+        # optional replacement for `decode_spec`, e.g. an onnxruntime session (see `s3gen/onnx_backend.py`)
+        self.spec_backend = None
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        for m in self.modules():
+            if isinstance(m, (Conv1d, ConvTranspose1d)):
+                fold_weight_norm(m)
+
+    def prepare_for_inference(self):
+        """
+        Irreversibly convert the vocoder for inference: fold weight norm into plain conv weights (including the
+        f0 predictor) so it is not recomputed on every forward, and precompute the Snake alphas. Idempotent.
+
+        Conv1d/ConvTranspose1d already dispatch to oneDNN on CPU and channels-last is only defined for 4D/5D
+        tensors, so the conv layouts are left as they are.
+        """
+        if getattr(self, "prepared_for_inference", False):
+            return self
+        for m in self.modules():
+            if isinstance(m, (Conv1d, ConvTranspose1d)):
+                fold_weight_norm(m)
+            elif isinstance(m, Snake):
+                m.fuse_for_inference()
+        self.prepared_for_inference = True
+        return self
 
     def _stft(self, x):
+        # STFT/ISTFT always run in fp32, whatever the dtype of the surrounding convs
         spec = torch.stft(
-            x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
+            x.float(),
+            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.float(),
             return_complex=True)
-        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+        spec = torch.view_as_real(spec).to(x.dtype)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
 
     def _istft(self, magnitude, phase):
+        magnitude, phase = magnitude.float(), phase.float()
         magnitude = torch.clip(magnitude, max=1e2)
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
+                                        self.istft_params["n_fft"], window=self.stft_window.float())
         return inverse_transform
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        decode_spec = self.spec_backend if self.spec_backend is not None else self.decode_spec
+        magnitude, phase = decode_spec(x, s_stft)
+
+        x = self._istft(magnitude, phase)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    def decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor):
+        """
+        Mel (B, 80, T) and source STFT (B, n_fft + 2, T') -> ISTFT magnitude and phase. This is the part of
+        `decode` without STFT/ISTFT, which is what gets exported to ONNX.
+        """
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
@@ -438,10 +492,7 @@ class HiFTGenerator(nn.Module):
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
-        x = self._istft(magnitude, phase)
-        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
-        return x
+        return magnitude, phase
 
     def forward(
             self,
@@ -472,3 +523,53 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+
+class HiFTStreamer:
+    """
+    Incremental HiFT vocoding of mel chunks with bounded memory.
+
+    Each `push` vocodes the new mel frames plus the last `overlap_frames` frames of the previous call. The source
+    excitation of that overlap is passed back as `cache_source`, so the sine phase continues across the join, and
+    the overlapping audio is crossfaded with a Hamming window. The last `overlap_frames` worth of audio is held
+    back until the next push (or `last=True`). Mel frames can be pushed as soon as they exist, e.g. while the flow
+    is still producing later chunks.
+    """
+
+    def __init__(self, hift: HiFTGenerator, overlap_frames: int = 20):
+        assert overlap_frames > 0
+        self.hift = hift
+        self.overlap_frames = overlap_frames
+        self.hop = int(hift.f0_upsamp.scale_factor)  # output samples per mel frame
+        self.overlap_samples = overlap_frames * self.hop
+        self.window = torch.from_numpy(np.hamming(2 * self.overlap_samples).astype(np.float32))
+        self.pending = None       # mel frames not vocoded yet (B, 80, t)
+        self.mel_cache = None     # overlap mel frames of the previous chunk
+        self.source_cache = None  # their source excitation
+        self.speech_cache = None  # their audio, held back for the crossfade
+
+    @torch.inference_mode()
+    def push(self, mel: torch.Tensor, last: bool = False) -> torch.Tensor:
+        "(B, 80, t) mel frames -> (B, n) audio that is final; empty until enough frames are buffered"
+        self.pending = mel if self.pending is None else torch.cat([self.pending, mel], dim=2)
+        if not last and self.pending.size(2) <= self.overlap_frames:
+            return mel.new_zeros(mel.size(0), 0)
+
+        chunk = self.pending if self.mel_cache is None else torch.cat([self.mel_cache, self.pending], dim=2)
+        self.pending = None
+        cache_source = self.source_cache if self.source_cache is not None else chunk.new_zeros(1, 1, 0)
+        speech, source = self.hift.inference(speech_feat=chunk, cache_source=cache_source)
+
+        if self.speech_cache is not None:
+            n = self.overlap_samples
+            window = self.window.to(speech)
+            speech[:, :n] = speech[:, :n] * window[:n] + self.speech_cache * window[n:]
+
+        if last:
+            self.mel_cache = self.source_cache = self.speech_cache = None
+            return speech
+
+        self.mel_cache = chunk[:, :, -self.overlap_frames:]
+        self.source_cache = source[:, :, -self.overlap_samples:]
+        self.speech_cache = speech[:, -self.overlap_samples:]
+        return speech[:, :-self.overlap_samples]
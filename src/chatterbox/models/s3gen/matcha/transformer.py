@@ -2,6 +2,7 @@ from typing import Any, Dict, Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from diffusers.models.attention import (
     GEGLU,
     GELU,
@@ -134,6 +135,27 @@ class FeedForward(nn.Module):
         return hidden_states
 
 
+class FusedSelfAttnProcessor:
+    r"""
+    Inference-only self-attention processor: one fused QKV projection (`attn.to_qkv`, see
+    `BasicTransformerBlock.fuse_for_inference`) and `F.scaled_dot_product_attention`, with the additive mask
+    broadcast over heads instead of repeated per head as the diffusers processors do.
+    """
+
+    def __call__(self, attn: Attention, hidden_states, encoder_hidden_states=None, attention_mask=None, **kwargs):
+        assert encoder_hidden_states is None, "only self-attention is supported"
+        B, T, _ = hidden_states.shape
+        q, k, v = attn.to_qkv(hidden_states).chunk(3, dim=-1)
+        q, k, v = (a.view(B, T, attn.heads, -1).transpose(1, 2) for a in (q, k, v))
+        if attention_mask is not None:
+            # (B, 1 | T, T) bias -> (B, 1, 1 | T, T)
+            attention_mask = attention_mask.unsqueeze(1).to(q.dtype)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attention_mask, scale=attn.scale)
+        out = out.transpose(1, 2).reshape(B, T, -1)
+        out = attn.to_out[0](out)
+        return attn.to_out[1](out)
+
+
 @maybe_allow_in_graph
 class BasicTransformerBlock(nn.Module):
     r"""
@@ -235,6 +257,28 @@ class BasicTransformerBlock(nn.Module):
         self._chunk_size = None
         self._chunk_dim = 0
 
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """
+        Fuse the self-attention q/k/v projections into a single `to_qkv` linear and switch to
+        `FusedSelfAttnProcessor`. Irreversible, and the state dict layout changes accordingly.
+        """
+        attn = self.attn1
+        assert not self.only_cross_attention and self.attn2 is None, "only plain self-attention blocks can be fused"
+        if hasattr(attn, "to_qkv"):
+            return
+        q, k, v = attn.to_q, attn.to_k, attn.to_v
+        fused = nn.Linear(
+            q.in_features, q.out_features + k.out_features + v.out_features, bias=q.bias is not None,
+            device=q.weight.device, dtype=q.weight.dtype,
+        )
+        fused.weight.copy_(torch.cat([q.weight, k.weight, v.weight]))
+        if q.bias is not None:
+            fused.bias.copy_(torch.cat([q.bias, k.bias, v.bias]))
+        del attn.to_q, attn.to_k, attn.to_v
+        attn.to_qkv = fused
+        attn.set_processor(FusedSelfAttnProcessor())
+
     def set_chunk_feed_forward(self, chunk_size: Optional[int], dim: int):
         # Sets chunk feed-forward
         self._chunk_size = chunk_size
@@ -0,0 +1,191 @@
+"""
+ONNX export and onnxruntime (CPU execution provider) backend for the S3Gen token-to-wave stack.
+
+`export_onnx` writes three graphs with dynamic batch and time axes:
+    - encoder.onnx:     UpsampleConformerEncoder, (xs (B, T, 512), xs_lens (B,)) -> (h (B, 2T, 512), masks (B, 1, 2T))
+    - estimator.onnx:   ConditionalDecoder, (x, mask, mu, t, spks, cond[, r]) -> dxdt (B, 80, T)
+    - hift_decode.onnx: HiFTGenerator.decode_spec, (speech_feat (B, 80, T), s_stft (B, n_fft + 2, T')) -> (magnitude, phase)
+
+The ORT modules below are parameter-free drop-ins for those components; `S3Token2Wav.use_onnx_backend` swaps them
+in. The f0 predictor, source module and STFT/ISTFT stay in torch.
+
+Requires `onnx` for export and `onnxruntime` at runtime (neither is a hard dependency of chatterbox).
+"""
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+
+logger = logging.getLogger(__name__)
+
+ENCODER_FILE = "encoder.onnx"
+ESTIMATOR_FILE = "estimator.onnx"
+HIFT_FILE = "hift_decode.onnx"
+COMPONENTS = ("encoder", "estimator", "hift")
+
+
+def _import_ort():
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError("the ONNX backend needs onnxruntime: pip install onnxruntime") from e
+    return ort
+
+
+def make_session(path, num_threads=None):
+    "onnxruntime CPU session with all graph optimizations and an explicit intra-op thread pool size"
+    ort = _import_ort()
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if num_threads:
+        opts.intra_op_num_threads = num_threads
+        opts.inter_op_num_threads = 1
+    return ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+class _OrtModule(nn.Module):
+    "Parameter-free module wrapping an onnxruntime session; tensors go through numpy on the CPU"
+
+    def __init__(self, path, num_threads=None):
+        super().__init__()
+        self.path = str(path)
+        self.session = make_session(path, num_threads)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def run(self, **inputs):
+        device = next(t for t in inputs.values() if torch.is_tensor(t)).device
+        feeds = {
+            name: inputs[name].detach().cpu().numpy()
+            for name in self.input_names
+        }
+        outs = self.session.run(None, feeds)
+        return [torch.from_numpy(np.ascontiguousarray(o)).to(device) for o in outs]
+
+    def extra_repr(self):
+        return f"onnxruntime: {self.path}"
+
+
+class OrtEncoder(_OrtModule):
+    def __init__(self, path, num_threads=None, output_size=512):
+        super().__init__(path, num_threads)
+        self._output_size = output_size
+
+    def output_size(self):
+        return self._output_size
+
+    def forward(self, xs, xs_lens, decoding_chunk_size=0, num_decoding_left_chunks=-1):
+        h, masks = self.run(xs=xs.float(), xs_lens=xs_lens.long())
+        return h.to(xs.dtype), masks.bool()
+
+
+class OrtEstimator(_OrtModule):
+    # the CFM solvers cast their inputs to `estimator.dtype`
+    dtype = torch.float32
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, r=None):
+        inputs = dict(x=x, mask=mask, mu=mu, t=t, spks=spks, cond=cond)
+        if "r" in self.input_names:
+            inputs["r"] = r
+        return self.run(**{k: v.float() for k, v in inputs.items() if v is not None})[0]
+
+
+class OrtHiFTDecode(_OrtModule):
+    def forward(self, x, s_stft):
+        magnitude, phase = self.run(speech_feat=x.float(), s_stft=s_stft.float())
+        return magnitude, phase
+
+
+class _EncoderExport(nn.Module):
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, xs, xs_lens):
+        return self.encoder(xs, xs_lens)
+
+
+class _EstimatorExport(nn.Module):
+    def __init__(self, estimator, meanflow):
+        super().__init__()
+        self.estimator = estimator
+        self.meanflow = meanflow
+
+    def forward(self, x, mask, mu, t, spks, cond, r=None):
+        return self.estimator(x, mask, mu, t, spks, cond, r=r if self.meanflow else None)
+
+
+class _HiFTExport(nn.Module):
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, speech_feat, s_stft):
+        return self.hift.decode_spec(speech_feat, s_stft)
+
+
+@torch.no_grad()
+def export_onnx(s3gen, out_dir, opset=17, n_tokens=64):
+    """
+    Export the encoder, CFM estimator and HiFT spectral decoder of an fp32 `S3Token2Wav` to `out_dir`.
+    Returns the paths written.
+    """
+    estimator = s3gen.flow.decoder.estimator
+    assert s3gen.estimator_mode in ("fp32", "fused"), "export from an fp32 (or fused fp32) estimator"
+    assert s3gen.dtype == torch.float32 and estimator.dtype == torch.float32, "export from an fp32 model"
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    s3gen = s3gen.cpu().eval()
+    paths = []
+
+    # encoder: token embeddings -> upsampled hidden states
+    T = n_tokens
+    xs = torch.randn(1, T, s3gen.flow.input_size)
+    xs_lens = torch.tensor([T], dtype=torch.long)
+    path = out_dir / ENCODER_FILE
+    torch.onnx.export(
+        _EncoderExport(s3gen.flow.encoder), (xs, xs_lens), str(path), opset_version=opset,
+        input_names=["xs", "xs_lens"], output_names=["h", "masks"],
+        dynamic_axes={"xs": {0: "B", 1: "T"}, "xs_lens": {0: "B"}, "h": {0: "B", 1: "T2"}, "masks": {0: "B", 2: "T2"}},
+    )
+    paths.append(path)
+
+    # estimator: one CFM step (CFG doubles the batch)
+    Tm, B = 2 * T, 2
+    inputs = (
+        torch.randn(B, 80, Tm), torch.ones(B, 1, Tm), torch.randn(B, 80, Tm), torch.rand(B),
+        torch.randn(B, 80), torch.randn(B, 80, Tm),
+    )
+    names = ["x", "mask", "mu", "t", "spks", "cond"]
+    if s3gen.meanflow:
+        inputs = inputs + (torch.rand(B),)
+        names.append("r")
+    axes = {"x": {0: "B", 2: "T"}, "mask": {0: "B", 2: "T"}, "mu": {0: "B", 2: "T"}, "t": {0: "B"},
+            "spks": {0: "B"}, "cond": {0: "B", 2: "T"}, "r": {0: "B"}, "dxdt": {0: "B", 2: "T"}}
+    path = out_dir / ESTIMATOR_FILE
+    torch.onnx.export(
+        _EstimatorExport(estimator, s3gen.meanflow), inputs, str(path), opset_version=opset,
+        input_names=names, output_names=["dxdt"], dynamic_axes={k: v for k, v in axes.items() if k in names + ["dxdt"]},
+    )
+    paths.append(path)
+
+    # HiFT: mel + source STFT -> magnitude / phase
+    hift = s3gen.mel2wav
+    speech_feat = torch.randn(1, 80, Tm)
+    s = torch.zeros(1, 1, Tm * int(hift.f0_upsamp.scale_factor))  # source is at the output sample rate
+    s_stft = torch.cat(hift._stft(s.squeeze(1)), dim=1)
+    path = out_dir / HIFT_FILE
+    torch.onnx.export(
+        _HiFTExport(hift), (speech_feat, s_stft), str(path), opset_version=opset,
+        input_names=["speech_feat", "s_stft"], output_names=["magnitude", "phase"],
+        dynamic_axes={"speech_feat": {0: "B", 2: "T"}, "s_stft": {0: "B", 2: "Ts"},
+                      "magnitude": {0: "B", 2: "Tm"}, "phase": {0: "B", 2: "Tm"}},
+    )
+    paths.append(path)
+
+    for path in paths:
+        logger.info(f"exported {path}")
+    return paths
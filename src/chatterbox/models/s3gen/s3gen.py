@@ -13,45 +13,64 @@
 # limitations under the License.
 
 import logging
+import math
 
 import numpy as np
 import torch
-import torchaudio as ta
-from functools import lru_cache
-from typing import Optional
+from pathlib import Path
+from typing import List, Optional
 
-from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
+from ...audio_frontend import get_resampler
+from ..s3tokenizer import S3_SR, S3_TOKEN_RATE, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
 from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
 from .utils.mel import mel_spectrogram
 from .f0_predictor import ConvRNNF0Predictor
-from .hifigan import HiFTGenerator
+from .hifigan import HiFTGenerator, HiFTStreamer
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
-from .decoder import ConditionalDecoder
+from .decoder import ConditionalDecoder, ESTIMATOR_MODES
 from .configs import CFM_PARAMS
 
+PROMPT_CONTEXT_MODES = ("tail", "informative")
+# log-mel of silence: the floor `mel_spectrogram` clamps magnitudes to before the log
+SILENCE_LOG_MEL = math.log(1e-5)
+
 
 def drop_invalid_tokens(x):
     assert len(x.shape) <= 2 and x.shape[0] == 1, "only batch size of one allowed for now"
     return x[x < SPEECH_VOCAB_SIZE]
 
 
-# TODO: global resampler cache
-@lru_cache(100)
-def get_resampler(src_sr, dst_sr, device):
-    return ta.transforms.Resample(src_sr, dst_sr).to(device)
+def pad_speech_tokens(seqs, device=None):
+    """
+    Drop invalid tokens from each 1-D token sequence and right-pad them into a batch.
+    Returns (tokens (B, L), token_lens (B,)) for `S3Token2Wav.inference(..., speech_token_lens=...)`.
+    """
+    seqs = [torch.as_tensor(s).flatten() for s in seqs]
+    seqs = [s[s < SPEECH_VOCAB_SIZE] for s in seqs]
+    lens = torch.tensor([s.numel() for s in seqs], dtype=torch.long)
+    tokens = torch.zeros(len(seqs), max(int(lens.max()), 1), dtype=torch.long)
+    for i, s in enumerate(seqs):
+        tokens[i, :s.numel()] = s
+    return tokens.to(device), lens.to(device)
 
 
 class S3Token2Mel(torch.nn.Module):
     """
     S3Gen's CFM decoder maps S3 speech tokens to mel-spectrograms.
 
+    `estimator_mode` selects an inference-optimized CFM estimator ("fused", "bf16" or "int8", see
+    `ConditionalDecoder.prepare_for_inference`). It is applied right after `load_state_dict`, so checkpoints
+    keep loading into the regular fp32 layout.
+
     TODO: make these modules configurable?
     """
-    def __init__(self, meanflow=False):
+    def __init__(self, meanflow=False, estimator_mode="fp32"):
         super().__init__()
+        if estimator_mode not in ESTIMATOR_MODES:
+            raise ValueError(f"unknown estimator mode {estimator_mode!r}, expected one of {ESTIMATOR_MODES}")
         self.tokenizer = S3Tokenizer("speech_tokenizer_v2_25hz")
         self.mel_extractor = mel_spectrogram # TODO: make it a torch module?
         self.speaker_encoder = CAMPPlus(
@@ -105,9 +124,18 @@ class S3Token2Mel(torch.nn.Module):
 
         self.resamplers = {}
 
+        self.estimator_mode = estimator_mode
+        if estimator_mode != "fp32":
+            self.register_load_state_dict_post_hook(S3Token2Mel._prepare_estimator)
+
+    @staticmethod
+    def _prepare_estimator(module, incompatible_keys=None):
+        module.flow.decoder.estimator.prepare_for_inference(module.estimator_mode)
+
     @property
     def device(self):
-        params = self.tokenizer.parameters()
+        # the tokenizer may be a `residency.LazyModule` without parameters of its own
+        params = self.flow.parameters()
         return next(params).device
 
     @property
@@ -121,7 +149,12 @@ class S3Token2Mel(torch.nn.Module):
         ref_sr: int,
         device="auto",
         ref_fade_out=True,
+        ref_wav_16: Optional[torch.Tensor] = None,
     ):
+        """
+        Reference conditioning (prompt tokens, prompt mels, x-vector) from `ref_wav` at `ref_sr`. Pass
+        `ref_wav_16`, the same audio at 16 kHz (e.g. `PromptAudio.at(S3_SR)`), to skip resampling it here.
+        """
         device = self.device if device == "auto" else device
         if isinstance(ref_wav, np.ndarray):
             ref_wav = torch.from_numpy(ref_wav).float()
@@ -144,9 +177,12 @@ class S3Token2Mel(torch.nn.Module):
         ref_mels_24_len = None
 
         # Resample to 16kHz
-        ref_wav_16 = ref_wav
-        if ref_sr != S3_SR:
+        if ref_wav_16 is not None:
+            ref_wav_16 = torch.atleast_2d(torch.as_tensor(ref_wav_16)).to(device=device, dtype=torch.float32)
+        elif ref_sr != S3_SR:
             ref_wav_16 = get_resampler(ref_sr, S3_SR, device)(ref_wav)
+        else:
+            ref_wav_16 = ref_wav
 
         # Speaker embedding
         ref_x_vector = self.speaker_encoder.inference(ref_wav_16.to(dtype=self.dtype))
@@ -170,18 +206,83 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def crop_ref_dict(self, ref_dict: dict, seconds: Optional[float], mode="tail"):
+        """
+        Bound the prompt context of the flow to `seconds` of the reference. The encoder and every CFM step run
+        over prompt + generated frames and the prompt frames are discarded afterwards, so flow cost scales with the
+        prompt length. The speaker embedding is kept as-is (it comes from the full reference).
+
+        - "tail": the last `seconds` of the reference, the part the generated speech continues from
+        - "informative": the window with the highest mean log-mel energy, i.e. the one with the least silence
+
+        Returns a new dict; `ref_dict` is returned unchanged if it is already short enough or `seconds` is None.
+        """
+        if mode not in PROMPT_CONTEXT_MODES:
+            raise ValueError(f"unknown prompt context mode {mode!r}, expected one of {PROMPT_CONTEXT_MODES}")
+        n_tok = ref_dict["prompt_token"].size(1)
+        n = int(round(seconds * S3_TOKEN_RATE)) if seconds is not None else n_tok
+        if n <= 0:
+            raise ValueError(f"prompt context must be positive, got {seconds} s")
+        if n >= n_tok:
+            return ref_dict
+
+        r = self.flow.token_mel_ratio
+        feat = ref_dict["prompt_feat"]  # (B, 2 * n_tok, 80)
+        if mode == "tail":
+            start = n_tok - n
+        else:
+            # per-token log-mel energy, then the best window of n tokens via a cumulative sum
+            energy = feat[:, :n_tok * r].float().mean(dim=(0, 2)).view(n_tok, r).mean(dim=1)
+            csum = torch.cat([energy.new_zeros(1), energy.cumsum(0)])
+            start = int(torch.argmax(csum[n:] - csum[:-n]))
+
+        out = dict(ref_dict)
+        out["prompt_token"] = ref_dict["prompt_token"][:, start:start + n]
+        out["prompt_token_len"] = torch.full_like(torch.as_tensor(ref_dict["prompt_token_len"]), n)
+        out["prompt_feat"] = feat[:, start * r:(start + n) * r]
+        if ref_dict.get("prompt_feat_len") is not None:
+            out["prompt_feat_len"] = torch.full_like(torch.as_tensor(ref_dict["prompt_feat_len"]), n * r)
+        return out
+
+    @staticmethod
+    def batch_ref_dicts(ref_dicts):
+        """
+        Merge single-row ref dicts (e.g. one per speaker, optionally cropped with `crop_ref_dict`) into one
+        batched ref dict: prompt tokens and mels are right-padded, lengths and embeddings stacked.
+        """
+        def as_tensor(v):
+            return torch.from_numpy(v) if isinstance(v, np.ndarray) else torch.as_tensor(v)
+
+        tokens = [as_tensor(d["prompt_token"]).reshape(-1) for d in ref_dicts]
+        lens = [int(as_tensor(d["prompt_token_len"]).reshape(-1)[0]) for d in ref_dicts]
+        feats = [as_tensor(d["prompt_feat"]).reshape(-1, as_tensor(d["prompt_feat"]).size(-1)) for d in ref_dicts]
+        prompt_token = tokens[0].new_zeros(len(tokens), max(t.numel() for t in tokens))
+        prompt_feat = feats[0].new_zeros(len(feats), max(f.size(0) for f in feats), feats[0].size(1))
+        for i, (t, f) in enumerate(zip(tokens, feats)):
+            prompt_token[i, :t.numel()] = t
+            prompt_feat[i, :f.size(0)] = f
+        return dict(
+            prompt_token=prompt_token,
+            prompt_token_len=torch.tensor(lens),
+            prompt_feat=prompt_feat,
+            prompt_feat_len=torch.tensor([f.size(0) for f in feats]),
+            embedding=torch.cat([torch.atleast_2d(as_tensor(d["embedding"])) for d in ref_dicts]),
+        )
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
         # locally-computed ref embedding (mutex with ref_dict)
         ref_wav: Optional[torch.Tensor],
         ref_sr: Optional[int],
-        # pre-computed ref embedding (prod API)
+        # pre-computed ref embedding (prod API), or a list of them (one per row)
         ref_dict: Optional[dict] = None,
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
         noised_mels=None,
+        cfm_solver=None,
+        cfm_cfg_steps=None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -190,20 +291,25 @@ class S3Token2Mel(torch.nn.Module):
         - The speaker encoder accepts 16 kHz waveform.
         - S3TokenizerV2 accepts 16 kHz waveform.
         - The mel-spectrogram for the reference assumes 24 kHz input signal.
-        - This function is designed for batch_size=1 only.
+        - `ref_wav` is batch_size=1 only; padded token batches need `ref_dict` plus `speech_token_lens`.
 
         Args
         ----
-        - `speech_tokens`: S3 speech tokens [B=1, T]
+        - `speech_tokens`: S3 speech tokens [B, T], right-padded when B > 1
+        - `ref_dict`: one ref dict shared by all rows, or a list of B ref dicts (see `batch_ref_dicts`)
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_cfm_timesteps`, `cfm_solver`: number of CFM steps and ODE solver (see `flow_matching.CFM_SOLVERS`)
+        - `cfm_cfg_steps`: CFG guidance interval, guidance on the first k CFM steps only (None = all steps)
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
+            if isinstance(ref_dict, (list, tuple)):
+                ref_dict = self.batch_ref_dicts(ref_dict)
             # type/device casting (all values will be numpy if it's from a prod API call)
             for rk in list(ref_dict):
                 if isinstance(ref_dict[rk], np.ndarray):
@@ -224,6 +330,8 @@ class S3Token2Mel(torch.nn.Module):
             noised_mels=noised_mels,
             n_timesteps=n_cfm_timesteps,
             meanflow=self.meanflow,
+            solver=cfm_solver,
+            cfg_steps=cfm_cfg_steps,
             **ref_dict,
         )
         return output_mels
@@ -238,8 +346,8 @@ class S3Token2Wav(S3Token2Mel):
 
     ignore_state_dict_missing = ("tokenizer._mel_filters", "tokenizer.window")
 
-    def __init__(self, meanflow=False):
-        super().__init__(meanflow)
+    def __init__(self, meanflow=False, estimator_mode="fp32"):
+        super().__init__(meanflow, estimator_mode)
 
         f0_predictor = ConvRNNF0Predictor()
         self.mel2wav = HiFTGenerator(
@@ -297,6 +405,27 @@ class S3Token2Wav(S3Token2Mel):
 
         return output_wavs
 
+    def use_onnx_backend(self, onnx_dir, num_threads=None, components=("encoder", "estimator", "hift")):
+        """
+        Run the selected components with onnxruntime (CPU) from graphs written by `onnx_backend.export_onnx`.
+        The replaced flow encoder and estimator are dropped, so this is irreversible for this instance. HiFT keeps
+        its torch module (the F0 predictor, source module and STFT still run in torch) and only routes
+        `decode_spec` to onnxruntime, so its decoder weights stay resident.
+        """
+        from .onnx_backend import COMPONENTS, ENCODER_FILE, ESTIMATOR_FILE, HIFT_FILE, OrtEncoder, OrtEstimator, OrtHiFTDecode
+
+        unknown = set(components) - set(COMPONENTS)
+        if unknown:
+            raise ValueError(f"unknown ONNX components {sorted(unknown)}, expected a subset of {COMPONENTS}")
+        onnx_dir = Path(onnx_dir)
+        if "encoder" in components:
+            self.flow.encoder = OrtEncoder(onnx_dir / ENCODER_FILE, num_threads, self.flow.encoder.output_size())
+        if "estimator" in components:
+            self.flow.decoder.estimator = OrtEstimator(onnx_dir / ESTIMATOR_FILE, num_threads)
+        if "hift" in components:
+            self.mel2wav.spec_backend = OrtHiFTDecode(onnx_dir / HIFT_FILE, num_threads)
+        return self
+
     @torch.inference_mode()
     def flow_inference(
         self,
@@ -309,14 +438,18 @@ class S3Token2Wav(S3Token2Mel):
         n_cfm_timesteps = None,
         finalize: bool = False,
         speech_token_lens=None,
+        cfm_solver=None,
+        cfm_cfg_steps=None,
     ):
         n_cfm_timesteps = n_cfm_timesteps or (2 if self.meanflow else 10)
         noise = None
         if self.meanflow:
-            noise = torch.randn(1, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
+            B = torch.atleast_2d(speech_tokens).size(0)
+            noise = torch.randn(B, 80, speech_tokens.size(-1) * 2, dtype=self.dtype, device=self.device)
         output_mels = super().forward(
             speech_tokens, speech_token_lens=speech_token_lens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict,
-            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise,
+            n_cfm_timesteps=n_cfm_timesteps, finalize=finalize, noised_mels=noise, cfm_solver=cfm_solver,
+            cfm_cfg_steps=cfm_cfg_steps,
         )
         return output_mels
 
@@ -326,6 +459,62 @@ class S3Token2Wav(S3Token2Mel):
             cache_source = torch.zeros(1, 1, 0).to(device=self.device, dtype=self.dtype)
         return self.mel2wav.inference(speech_feat=speech_feat, cache_source=cache_source)
 
+    def hift_inference_chunked(self, speech_feat, chunk_frames=200, overlap_frames=20):
+        """
+        Vocode (B, 80, T) mels in windows of `chunk_frames` with `overlap_frames` of context, source caching and
+        crossfaded joins (see `HiFTStreamer`). Yields (B, n) audio chunks; peak memory depends on the window, not T.
+        """
+        if chunk_frames <= overlap_frames:
+            raise ValueError(f"chunk_frames ({chunk_frames}) must be larger than overlap_frames ({overlap_frames})")
+        streamer = HiFTStreamer(self.mel2wav, overlap_frames)
+        T = speech_feat.size(2)
+        for start in range(0, T, chunk_frames):
+            yield streamer.push(speech_feat[:, :, start:start + chunk_frames], last=start + chunk_frames >= T)
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        speech_tokens,
+        ref_dict: dict,
+        chunk_tokens=100,
+        context_tokens=10,
+        overlap_frames=20,
+        n_cfm_timesteps=None,
+        cfm_solver=None,
+        cfm_cfg_steps=None,
+    ):
+        """
+        Generator version of `inference` for one utterance: the flow runs over windows of `chunk_tokens` tokens
+        (25 per second) with `context_tokens` of context on each side, and each window's mels go straight to a
+        `HiFTStreamer`, so audio for the first window is yielded before the flow has seen the rest. The flow is
+        non-causal, so window joins are only as good as the context; a window covering all tokens matches
+        `inference(..., vocoder_chunk_frames=...)`. Yields (1, n) audio chunks.
+        """
+        if chunk_tokens <= 0:
+            raise ValueError(f"chunk_tokens must be positive, got {chunk_tokens}")
+        speech_tokens = torch.atleast_2d(speech_tokens)
+        T = speech_tokens.size(1)
+        ratio = self.flow.token_mel_ratio
+        streamer = HiFTStreamer(self.mel2wav, overlap_frames)
+        vocoder_dtype = next(self.mel2wav.parameters()).dtype
+        emitted = 0
+        for start in range(0, T, chunk_tokens):
+            end = min(T, start + chunk_tokens)
+            lo, hi = max(0, start - context_tokens), min(T, end + context_tokens)
+            mels = self.flow_inference(
+                speech_tokens[:, lo:hi], ref_dict=ref_dict, n_cfm_timesteps=n_cfm_timesteps, finalize=True,
+                cfm_solver=cfm_solver, cfm_cfg_steps=cfm_cfg_steps,
+            )
+            mels = mels[:, :, (start - lo) * ratio:(end - lo) * ratio].to(dtype=vocoder_dtype)
+            wav = streamer.push(mels, last=end >= T)
+            if emitted < len(self.trim_fade) and wav.size(1) > 0:
+                # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+                n = min(wav.size(1), len(self.trim_fade) - emitted)
+                wav[:, :n] *= self.trim_fade[emitted:emitted + n].to(wav)
+            emitted += wav.size(1)
+            if wav.size(1) > 0:
+                yield wav
+
     @torch.inference_mode()
     def inference(
         self,
@@ -339,7 +528,23 @@ class S3Token2Wav(S3Token2Mel):
         drop_invalid_tokens=True,
         n_cfm_timesteps=None,
         speech_token_lens=None,
+        cfm_solver=None,
+        cfm_cfg_steps=None,
+        vocoder_chunk_frames=None,
     ):
+        """
+        `cfm_cfg_steps` sets the CFG guidance interval: guidance on the first k of `n_cfm_timesteps` flow steps,
+        the rest run the estimator on the conditional half of the batch only.
+
+        `vocoder_chunk_frames` vocodes the mels in windows of that many frames (50 per second) instead of in one
+        shot, which keeps vocoder memory flat on long inputs (see `hift_inference_chunked`); the flow still finishes
+        first, `inference_stream` also windows the flow so vocoding starts early.
+
+        A right-padded (B, T) batch with `speech_token_lens` runs as one masked flow solve and one vocoder pass.
+        Mel frames past each row's length are set to silence before HiFT, so the end of a short row is vocoded
+        like a single utterance followed by silence, and samples past its length are zeroed. Use
+        `inference_batch` to get per-row trimmed waveforms.
+        """
         # hallucination prevention, drop special tokens
         # if drop_invalid_tokens:
         #     speech_tokens, speech_token_lens = drop_invalid(speech_tokens, pad=S3_QUIET_PAD)
@@ -352,11 +557,49 @@ class S3Token2Wav(S3Token2Mel):
             ref_dict=ref_dict,
             n_cfm_timesteps=n_cfm_timesteps,
             finalize=True,
+            cfm_solver=cfm_solver,
+            cfm_cfg_steps=cfm_cfg_steps,
         )
-        output_mels = output_mels.to(dtype=self.dtype) # FIXME (fp16 mode) is this still needed?
-        output_wavs, output_sources = self.hift_inference(output_mels, None)
+        # the estimator may run in another dtype (bf16 mode), hand the vocoder mels in its own dtype
+        output_mels = output_mels.to(dtype=next(self.mel2wav.parameters()).dtype)
+        if speech_token_lens is not None and output_mels.size(0) > 1:
+            # the flow leaves noise (or zeros, a loud log-mel) in the padding; HiFT's convolutions would see it
+            mel_lens = torch.as_tensor(speech_token_lens, device=output_mels.device).long() * self.flow.token_mel_ratio
+            pad = torch.arange(output_mels.size(2), device=output_mels.device)[None] >= mel_lens[:, None]
+            output_mels = output_mels.masked_fill(pad[:, None, :], SILENCE_LOG_MEL)
+        if vocoder_chunk_frames:
+            # no chunks for zero speech tokens
+            chunks = list(self.hift_inference_chunked(output_mels, vocoder_chunk_frames))
+            output_wavs = torch.cat(chunks, dim=1) if chunks else output_mels.new_zeros(output_mels.size(0), 0)
+            output_sources = None
+        else:
+            output_wavs, output_sources = self.hift_inference(output_mels, None)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
-        output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+        n = min(output_wavs.size(1), len(self.trim_fade))
+        output_wavs[:, :n] *= self.trim_fade[:n].to(output_wavs)
+
+        if speech_token_lens is not None and output_wavs.size(0) > 1:
+            wav_lens = self.wav_lens(speech_token_lens).to(output_wavs.device)
+            pad = torch.arange(output_wavs.size(1), device=output_wavs.device)[None] >= wav_lens[:, None]
+            output_wavs = output_wavs.masked_fill(pad, 0)
 
         return output_wavs, output_sources
+
+    def wav_lens(self, speech_token_lens):
+        "Number of output samples for each row's token count."
+        samples_per_frame = int(self.mel2wav.f0_upsamp.scale_factor)
+        return torch.as_tensor(speech_token_lens).long() * self.flow.token_mel_ratio * samples_per_frame
+
+    def inference_batch(self, speech_tokens, ref_dict, speech_token_lens=None, **kwargs) -> List[torch.Tensor]:
+        """
+        Batched `inference`: `speech_tokens` is a list of 1-D token sequences (invalid tokens are dropped) or a
+        right-padded (B, T) tensor with `speech_token_lens`; `ref_dict` is shared or a list with one per row.
+        Returns a list of B (1, n_i) waveforms trimmed to each row's length.
+        """
+        if isinstance(speech_tokens, (list, tuple)):
+            speech_tokens, speech_token_lens = pad_speech_tokens(speech_tokens, device=self.device)
+        elif speech_token_lens is None:
+            raise ValueError("speech_token_lens is required with a padded speech_tokens tensor")
+        wavs, _ = self.inference(speech_tokens, ref_dict=ref_dict, speech_token_lens=speech_token_lens, **kwargs)
+        return [wav[None, :n] for wav, n in zip(wavs, self.wav_lens(speech_token_lens).tolist())]
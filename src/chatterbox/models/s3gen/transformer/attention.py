@@ -17,9 +17,10 @@
 """Multi-Head Attention layer definition."""
 
 import math
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 
 
@@ -31,8 +32,14 @@ class MultiHeadedAttention(nn.Module):
         n_feat (int): The number of features.
         dropout_rate (float): Dropout rate.
 
+    In eval mode the attention runs through `F.scaled_dot_product_attention`
+    (see `forward_attention_sdpa`); set `use_sdpa = False` for the explicit
+    masked_fill/softmax/matmul path.
+
     """
 
+    use_sdpa = True
+
     def __init__(self,
                  n_head: int,
                  n_feat: int,
@@ -126,6 +133,47 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def forward_attention_sdpa(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+        bias: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """`forward_attention` with fused scaled dot product attention.
+
+        Computes softmax(q k^T / sqrt(d_k) + bias) v with `bias` and the
+        mask folded into one additive float mask. Masked keys get the dtype's
+        most negative value instead of -inf, so a fully masked query row
+        averages its values instead of returning zeros (padding rows only).
+
+        Args:
+            q (torch.Tensor): Query (#batch, n_head, time1, d_k).
+            k (torch.Tensor): Key (#batch, n_head, time2, d_k).
+            v (torch.Tensor): Value (#batch, n_head, time2, d_k).
+            mask (torch.Tensor): Mask, size (#batch, 1, time2) or
+                (#batch, time1, time2), (0, 0, 0) means fake mask.
+            bias (torch.Tensor): Additive score bias, already scaled,
+                broadcastable to (#batch, n_head, time1, time2).
+
+        Returns:
+            torch.Tensor: Output tensor (#batch, time1, d_model).
+
+        """
+        attn_mask = bias
+        if mask.size(2) > 0:  # time2 > 0
+            mask = mask.unsqueeze(1)[:, :, :, :k.size(2)]  # (batch, 1, *, time2)
+            if attn_mask is None:
+                attn_mask = torch.zeros(mask.shape, dtype=q.dtype, device=q.device)
+            attn_mask = attn_mask.masked_fill(~mask, torch.finfo(q.dtype).min)
+        x = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask,
+            dropout_p=self.dropout.p if self.training else 0.0,
+        )  # (batch, head, time1, d_k)
+        x = x.transpose(1, 2).reshape(q.size(0), -1, self.h * self.d_k)
+        return self.linear_out(x)  # (batch, time1, d_model)
+
     def forward(
         self,
         query: torch.Tensor,
@@ -193,6 +241,8 @@ class MultiHeadedAttention(nn.Module):
         #   non-trivial to calculate `next_cache_start` here.
         new_cache = torch.cat((k, v), dim=-1)
 
+        if self.use_sdpa and not self.training:
+            return self.forward_attention_sdpa(q, k, v, mask), new_cache
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
 
@@ -311,6 +361,14 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # (batch, head, time1, d_k)
         q_with_bias_v = (q + self.pos_bias_v.to(q.device)).transpose(1, 2)
 
+        if self.use_sdpa and not self.training:
+            # the positional term (matrix bd) becomes an additive mask, SDPA computes matrix ac
+            matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
+            if matrix_bd.size(-1) != k.size(2):
+                matrix_bd = self.rel_shift(matrix_bd)
+            bias = matrix_bd / math.sqrt(self.d_k)
+            return self.forward_attention_sdpa(q_with_bias_u, k, v, mask, bias), new_cache
+
         # compute attention score
         # first compute matrix a and matrix c
         # as described in https://arxiv.org/abs/1901.02860 Section 3.3
@@ -4,7 +4,6 @@ import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
@@ -22,7 +21,7 @@ SPEECH_VOCAB_SIZE = 6561
 class S3Tokenizer(S3TokenizerV2):
     """
     s3tokenizer.S3TokenizerV2 with the following changes:
-    - a more integrated `forward`
+    - a more integrated, batched `forward`
     - compute `log_mel_spectrogram` using `_mel_filters` and `window` in `register_buffers`
     """
 
@@ -96,24 +95,20 @@ class S3Tokenizer(S3TokenizerV2):
     ) -> Tuple[torch.Tensor, torch.LongTensor]:
         """
         NOTE: mel-spec has a hop size of 160 points (100 frame/sec).
-        FIXME: this class inherits `nn.Module` but doesn't accept `torch.Tensor` and handles a list of wavs one by one, which is unexpected.
+
+        The wavs are padded once and go through a single batched STFT / mel projection (`log_mel_spectrogram_batch`)
+        and one `quantize` call, so tokenizing many files costs one pass instead of one per file.
 
         Args
         ----
-        - `wavs`: 16 kHz speech audio
+        - `wavs`: list of 16 kHz speech audio, each (T,) or (1, T)
         - `max_len` max length to truncate the output sequence to (25 token/sec).
         NOTE: please pad the waveform if longer sequence is needed.
         """
-        processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        mels, mel_lens = self.log_mel_spectrogram_batch(self._prepare_audio(wavs))
+        if max_len is not None:
+            mels = mels[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
+            mel_lens = mel_lens.clamp(max=max_len * 4)
         if accelerator is None:
             tokenizer = self
         else:
@@ -150,19 +145,50 @@ class S3Tokenizer(S3TokenizerV2):
         if not torch.is_tensor(audio):
             audio = torch.from_numpy(audio)
 
+        # `window` and `_mel_filters` are buffers, they already follow the module's device
         audio = audio.to(self.device)
         if padding > 0:
             audio = F.pad(audio, (0, padding))
         stft = torch.stft(
             audio, self.n_fft, S3_HOP,
-            window=self.window.to(self.device),
+            window=self.window,
             return_complex=True
         )
         magnitudes = stft[..., :-1].abs()**2
 
-        mel_spec = self._mel_filters.to(self.device) @ magnitudes
+        mel_spec = self._mel_filters @ magnitudes
 
         log_spec = torch.clamp(mel_spec, min=1e-10).log10()
         log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
         log_spec = (log_spec + 4.0) / 4.0
         return log_spec
+
+    def log_mel_spectrogram_batch(self, wavs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """
+        Batched `log_mel_spectrogram` of a list of (1, T) or (T,) 16 kHz wavs.
+
+        Each wav gets the same reflect padding `torch.stft(center=True)` would apply to it alone before the batch
+        is zero-padded to the longest one, and the max normalization is taken per row over its own frames, so
+        every row matches the single-wav result. Padded frames are zeros, like `s3tokenizer.utils.padding`.
+
+        Returns (mels (B, n_mels, T_max), mel_lens (B,)).
+        """
+        half = self.n_fft // 2
+        rows = [w.reshape(1, 1, -1).to(device=self.device, dtype=torch.float32) for w in wavs]
+        mel_lens = torch.tensor([r.size(-1) // S3_HOP for r in rows], device=self.device)
+        rows = [F.pad(r, (half, half), mode="reflect").reshape(-1) for r in rows]
+        audio = torch.zeros(len(rows), max(r.numel() for r in rows), device=self.device)
+        for i, r in enumerate(rows):
+            audio[i, :r.numel()] = r
+
+        stft = torch.stft(audio, self.n_fft, S3_HOP, window=self.window, center=False, return_complex=True)
+        T = int(mel_lens.max())
+        magnitudes = stft[..., :T].abs()**2
+        mel_spec = self._mel_filters @ magnitudes  # (B, n_mels, T)
+
+        valid = (torch.arange(T, device=self.device)[None] < mel_lens[:, None])[:, None]  # (B, 1, T)
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        row_max = log_spec.masked_fill(~valid, float("-inf")).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, row_max - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec.masked_fill(~valid, 0.0), mel_lens
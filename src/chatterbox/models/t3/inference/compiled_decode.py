@@ -0,0 +1,165 @@
+"""
+Opt-in `torch.compile`d per-token decode step for T3.
+
+Llama backbones decode into a transformers `StaticCache` whose length is rounded up to a multiple of `bucket`,
+so the per-token step always sees the same shapes and compiles once per bucket. GPT2 backbones (turbo) have no
+static cache support and compile the step with dynamic shapes instead. The prefill has a variable length and
+always runs eagerly.
+
+Compiled artifacts go to `<cache_dir>/t3-<weights hash>-<dtype>-torch<version>`, so later process starts with the
+same weights, dtype and torch build reuse them instead of recompiling.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+import torch
+from transformers import StaticCache
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chatterbox", "compile")
+
+
+def weights_fingerprint(module: torch.nn.Module) -> str:
+    "Cheap content hash of a module's weights: names, shapes, dtypes and a strided sample of every tensor"
+    h = hashlib.sha256()
+    for name, t in module.state_dict().items():
+        h.update(name.encode())
+        if not torch.is_tensor(t):
+            continue
+        h.update(f"{tuple(t.shape)}:{t.dtype}".encode())
+        if t.numel():
+            flat = t.detach().reshape(-1)
+            sample = flat[::max(1, flat.numel() // 1024)][:1024]
+            h.update(sample.float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+class DecodeSession:
+    "KV cache and position of one generation; `close()` returns a static cache to the decoder's pool"
+
+    def __init__(self, decoder: 'CompiledDecoder', past, pos: int, pool_key=None):
+        self.decoder = decoder
+        self.past = past
+        self.pos = pos
+        self.pool_key = pool_key
+
+    def step(self, embeds: torch.Tensor) -> torch.Tensor:
+        "(B, 1, dim) embeds of the last sampled token -> (B, vocab) speech logits of the next one"
+        logits, self.past = self.decoder.compiled_step(embeds, self.pos, self.past, self.pool_key)
+        self.pos += 1
+        return logits
+
+    def close(self):
+        if self.pool_key is not None:
+            self.decoder.release(self.pool_key, self.past)
+        self.past = None
+
+
+class CompiledDecoder:
+    def __init__(self, t3, cache_dir=None, bucket=512, max_buckets=8):
+        self.t3 = t3
+        self.static = not t3.is_gpt
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self._pool = {}
+        self._compiled_keys = set()
+
+        cache_root = cache_dir or os.environ.get("CHATTERBOX_COMPILE_CACHE", DEFAULT_CACHE_DIR)
+        dtype = str(t3.dtype).replace("torch.", "")
+        version = torch.__version__.replace("+", "_")
+        self.artifact_dir = os.path.join(cache_root, f"t3-{weights_fingerprint(t3)[:16]}-{dtype}-torch{version}")
+        os.makedirs(self.artifact_dir, exist_ok=True)
+
+        # inductor reads its cache location lazily, so this only needs to happen before the first compile
+        if "TORCHINDUCTOR_CACHE_DIR" in os.environ:
+            logger.info(f"TORCHINDUCTOR_CACHE_DIR is set, not redirecting it to {self.artifact_dir}")
+        else:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.artifact_dir
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+        # every bucket is a separate graph; beyond `max_buckets` dynamo falls back to eager instead of recompiling
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, max_buckets)
+        self._load_artifacts()
+
+        self._step = torch.compile(self._forward, dynamic=not self.static)
+
+    @property
+    def _artifacts_path(self):
+        return os.path.join(self.artifact_dir, "artifacts.bin")
+
+    def _load_artifacts(self):
+        if not (hasattr(torch.compiler, "load_cache_artifacts") and os.path.exists(self._artifacts_path)):
+            return
+        try:
+            with open(self._artifacts_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            logger.info(f"Loaded compiled T3 artifacts from {self.artifact_dir}")
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable compile artifacts in {self.artifact_dir}: {e}")
+
+    def _save_artifacts(self):
+        if not hasattr(torch.compiler, "save_cache_artifacts"):
+            return  # older torch: the inductor FX graph cache in `artifact_dir` still applies
+        out = torch.compiler.save_cache_artifacts()
+        if out is None:
+            return
+        tmp = self._artifacts_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(out[0])
+        os.replace(tmp, self._artifacts_path)
+
+    def _forward(self, embeds, cache_position, past):
+        kwargs = dict(cache_position=cache_position) if self.static else {}
+        out = self.t3.tfmr(inputs_embeds=embeds, past_key_values=past, use_cache=True, return_dict=True, **kwargs)
+        return self.t3.speech_head(out.last_hidden_state[:, -1]), out.past_key_values
+
+    def prefill(self, embeds: torch.Tensor, max_new_tokens: int):
+        "Run the (B, L, dim) prompt eagerly, returns the (B, vocab) logits and a `DecodeSession`"
+        B, L, _ = embeds.shape
+        past, pool_key, cache_position = None, None, None
+        if self.static:
+            size = -(-(L + max_new_tokens + 1) // self.bucket) * self.bucket
+            pool_key = (B, size, embeds.dtype, embeds.device)
+            past = self.acquire(pool_key)
+            cache_position = torch.arange(L, device=embeds.device)
+        logits, past = self._forward(embeds, cache_position, past)
+        return logits, DecodeSession(self, past, L, pool_key)
+
+    def compiled_step(self, embeds, pos, past, pool_key):
+        cache_position = torch.tensor([pos], device=embeds.device) if self.static else None
+        key = pool_key or "dynamic"
+        if key in self._compiled_keys:
+            return self._step(embeds, cache_position, past)
+
+        # first step of a new shape: compile under the lock so concurrent sessions don't compile twice
+        with self.lock:
+            try:
+                out = self._step(embeds, cache_position, past)
+            except Exception as e:
+                logger.warning(f"Compiled T3 decode step failed, falling back to eager: {e}")
+                self._step = self._forward
+                out = self._forward(embeds, cache_position, past)
+            self._compiled_keys.add(key)
+            try:
+                self._save_artifacts()
+            except Exception as e:
+                logger.warning(f"Could not save compiled T3 artifacts: {e}")
+        return out
+
+    def acquire(self, key):
+        with self.lock:
+            free = self._pool.get(key)
+            if free:
+                cache = free.pop()
+                cache.reset()
+                return cache
+        B, size, dtype, device = key
+        return StaticCache(self.t3.cfg, B, size, device, dtype)
+
+    def release(self, key, cache):
+        with self.lock:
+            self._pool.setdefault(key, []).append(cache)
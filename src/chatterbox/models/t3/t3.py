@@ -1,6 +1,8 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
+import dataclasses
 import logging
+import threading
 from typing import Union, Optional, List
 
 logger = logging.getLogger(__name__)
@@ -25,7 +27,9 @@ from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
 from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.compiled_decode import CompiledDecoder
 from ..utils import AttrDict
+from ..quantization import QUANT_MODES, quantize_linears, quantize_embeddings
 
 
 logger = logging.getLogger(__name__)
@@ -85,15 +89,54 @@ class T3(nn.Module):
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=self.is_gpt)
         self.compiled = False
+        self.compile_lock = threading.Lock()
+        self.decoder = None  # optional `CompiledDecoder`, see `enable_compiled_decode`
+        self.quantized = None
 
     @property
     def device(self):
-        return self.speech_head.weight.device
+        # NOTE: `speech_head` may be swapped for a quantized module without a `.weight` tensor
+        return self.text_emb.weight.device
+
+    @property
+    def dtype(self):
+        return self.text_emb.weight.dtype
+
+    def quantize(self, mode: str = "int8"):
+        """
+        Quantize the backbone, `speech_head` and `speech_emb` for CPU inference (see `models/quantization.py`
+        for the available modes). This is irreversible; the text head and conditioning encoder stay in float.
+        """
+        if mode not in QUANT_MODES:
+            raise ValueError(f"Unsupported quantization mode {mode!r}, expected one of {QUANT_MODES}")
+        assert self.quantized is None, f"T3 is already quantized ({self.quantized})"
+        assert self.decoder is None, "quantize before `enable_compiled_decode`"
+        if mode == "int8" and self.dtype != torch.float32:
+            raise ValueError(f"dynamic int8 needs fp32 activations, use 'int8_weight_only' with {self.dtype}")
+        quantize_linears(self, ["tfmr", "speech_head"], mode)
+        quantize_embeddings(self, ["speech_emb"])
+        self.quantized = mode
+        self.compiled = False
+        return self
+
+    def enable_compiled_decode(self, cache_dir=None):
+        """
+        Opt in to a `torch.compile`d per-token decode step for `inference` / `inference_turbo` (see
+        `inference/compiled_decode.py`). Artifacts are cached on disk under `cache_dir`, keyed by the weights,
+        dtype and torch version. Call after `quantize` / dtype casts. Multilingual generations, which need
+        attention maps for the alignment analyzer, keep decoding eagerly.
+        """
+        with self.compile_lock:
+            self.decoder = CompiledDecoder(self, cache_dir=cache_dir)
+        return self
 
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
         """
+        if t3_cond.speaker_emb.dtype != self.dtype:
+            # cast a copy, the caller's conditionals stay in their own dtype
+            t3_cond = dataclasses.replace(t3_cond).to(dtype=self.dtype)
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
             t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens)
             if not self.is_gpt:
@@ -270,32 +313,34 @@ class T3(nn.Module):
         # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
         # Note the llama-specific logic. Other tfmr types can be added later.
 
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            # Default to None for English models, only create for multilingual
-            alignment_stream_analyzer = None
-            if self.hp.is_multilingual:
-                alignment_stream_analyzer = AlignmentStreamAnalyzer(
-                    self.tfmr,
-                    None,
-                    text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
-                    alignment_layer_idx=9, # TODO: hparam or something?
-                    eos_idx=self.hp.stop_speech_token,
+        # the alignment analyzer tracks per-utterance state, so multilingual models rebuild the backend every call
+        if self.hp.is_multilingual:
+            self.compiled = False
+
+        with self.compile_lock:
+            if not self.compiled:
+                # Default to None for English models, only create for multilingual
+                alignment_stream_analyzer = None
+                if self.hp.is_multilingual:
+                    alignment_stream_analyzer = AlignmentStreamAnalyzer(
+                        self.tfmr,
+                        None,
+                        text_tokens_slice=(len_cond, len_cond + text_tokens.size(-1)),
+                        alignment_layer_idx=9, # TODO: hparam or something?
+                        eos_idx=self.hp.stop_speech_token,
+                    )
+                    assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
+
+                patched_model = T3HuggingfaceBackend(
+                    config=self.cfg,
+                    llama=self.tfmr,
+                    speech_enc=self.speech_emb,
+                    speech_head=self.speech_head,
+                    alignment_stream_analyzer=alignment_stream_analyzer,
                 )
-                assert alignment_stream_analyzer.eos_idx == self.hp.stop_speech_token
-
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=alignment_stream_analyzer,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
+                self.patched_model = patched_model
+                self.compiled = True
+            patched_model = self.patched_model
 
         # # Run normal generate method, which calls our custom extended methods
         # return self.patched_model.generate(
@@ -336,21 +381,29 @@ class T3(nn.Module):
         top_p_warper = TopPLogitsWarper(top_p=top_p)
         repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
 
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+
         # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
-        )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
+        # The compiled decoder can't hand out attention maps, so it's skipped when the alignment analyzer is active
+        session = None
+        if self.decoder is not None and patched_model.alignment_stream_analyzer is None:
+            last_logits, session = self.decoder.prefill(inputs_embeds, max_new_tokens)
+        else:
+            output = patched_model(
+                inputs_embeds=inputs_embeds,
+                past_key_values=None,
+                use_cache=True,
+                output_attentions=True,
+                output_hidden_states=True,
+                return_dict=True,
+            )
+            # Initialize kv_cache with the full context.
+            past = output.past_key_values
+            last_logits = output.logits[:, -1, :]
 
         # ---- Generation Loop using kv_cache ----
         for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits_step = output.logits[:, -1, :]
+            logits_step = last_logits.float()  # sample in fp32 (bf16 mode)
             # CFG combine  → (1, V)
             cond   = logits_step[0:1, :]
             uncond = logits_step[1:2, :]
@@ -358,12 +411,12 @@ class T3(nn.Module):
             logits = cond + cfg * (cond - uncond)
             
             # Apply alignment stream analyzer integrity checks
-            if self.patched_model.alignment_stream_analyzer is not None:
+            if patched_model.alignment_stream_analyzer is not None:
                 if logits.dim() == 1:            # guard in case something upstream squeezed
                     logits = logits.unsqueeze(0) # (1, V)
                 # Pass the last generated token for repetition tracking
                 last_token = generated_ids[0, -1].item() if len(generated_ids[0]) > 0 else None
-                logits = self.patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
+                logits = patched_model.alignment_stream_analyzer.step(logits, next_token=last_token)  # (1, V)
 
             # Apply repetition penalty
             ids_for_proc = generated_ids[:1, ...]   # batch = 1
@@ -397,7 +450,10 @@ class T3(nn.Module):
             next_token_embed = torch.cat([next_token_embed, next_token_embed])
 
             # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
+            if session is not None:
+                last_logits = session.step(next_token_embed)
+                continue
+            output = patched_model(
                 inputs_embeds=next_token_embed,
                 past_key_values=past,
                 output_attentions=True,
@@ -406,11 +462,119 @@ class T3(nn.Module):
             )
             # Update the kv_cache.
             past = output.past_key_values
+            last_logits = output.logits[:, -1, :]
+
+        if session is not None:
+            session.close()
 
         # Concatenate all predicted tokens along the sequence dimension.
         predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
         return predicted_tokens
 
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: List[Tensor],
+        max_new_tokens=None,
+        temperature=0.8,
+        top_p=0.95,
+        min_p=0.05,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+    ) -> List[Tensor]:
+        """
+        Sample speech tokens for several texts with one voice in lockstep. `text_tokens` is a list of 1-D token
+        sequences with start/stop text tokens. Each row's prefix (conditioning, text, BOS) is built as in
+        `inference`, then left-padded and masked, with position ids counted from the first real token, so a row
+        decodes as it would alone. Finished rows keep emitting the stop token until every row has stopped.
+
+        The alignment stream analyzer is per-utterance, so multilingual models and the GPT-2 (turbo) T3 are not
+        supported. Returns one 1-D token tensor per text, ending with the stop token unless `max_new_tokens` ran out.
+        """
+        if self.hp.is_multilingual or self.is_gpt:
+            raise ValueError("batched T3 inference is only supported for the English Llama T3")
+        device, stop = self.device, self.hp.stop_speech_token
+        B, use_cfg = len(text_tokens), cfg_weight > 0.0
+
+        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
+        bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+        cond_rows, uncond_rows = [], []
+        for tt in text_tokens:
+            tt = torch.atleast_2d(tt).to(dtype=torch.long, device=device)
+            _ensure_BOT_EOT(tt, self.hp)
+            if use_cfg:
+                tt = torch.cat([tt, tt])
+            embeds, _ = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=tt,
+                speech_tokens=self.hp.start_speech_token * torch.ones_like(tt[:, :1]),
+                cfg_weight=cfg_weight,
+            )
+            embeds = torch.cat([embeds, bos_embed.expand(embeds.size(0), -1, -1).to(embeds.dtype)], dim=1)
+            cond_rows.append(embeds[0])
+            if use_cfg:
+                uncond_rows.append(embeds[1])
+        rows = cond_rows + uncond_rows  # CFG rows as [cond_0..cond_B-1, uncond_0..uncond_B-1]
+
+        L = max(r.size(0) for r in rows)
+        inputs_embeds = rows[0].new_zeros(len(rows), L, rows[0].size(-1))
+        attention_mask = torch.zeros(len(rows), L, dtype=torch.long, device=device)
+        for i, r in enumerate(rows):
+            inputs_embeds[i, L - r.size(0):] = r
+            attention_mask[i, L - r.size(0):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        out = self.tfmr(
+            inputs_embeds=inputs_embeds, attention_mask=attention_mask, position_ids=position_ids,
+            use_cache=True, return_dict=True,
+        )
+        past, last_logits = out.past_key_values, self.speech_head(out.last_hidden_state[:, -1])
+        position_ids = position_ids[:, -1:]
+
+        top_p_warper = TopPLogitsWarper(top_p=top_p)
+        min_p_warper = MinPLogitsWarper(min_p=min_p)
+        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+        generated_ids = bos_token.expand(B, 1)
+        finished = torch.zeros(B, dtype=torch.bool, device=device)
+        predicted = []
+
+        for i in range(max_new_tokens or self.hp.max_speech_tokens):
+            logits = last_logits.float()
+            if use_cfg:
+                cond, uncond = logits[:B], logits[B:]
+                logits = cond + cfg_weight * (cond - uncond)
+            logits = repetition_penalty_processor(generated_ids, logits)
+            if temperature != 1.0:
+                logits = logits / temperature
+            logits = min_p_warper(generated_ids, logits)
+            logits = top_p_warper(generated_ids, logits)
+            next_token = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)  # (B, 1)
+            next_token = next_token.masked_fill(finished[:, None], stop)
+
+            predicted.append(next_token)
+            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+            finished |= next_token.view(-1) == stop
+            if finished.all():
+                break
+
+            next_embed = self.speech_emb(next_token) + self.speech_pos_emb.get_fixed_embedding(i + 1)
+            if use_cfg:
+                next_embed = torch.cat([next_embed, next_embed])
+            attention_mask = F.pad(attention_mask, (0, 1), value=1)
+            position_ids = position_ids + 1
+            out = self.tfmr(
+                inputs_embeds=next_embed.to(inputs_embeds.dtype), attention_mask=attention_mask,
+                position_ids=position_ids, past_key_values=past, use_cache=True, return_dict=True,
+            )
+            past, last_logits = out.past_key_values, self.speech_head(out.last_hidden_state[:, -1])
+
+        tokens = torch.cat(predicted, dim=1)
+        is_stop = tokens == stop
+        lens = torch.where(is_stop.any(dim=1), is_stop.int().argmax(dim=1) + 1, tokens.size(1))
+        return [row[:n] for row, n in zip(tokens, lens.tolist())]
+
     @torch.inference_mode()
     def inference_turbo(self, t3_cond, text_tokens, temperature=0.8, top_k=1000, top_p=0.95, repetition_penalty=1.2,
                         max_gen_len=1000):
@@ -436,18 +600,23 @@ class T3(nn.Module):
 
         generated_speech_tokens = []
 
-        llm_outputs = self.tfmr(
-            inputs_embeds=embeds,
-            use_cache=True
-        )
+        session = None
+        if self.decoder is not None:
+            speech_logits, session = self.decoder.prefill(embeds, max_gen_len + 1)
+            speech_logits = speech_logits[:, None]
+        else:
+            llm_outputs = self.tfmr(
+                inputs_embeds=embeds,
+                use_cache=True
+            )
 
-        hidden_states = llm_outputs[0]
-        past_key_values = llm_outputs.past_key_values
+            hidden_states = llm_outputs[0]
+            past_key_values = llm_outputs.past_key_values
 
-        speech_hidden = hidden_states[:, -1:]
-        speech_logits = self.speech_head(speech_hidden)
+            speech_hidden = hidden_states[:, -1:]
+            speech_logits = self.speech_head(speech_hidden)
 
-        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :])
+        processed_logits = logits_processors(speech_start_token, speech_logits[:, -1, :].float())
         probs = F.softmax(processed_logits, dim=-1)
         next_speech_token = torch.multinomial(probs, num_samples=1)
 
@@ -457,18 +626,21 @@ class T3(nn.Module):
         for _ in tqdm(range(max_gen_len)):
             current_speech_embed = self.speech_emb(current_speech_token)
 
-            llm_outputs = self.tfmr(
-                inputs_embeds=current_speech_embed,
-                past_key_values=past_key_values,
-                use_cache=True
-            )
+            if session is not None:
+                speech_logits = session.step(current_speech_embed)[:, None]
+            else:
+                llm_outputs = self.tfmr(
+                    inputs_embeds=current_speech_embed,
+                    past_key_values=past_key_values,
+                    use_cache=True
+                )
 
-            hidden_states = llm_outputs[0]
-            past_key_values = llm_outputs.past_key_values
-            speech_logits = self.speech_head(hidden_states)
+                hidden_states = llm_outputs[0]
+                past_key_values = llm_outputs.past_key_values
+                speech_logits = self.speech_head(hidden_states)
 
             input_ids = torch.cat(generated_speech_tokens, dim=1)
-            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :])
+            processed_logits = logits_processors(input_ids, speech_logits[:, -1, :].float())
             if torch.all(processed_logits == -float("inf")):
                 print("Warning: All logits are -inf")
                 break
@@ -481,6 +653,8 @@ class T3(nn.Module):
             if torch.all(next_speech_token == self.hp.stop_speech_token):
                 break
 
+        if session is not None:
+            session.close()
         all_tokens = torch.cat(generated_speech_tokens, dim=1)
 
         # Remove EOS token if present
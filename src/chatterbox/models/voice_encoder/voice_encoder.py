@@ -245,7 +245,7 @@ class VoiceEncoder(nn.Module):
 
     def embeds_from_wavs(
         self,
-        wavs: List[np.ndarray],
+        wavs: List[Union[np.ndarray, torch.Tensor]],
         sample_rate,
         as_spk=False,
         batch_size=32,
@@ -257,6 +257,8 @@ class VoiceEncoder(nn.Module):
 
         :param trim_top_db: this argument was only added for the sake of compatibility with metavoice's implementation
         """
+        # (1, T) / (T,) tensors, e.g. from `PromptAudio.at(16000)`
+        wavs = [w.detach().float().cpu().numpy().reshape(-1) if torch.is_tensor(w) else w for w in wavs]
         if sample_rate != self.hp.sample_rate:
             wavs = [
                 librosa.resample(wav, orig_sr=sample_rate, target_sr=self.hp.sample_rate, res_type="kaiser_fast")
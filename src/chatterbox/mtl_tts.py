@@ -2,14 +2,16 @@ from dataclasses import dataclass
 from pathlib import Path
 import os
 
-import librosa
 import torch
 import perth
 import torch.nn.functional as F
-from safetensors.torch import load_file as load_safetensors
 from huggingface_hub import snapshot_download
 
 from .models.t3 import T3
+from .audio_frontend import PromptAudio
+from .models.loading import load_module, load_parallel
+from .models.registry import REGISTRY
+from .models.utils import resolve_dtype
 from .models.t3.modules.t3_config import T3Config
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
@@ -158,27 +160,48 @@ class ChatterboxMultilingualTTS:
         return SUPPORTED_LANGUAGES.copy()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxMultilingualTTS':
+    def from_local(cls, ckpt_dir, device, quantize=None, dtype=None) -> 'ChatterboxMultilingualTTS':
+        """
+        Args:
+            quantize: optional T3 quantization mode for CPU serving, "int8" (dynamic) or "int8_weight_only".
+            dtype: "fp32" (default) or "bf16". bf16 runs T3 and the S3Gen flow estimator in bfloat16; mel
+                extraction, STFT/ISTFT and the vocoder source stay in fp32.
+        """
         ckpt_dir = Path(ckpt_dir)
+        dtype = resolve_dtype(dtype)
+        if quantize and device != "cpu":
+            raise ValueError(f"T3 quantization ({quantize}) is only supported on CPU, got device={device}")
+
+        # components are built on the meta device, filled from mmap'd safetensors and loaded in parallel;
+        # ve.pt / s3gen.pt are converted to safetensors on first use (see `loading.cached_safetensors`)
+        # VE and S3Gen come from the process-wide registry, shared with other wrappers using the same weights
+        def load_ve():
+            path = ckpt_dir / "ve.pt"
+            return REGISTRY.get_or_load(
+                "ve", path, lambda: REGISTRY.dedupe(load_module(VoiceEncoder, path).to(device).eval()), device,
+            )
 
-        ve = VoiceEncoder()
-        ve.load_state_dict(
-            torch.load(ckpt_dir / "ve.pt", weights_only=True)
-        )
-        ve.to(device).eval()
-
-        t3 = T3(T3Config.multilingual())
-        t3_state = load_safetensors(ckpt_dir / "t3_mtl23ls_v2.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        t3.to(device).eval()
-
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            torch.load(ckpt_dir / "s3gen.pt", weights_only=True)
+        def load_t3():
+            t3 = load_module(
+                lambda: T3(T3Config.multilingual()), ckpt_dir / "t3_mtl23ls_v2.safetensors",
+                transform=lambda s: s["model"][0] if "model" in s else s,
+            )
+            t3.to(device=device, dtype=dtype).eval()
+            if quantize:
+                t3.quantize(quantize)
+            return t3
+
+        estimator_mode = "bf16" if dtype == torch.bfloat16 else "fp32"
+
+        def load_s3gen():
+            s3gen = load_module(lambda: S3Gen(estimator_mode=estimator_mode), ckpt_dir / "s3gen.pt")
+            s3gen.mel2wav.prepare_for_inference()
+            return REGISTRY.share_s3gen_parts(s3gen.to(device).eval())
+
+        ve, t3, s3gen = load_parallel(
+            load_ve, load_t3,
+            lambda: REGISTRY.get_or_load("s3gen", ckpt_dir / "s3gen.pt", load_s3gen, device, estimator_mode),
         )
-        s3gen.to(device).eval()
 
         tokenizer = MTLTokenizer(
             str(ckpt_dir / "grapheme_mtl_merged_expanded_v1.json")
@@ -191,7 +214,7 @@ class ChatterboxMultilingualTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device: torch.device) -> 'ChatterboxMultilingualTTS':
+    def from_pretrained(cls, device: torch.device, quantize=None, dtype=None) -> 'ChatterboxMultilingualTTS':
         ckpt_dir = Path(
             snapshot_download(
                 repo_id=REPO_ID,
@@ -201,22 +224,24 @@ class ChatterboxMultilingualTTS:
                 token=os.getenv("HF_TOKEN"),
             )
         )
-        return cls.from_local(ckpt_dir, device)
+        return cls.from_local(ckpt_dir, device, quantize=quantize, dtype=dtype)
     
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        ## Load reference wav: decoded once, resampled once per rate (`wav_fpath` may also be bytes or a PromptAudio)
+        prompt = PromptAudio.load(wav_fpath)
+        ref_16k_wav = prompt.at(S3_SR)
+
+        s3gen_ref_wav = prompt.at(S3GEN_SR)[:, :self.DEC_COND_LEN]
+        s3gen_ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device,
+            ref_wav_16=ref_16k_wav[:, :self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
 
         # Speech cond prompt tokens
         t3_cond_prompt_tokens = None
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:, :self.ENC_COND_LEN]], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
@@ -241,6 +266,8 @@ class ChatterboxMultilingualTTS:
         repetition_penalty=2.0,
         min_p=0.05,
         top_p=1.0,
+        n_cfm_timesteps=None,
+        cfm_solver=None,
     ):
         # Validate language_id
         if language_id and language_id.lower() not in SUPPORTED_LANGUAGES:
@@ -295,6 +322,8 @@ class ChatterboxMultilingualTTS:
             wav, _ = self.s3gen.inference(
                 speech_tokens=speech_tokens,
                 ref_dict=self.conds.gen,
+                n_cfm_timesteps=n_cfm_timesteps,
+                cfm_solver=cfm_solver,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
@@ -1,14 +1,16 @@
 from dataclasses import dataclass
 from pathlib import Path
 
-import librosa
 import torch
 import perth
 import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
 from .models.t3 import T3
+from .audio_frontend import PromptAudio
+from .models.loading import load_module, load_parallel
+from .models.registry import REGISTRY
+from .models.utils import resolve_dtype
 from .models.s3tokenizer import S3_SR, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
@@ -126,8 +128,17 @@ class ChatterboxTTS:
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, quantize=None, dtype=None) -> 'ChatterboxTTS':
+        """
+        Args:
+            quantize: optional T3 quantization mode for CPU serving, "int8" (dynamic) or "int8_weight_only".
+            dtype: "fp32" (default) or "bf16". bf16 runs T3 and the S3Gen flow estimator in bfloat16; mel
+                extraction, STFT/ISTFT and the vocoder source stay in fp32.
+        """
         ckpt_dir = Path(ckpt_dir)
+        dtype = resolve_dtype(dtype)
+        if quantize and device != "cpu":
+            raise ValueError(f"T3 quantization ({quantize}) is only supported on CPU, got device={device}")
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
         if device in ["cpu", "mps"]:
@@ -135,24 +146,32 @@ class ChatterboxTTS:
         else:
             map_location = None
 
-        ve = VoiceEncoder()
-        ve.load_state_dict(
-            load_file(ckpt_dir / "ve.safetensors")
-        )
-        ve.to(device).eval()
-
-        t3 = T3()
-        t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        t3.to(device).eval()
-
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
+        # components are built on the meta device, filled from mmap'd safetensors and loaded in parallel;
+        # VE and S3Gen come from the process-wide registry, shared with other wrappers using the same weights
+        def load_ve():
+            path = ckpt_dir / "ve.safetensors"
+            return REGISTRY.get_or_load(
+                "ve", path, lambda: REGISTRY.dedupe(load_module(VoiceEncoder, path).to(device).eval()), device,
+            )
+
+        def load_t3():
+            t3 = load_module(T3, ckpt_dir / "t3_cfg.safetensors", transform=lambda s: s["model"][0] if "model" in s else s)
+            t3.to(device=device, dtype=dtype).eval()
+            if quantize:
+                t3.quantize(quantize)
+            return t3
+
+        estimator_mode = "bf16" if dtype == torch.bfloat16 else "fp32"
+
+        def load_s3gen():
+            s3gen = load_module(lambda: S3Gen(estimator_mode=estimator_mode), ckpt_dir / "s3gen.safetensors", strict=False)
+            s3gen.mel2wav.prepare_for_inference()
+            return REGISTRY.share_s3gen_parts(s3gen.to(device).eval())
+
+        ve, t3, s3gen = load_parallel(
+            load_ve, load_t3,
+            lambda: REGISTRY.get_or_load("s3gen", ckpt_dir / "s3gen.safetensors", load_s3gen, device, estimator_mode),
         )
-        s3gen.to(device).eval()
 
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
@@ -165,7 +184,7 @@ class ChatterboxTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, quantize=None, dtype=None) -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -177,21 +196,23 @@ class ChatterboxTTS:
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, quantize=quantize, dtype=dtype)
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        ## Load reference wav: decoded once, resampled once per rate (`wav_fpath` may also be bytes or a PromptAudio)
+        prompt = PromptAudio.load(wav_fpath)
+        ref_16k_wav = prompt.at(S3_SR)
+
+        s3gen_ref_wav = prompt.at(S3GEN_SR)[:, :self.DEC_COND_LEN]
+        s3gen_ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device,
+            ref_wav_16=ref_16k_wav[:, :self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:, :self.ENC_COND_LEN]], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
@@ -205,17 +226,9 @@ class ChatterboxTTS:
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
 
-    def generate(
-        self,
-        text,
-        repetition_penalty=1.2,
-        min_p=0.05,
-        top_p=1.0,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-    ):
+    def _speech_tokens(self, text, repetition_penalty, min_p, top_p, audio_prompt_path, exaggeration, cfg_weight,
+                       temperature):
+        "Conditioning update and T3 sampling shared by `generate` and `generate_stream`; returns 1-D speech tokens"
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
@@ -261,12 +274,141 @@ class ChatterboxTTS:
             
             speech_tokens = speech_tokens[speech_tokens < 6561]
 
-            speech_tokens = speech_tokens.to(self.device)
+            return speech_tokens.to(self.device)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
+    def generate(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_cfm_timesteps=None,
+        cfm_solver=None,
+        flow_prompt_seconds=None,
+        flow_prompt_mode="tail",
+        vocoder_chunk_frames=None,
+        flow_chunk_tokens=None,
+    ):
+        """
+        `vocoder_chunk_frames` vocodes in fixed mel windows (flat vocoder memory); `flow_chunk_tokens` also runs
+        the flow in token windows (see `S3Gen.inference_stream`), which bounds flow memory on long texts too.
+        """
+        speech_tokens = self._speech_tokens(
+            text, repetition_penalty, min_p, top_p, audio_prompt_path, exaggeration, cfg_weight, temperature,
+        )
+        with torch.inference_mode():
+            # bound the reference context the flow runs over (see `S3Gen.crop_ref_dict`)
+            ref_dict = self.s3gen.crop_ref_dict(self.conds.gen, flow_prompt_seconds, flow_prompt_mode)
+            if flow_chunk_tokens:
+                wavs = list(self.s3gen.inference_stream(
+                    speech_tokens, ref_dict, chunk_tokens=flow_chunk_tokens, n_cfm_timesteps=n_cfm_timesteps,
+                    cfm_solver=cfm_solver,
+                ))
+                wav = torch.cat(wavs, dim=1) if wavs else torch.zeros(1, 0)
+            else:
+                wav, _ = self.s3gen.inference(
+                    speech_tokens=speech_tokens,
+                    ref_dict=ref_dict,
+                    n_cfm_timesteps=n_cfm_timesteps,
+                    cfm_solver=cfm_solver,
+                    vocoder_chunk_frames=vocoder_chunk_frames,
+                )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_cfm_timesteps=None,
+        cfm_solver=None,
+        flow_prompt_seconds=None,
+        flow_prompt_mode="tail",
+        flow_chunk_tokens=100,
+    ):
+        """
+        `generate` that yields (1, n) watermarked audio chunks as the flow and vocoder work through windows of
+        `flow_chunk_tokens` speech tokens (see `S3Gen.inference_stream`), so playback can start after the first
+        window instead of after the whole utterance. T3 sampling still completes first.
+        """
+        speech_tokens = self._speech_tokens(
+            text, repetition_penalty, min_p, top_p, audio_prompt_path, exaggeration, cfg_weight, temperature,
+        )
+        ref_dict = self.s3gen.crop_ref_dict(self.conds.gen, flow_prompt_seconds, flow_prompt_mode)
+        for wav in self.s3gen.inference_stream(
+            speech_tokens, ref_dict, chunk_tokens=flow_chunk_tokens, n_cfm_timesteps=n_cfm_timesteps,
+            cfm_solver=cfm_solver,
+        ):
+            wav = wav.squeeze(0).detach().cpu().numpy()
+            yield torch.from_numpy(self.watermarker.apply_watermark(wav, sample_rate=self.sr)).unsqueeze(0)
+
+    def generate_batch(
+        self,
+        texts,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        n_cfm_timesteps=None,
+        cfm_solver=None,
+        flow_prompt_seconds=None,
+        flow_prompt_mode="tail",
+        return_token_counts=False,
+    ):
+        """
+        `generate` for several texts with the prepared voice: one lockstep T3 sampling run (`T3.inference_batch`)
+        and one padded S3Gen pass (`S3Gen.inference_batch`). Texts of similar length batch with the least padding.
+        Returns one (1, n) waveform per text, and with `return_token_counts` also the number of speech tokens T3
+        sampled for each text.
+        """
+        assert self.conds is not None, "Please `prepare_conditionals` first"
+        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
+            _cond: T3Cond = self.conds.t3
+            self.conds.t3 = T3Cond(
+                speaker_emb=_cond.speaker_emb,
+                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
+                emotion_adv=exaggeration * torch.ones(1, 1, 1),
+            ).to(device=self.device)
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = []
+        for text in texts:
+            tt = self.tokenizer.text_to_tokens(punc_norm(text)).to(self.device)[0]
+            text_tokens.append(F.pad(F.pad(tt, (1, 0), value=sot), (0, 1), value=eot))
+
+        with torch.inference_mode():
+            speech_tokens = self.t3.inference_batch(
+                t3_cond=self.conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=self.t3.hp.max_speech_tokens,
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            )
+            token_counts = [t.numel() for t in speech_tokens]
+            speech_tokens = [drop_invalid_tokens(t) for t in speech_tokens]
+            ref_dict = self.s3gen.crop_ref_dict(self.conds.gen, flow_prompt_seconds, flow_prompt_mode)
+            wavs = self.s3gen.inference_batch(
+                speech_tokens, ref_dict, n_cfm_timesteps=n_cfm_timesteps, cfm_solver=cfm_solver,
+            )
+            out = []
+            for wav in wavs:
+                wav = wav.squeeze(0).detach().cpu().numpy()
+                out.append(torch.from_numpy(self.watermarker.apply_watermark(wav, sample_rate=self.sr)).unsqueeze(0))
+        return (out, token_counts) if return_token_counts else out
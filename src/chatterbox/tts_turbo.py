@@ -3,16 +3,18 @@ import math
 from dataclasses import dataclass
 from pathlib import Path
 
-import librosa
 import torch
 import perth
 import pyloudnorm as ln
 
-from safetensors.torch import load_file
 from huggingface_hub import snapshot_download
 from transformers import AutoTokenizer
 
 from .models.t3 import T3
+from .audio_frontend import PromptAudio
+from .models.loading import load_module, load_parallel
+from .models.registry import REGISTRY
+from .models.utils import resolve_dtype
 from .models.s3tokenizer import S3_SR
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
@@ -130,8 +132,17 @@ class ChatterboxTurboTTS:
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTurboTTS':
+    def from_local(cls, ckpt_dir, device, quantize=None, dtype=None) -> 'ChatterboxTurboTTS':
+        """
+        Args:
+            quantize: optional T3 quantization mode for CPU serving, "int8" (dynamic) or "int8_weight_only".
+            dtype: "fp32" (default) or "bf16". bf16 runs T3 and the S3Gen flow estimator in bfloat16; mel
+                extraction, STFT/ISTFT and the vocoder source stay in fp32.
+        """
         ckpt_dir = Path(ckpt_dir)
+        dtype = resolve_dtype(dtype)
+        if quantize and device != "cpu":
+            raise ValueError(f"T3 quantization ({quantize}) is only supported on CPU, got device={device}")
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
         if device in ["cpu", "mps"]:
@@ -139,12 +150,6 @@ class ChatterboxTurboTTS:
         else:
             map_location = None
 
-        ve = VoiceEncoder()
-        ve.load_state_dict(
-            load_file(ckpt_dir / "ve.safetensors")
-        )
-        ve.to(device).eval()
-
         # Turbo specific hp
         hp = T3Config(text_tokens_dict_size=50276)
         hp.llama_config_name = "GPT2_medium"
@@ -154,20 +159,37 @@ class ChatterboxTurboTTS:
         hp.use_perceiver_resampler = False
         hp.emotion_adv = False
 
-        t3 = T3(hp)
-        t3_state = load_file(ckpt_dir / "t3_turbo_v1.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        del t3.tfmr.wte
-        t3.to(device).eval()
-
-        s3gen = S3Gen(meanflow=True)
-        weights = load_file(ckpt_dir / "s3gen_meanflow.safetensors")
-        s3gen.load_state_dict(
-            weights, strict=True
+        # components are built on the meta device, filled from mmap'd safetensors and loaded in parallel;
+        # VE and S3Gen come from the process-wide registry, shared with other wrappers using the same weights
+        def load_ve():
+            path = ckpt_dir / "ve.safetensors"
+            return REGISTRY.get_or_load(
+                "ve", path, lambda: REGISTRY.dedupe(load_module(VoiceEncoder, path).to(device).eval()), device,
+            )
+
+        def load_t3():
+            t3 = load_module(
+                lambda: T3(hp), ckpt_dir / "t3_turbo_v1.safetensors",
+                transform=lambda s: s["model"][0] if "model" in s else s,
+            )
+            del t3.tfmr.wte
+            t3.to(device=device, dtype=dtype).eval()
+            if quantize:
+                t3.quantize(quantize)
+            return t3
+
+        estimator_mode = "bf16" if dtype == torch.bfloat16 else "fp32"
+        s3gen_path = ckpt_dir / "s3gen_meanflow.safetensors"
+
+        def load_s3gen():
+            s3gen = load_module(lambda: S3Gen(meanflow=True, estimator_mode=estimator_mode), s3gen_path, strict=True)
+            s3gen.mel2wav.prepare_for_inference()
+            return REGISTRY.share_s3gen_parts(s3gen.to(device).eval())
+
+        ve, t3, s3gen = load_parallel(
+            load_ve, load_t3,
+            lambda: REGISTRY.get_or_load("s3gen_meanflow", s3gen_path, load_s3gen, device, estimator_mode),
         )
-        s3gen.to(device).eval()
 
         tokenizer = AutoTokenizer.from_pretrained(ckpt_dir)
         if tokenizer.pad_token is None:
@@ -183,7 +205,7 @@ class ChatterboxTurboTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTurboTTS':
+    def from_pretrained(cls, device, quantize=None, dtype=None) -> 'ChatterboxTurboTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -199,7 +221,7 @@ class ChatterboxTurboTTS:
             allow_patterns=["*.safetensors", "*.json", "*.txt", "*.pt", "*.model"]
         )
 
-        return cls.from_local(local_path, device)
+        return cls.from_local(local_path, device, quantize=quantize, dtype=dtype)
 
     def norm_loudness(self, wav, sr, target_lufs=-27):
         try:
@@ -215,23 +237,26 @@ class ChatterboxTurboTTS:
         return wav
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5, norm_loudness=True):
-        ## Load and norm reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
+        ## Load and norm reference wav: decoded once, resampled once per rate (`wav_fpath` may also be bytes or a PromptAudio)
+        prompt = PromptAudio.load(wav_fpath)
 
-        assert len(s3gen_ref_wav) / _sr > 5.0, "Audio prompt must be longer than 5 seconds!"
+        assert prompt.duration() > 5.0, "Audio prompt must be longer than 5 seconds!"
 
         if norm_loudness:
-            s3gen_ref_wav = self.norm_loudness(s3gen_ref_wav, _sr)
+            prompt = PromptAudio(self.norm_loudness(prompt.numpy(S3GEN_SR), S3GEN_SR), S3GEN_SR)
 
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+        ref_16k_wav = prompt.at(S3_SR)
 
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        s3gen_ref_wav = prompt.at(S3GEN_SR)[:, :self.DEC_COND_LEN]
+        s3gen_ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device,
+            ref_wav_16=ref_16k_wav[:, :self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
 
         # Speech cond prompt tokens
         if plen := self.t3.hp.speech_cond_prompt_len:
             s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
+            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:, :self.ENC_COND_LEN]], max_len=plen)
             t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
 
         # Voice-encoder speaker embedding
@@ -257,6 +282,7 @@ class ChatterboxTurboTTS:
         temperature=0.8,
         top_k=1000,
         norm_loudness=True,
+        n_cfm_timesteps=2,
     ):
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration, norm_loudness=norm_loudness)
@@ -289,7 +315,7 @@ class ChatterboxTurboTTS:
         wav, _ = self.s3gen.inference(
             speech_tokens=speech_tokens,
             ref_dict=self.conds.gen,
-            n_cfm_timesteps=2,
+            n_cfm_timesteps=n_cfm_timesteps,
         )
         wav = wav.squeeze(0).detach().cpu().numpy()
         watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
@@ -1,13 +1,15 @@
 from pathlib import Path
 
-import librosa
 import torch
 import perth
 from huggingface_hub import hf_hub_download
-from safetensors.torch import load_file
 
-from .models.s3tokenizer import S3_SR
+from .audio_frontend import PromptAudio, iter_audio_windows
+from .models.loading import load_module
+from .models.registry import REGISTRY
+from .models.s3tokenizer import S3_SR, S3_TOKEN_RATE
 from .models.s3gen import S3GEN_SR, S3Gen
+from .models.s3gen.hifigan import HiFTStreamer
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -50,11 +52,13 @@ class ChatterboxVC:
             states = torch.load(builtin_voice, map_location=map_location)
             ref_dict = states['gen']
 
-        s3gen = S3Gen()
-        s3gen.load_state_dict(
-            load_file(ckpt_dir / "s3gen.safetensors"), strict=False
-        )
-        s3gen.to(device).eval()
+        def load_s3gen():
+            s3gen = load_module(S3Gen, ckpt_dir / "s3gen.safetensors", strict=False)
+            s3gen.mel2wav.prepare_for_inference()
+            return REGISTRY.share_s3gen_parts(s3gen.to(device).eval())
+
+        # shared with a ChatterboxTTS loaded from the same checkpoint (see `models.registry`)
+        s3gen = REGISTRY.get_or_load("s3gen", ckpt_dir / "s3gen.safetensors", load_s3gen, device, "fp32")
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
@@ -74,11 +78,13 @@ class ChatterboxVC:
         return cls.from_local(Path(local_path).parent, device)
 
     def set_target_voice(self, wav_fpath):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        ## Load reference wav: decoded once, resampled once per rate (`wav_fpath` may also be bytes or a PromptAudio)
+        prompt = PromptAudio.load(wav_fpath)
+        s3gen_ref_wav = prompt.at(S3GEN_SR)[:, :self.DEC_COND_LEN]
+        self.ref_dict = self.s3gen.embed_ref(
+            s3gen_ref_wav, S3GEN_SR, device=self.device,
+            ref_wav_16=prompt.at(S3_SR)[:, :self.DEC_COND_LEN * S3_SR // S3GEN_SR],
+        )
 
     def generate(
         self,
@@ -91,8 +97,7 @@ class ChatterboxVC:
             assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
 
         with torch.inference_mode():
-            audio_16, _ = librosa.load(audio, sr=S3_SR)
-            audio_16 = torch.from_numpy(audio_16).float().to(self.device)[None, ]
+            audio_16 = PromptAudio.load(audio).at(S3_SR).to(self.device)
 
             s3_tokens, _ = self.s3gen.tokenizer(audio_16)
             wav, _ = self.s3gen.inference(
@@ -101,4 +106,82 @@ class ChatterboxVC:
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(watermarked_wav).unsqueeze(0)
\ No newline at end of file
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        audio,
+        target_voice_path=None,
+        block_seconds=20.0,
+        context_seconds=2.0,
+        overlap_frames=20,
+    ):
+        """
+        Convert a long recording block by block with bounded memory, yielding (1, n) waveforms as they are ready.
+
+        The source is read in `block_seconds` windows with `context_seconds` of neighbouring audio on each side
+        (`iter_audio_windows`). Each window is tokenized and converted with the cached target `ref_dict`, the mels
+        of the context are dropped, and the block's mels go through a `HiFTStreamer`, which carries the source
+        phase across blocks and crossfades the joins. Each yielded piece is watermarked on its own.
+        """
+        if target_voice_path:
+            self.set_target_voice(target_voice_path)
+        else:
+            assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
+
+        samples_per_token = S3_SR // S3_TOKEN_RATE
+        mel_ratio = self.s3gen.flow.token_mel_ratio
+        streamer = HiFTStreamer(self.s3gen.mel2wav, overlap_frames)
+        trim_fade = self.s3gen.trim_fade
+        done = 0
+        with torch.inference_mode():
+            windows = iter_audio_windows(audio, S3_SR, block_seconds, context_seconds)
+            window = next(windows, None)
+            while window is not None:
+                wav_16, left, right = window
+                window = next(windows, None)
+                s3_tokens, _ = self.s3gen.tokenizer(wav_16.to(self.device))
+                mels = self.s3gen.flow_inference(torch.atleast_2d(s3_tokens), ref_dict=self.ref_dict, finalize=True)
+                lo = round(left / samples_per_token) * mel_ratio
+                hi = mels.size(2) - round(right / samples_per_token) * mel_ratio
+                mels = mels[:, :, lo:hi].to(dtype=next(self.s3gen.mel2wav.parameters()).dtype)
+                wav = streamer.push(mels, last=window is None)
+                if wav.size(1) == 0:
+                    continue
+                # the same spillover fade `S3Gen.inference` applies to the start of the output
+                if done < len(trim_fade):
+                    n = min(len(trim_fade) - done, wav.size(1))
+                    wav[:, :n] *= trim_fade[done:done + n].to(wav)
+                done += wav.size(1)
+                wav = wav.squeeze(0).detach().cpu().numpy()
+                yield torch.from_numpy(self.watermarker.apply_watermark(wav, sample_rate=self.sr)).unsqueeze(0)
+
+    def generate_batch(
+        self,
+        audios,
+        target_voice_path=None,
+        batch_size=8,
+    ):
+        """
+        Convert several clips to one target voice. The target is embedded once; the clips are decoded, sorted by
+        length and processed `batch_size` at a time with one batched tokenizer call and one padded flow + HiFT
+        pass (`S3Gen.inference_batch`) per batch. `audios` are paths, bytes or `PromptAudio`s; returns one (1, n)
+        waveform per clip, in input order.
+        """
+        if target_voice_path:
+            self.set_target_voice(target_voice_path)
+        else:
+            assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
+
+        clips = [PromptAudio.load(a).at(S3_SR) for a in audios]
+        order = sorted(range(len(clips)), key=lambda i: clips[i].size(1))
+        out = [None] * len(clips)
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                idx = order[start:start + batch_size]
+                s3_tokens, token_lens = self.s3gen.tokenizer([clips[i].to(self.device) for i in idx])
+                wavs = self.s3gen.inference_batch(s3_tokens, self.ref_dict, speech_token_lens=token_lens)
+                for i, wav in zip(idx, wavs):
+                    wav = wav.squeeze(0).detach().cpu().numpy()
+                    out[i] = torch.from_numpy(self.watermarker.apply_watermark(wav, sample_rate=self.sr)).unsqueeze(0)
+        return out